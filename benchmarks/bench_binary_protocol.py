@@ -0,0 +1,115 @@
+"""
+    Encoding and decoding speed of TBinaryProtocol vs TBinaryProtocolAccelerated
+
+    Without the fastbinary C extension, TBinaryProtocolAccelerated uses the
+    compiled pure-Python codec of thrift.protocol.TBinaryCodec.
+
+    Usage: python benchmarks/bench_binary_protocol.py [--rounds N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zaailabcorelib.thrift.protocol.TProtocol import TType
+from zaailabcorelib.thrift.protocol.TBase import TBase
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from zaailabcorelib.thrift.transport.TTransport import TMemoryBuffer
+
+
+class Box(TBase):
+    __slots__ = ('label', 'score', 'coords')
+
+    def __init__(self, label=None, score=None, coords=None):
+        self.label = label
+        self.score = score
+        self.coords = coords
+
+
+Box.thrift_spec = (
+    None,
+    (1, TType.STRING, 'label', 'UTF8', None, ),
+    (2, TType.DOUBLE, 'score', None, None, ),
+    (3, TType.LIST, 'coords', (TType.I32, None, False), None, ),
+)
+
+
+class Prediction(TBase):
+    __slots__ = ('request_id', 'error_code', 'latency', 'boxes', 'embedding', 'tags', 'payload')
+
+    def __init__(self, request_id=None, error_code=None, latency=None, boxes=None, embedding=None,
+                 tags=None, payload=None):
+        self.request_id = request_id
+        self.error_code = error_code
+        self.latency = latency
+        self.boxes = boxes
+        self.embedding = embedding
+        self.tags = tags
+        self.payload = payload
+
+
+Prediction.thrift_spec = (
+    None,
+    (1, TType.I64, 'request_id', None, None, ),
+    (2, TType.I32, 'error_code', None, None, ),
+    (3, TType.DOUBLE, 'latency', None, None, ),
+    (4, TType.LIST, 'boxes', (TType.STRUCT, [Box, Box.thrift_spec], False), None, ),
+    (5, TType.LIST, 'embedding', (TType.DOUBLE, None, False), None, ),
+    (6, TType.MAP, 'tags', (TType.STRING, 'UTF8', TType.I32, None, False), None, ),
+    (7, TType.STRING, 'payload', 'BINARY', None, ),
+)
+
+
+def small():
+    return Box(label='cat', score=0.97, coords=[10, 20, 110, 220])
+
+
+def large():
+    return Prediction(request_id=123456789012, error_code=0, latency=0.0123,
+                      boxes=[Box(label='obj%d' % i, score=i / 50.0, coords=[i, i + 1, i + 2, i + 3])
+                             for i in range(50)],
+                      embedding=[i / 512.0 for i in range(512)],
+                      tags=dict(('tag%d' % i, i) for i in range(20)),
+                      payload=os.urandom(1024))
+
+
+def encode(protocol_cls, obj):
+    trans = TMemoryBuffer()
+    obj.write(protocol_cls(trans))
+    return trans.getvalue()
+
+
+def decode(protocol_cls, cls, data):
+    obj = cls()
+    obj.read(protocol_cls(TMemoryBuffer(data)))
+    return obj
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+    accelerated = TBinaryProtocolAccelerated(TMemoryBuffer())
+    print('accelerated codec: %s' % accelerated._fast_encode.__module__)
+    for name, obj, rounds in (('small', small(), args.rounds * 10), ('large', large(), args.rounds // 10)):
+        data = encode(TBinaryProtocol, obj)
+        # both paths must agree on the wire format
+        assert encode(TBinaryProtocolAccelerated, obj) == data
+        assert decode(TBinaryProtocolAccelerated, type(obj), data) == obj
+        print('%s struct, %d bytes, %d rounds' % (name, len(data), rounds))
+        for op in ('encode', 'decode'):
+            timings = []
+            for protocol_cls in (TBinaryProtocol, TBinaryProtocolAccelerated):
+                if op == 'encode':
+                    seconds = timeit.timeit(lambda: encode(protocol_cls, obj), number=rounds)
+                else:
+                    seconds = timeit.timeit(lambda: decode(protocol_cls, type(obj), data), number=rounds)
+                timings.append(seconds / rounds * 1e6)
+            print('  %s: TBinaryProtocol %8.1f us  TBinaryProtocolAccelerated %8.1f us  x%.1f'
+                  % (op, timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+    Encoding and decoding speed of list<double> embeddings, per element vs in bulk
+
+    "per element" writes and reads one double at a time, as before
+    writeNumbers() and readNumbers(). "bulk" packs the whole list at once and
+    "numpy" also decodes to numpy arrays and encodes from them.
+    TBinaryProtocolAccelerated goes through its codec, never per element.
+
+    Usage: python benchmarks/bench_numeric_lists.py [--rounds N] [--dim N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy
+
+from zaailabcorelib.thrift.protocol.TProtocol import TType, TProtocolBase
+from zaailabcorelib.thrift.protocol.TBase import TBase
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from zaailabcorelib.thrift.protocol.TCompactProtocol import TCompactProtocol
+from zaailabcorelib.thrift.transport.TTransport import TMemoryBuffer
+
+
+class Embedding(TBase):
+    __slots__ = ('id', 'vector')
+
+    def __init__(self, id=None, vector=None):
+        self.id = id
+        self.vector = vector
+
+
+Embedding.thrift_spec = (
+    None,
+    (1, TType.I64, 'id', None, None, ),
+    (2, TType.LIST, 'vector', (TType.DOUBLE, None, False), None, ),
+)
+
+
+def per_element(protocol_cls):
+    class PerElement(protocol_cls):
+        writeNumbers = TProtocolBase.writeNumbers
+        readNumbers = TProtocolBase.readNumbers
+    return PerElement
+
+
+def encode(protocol_cls, obj):
+    trans = TMemoryBuffer()
+    obj.write(protocol_cls(trans))
+    return trans.getvalue()
+
+
+def decode(protocol_cls, data, **kwargs):
+    obj = Embedding()
+    obj.read(protocol_cls(TMemoryBuffer(data), **kwargs))
+    return obj
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    parser.add_argument('--dim', type=int, default=512)
+    args = parser.parse_args()
+    vector = [i / float(args.dim) for i in range(args.dim)]
+    as_list = Embedding(id=1, vector=vector)
+    as_array = Embedding(id=1, vector=numpy.array(vector))
+    print('%d-d embedding, %d rounds' % (args.dim, args.rounds))
+    print('  %-34s %14s %14s %14s' % ('', 'per element us', 'bulk us', 'numpy us'))
+    for protocol_cls in (TBinaryProtocol, TCompactProtocol, TBinaryProtocolAccelerated):
+        data = encode(protocol_cls, as_list)
+        slow_cls = per_element(protocol_cls) if protocol_cls is not TBinaryProtocolAccelerated else None
+        assert slow_cls is None or encode(slow_cls, as_list) == data
+        assert encode(protocol_cls, as_array) == data
+        assert decode(protocol_cls, data, numpy_arrays=True).vector.tolist() == vector
+        for op in ('encode', 'decode'):
+            if op == 'encode':
+                runs = (slow_cls and (lambda: encode(slow_cls, as_list)),
+                        lambda: encode(protocol_cls, as_list),
+                        lambda: encode(protocol_cls, as_array))
+            else:
+                runs = (slow_cls and (lambda: decode(slow_cls, data)),
+                        lambda: decode(protocol_cls, data),
+                        lambda: decode(protocol_cls, data, numpy_arrays=True))
+            timings = ['%14.1f' % (timeit.timeit(run, number=args.rounds) / args.rounds * 1e6) if run else '%14s' % '-'
+                       for run in runs]
+            print('  %-34s %s' % ('%s %s' % (protocol_cls.__name__, op), ' '.join(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+    Size and speed of the binary, compact and JSON protocols through TSerialization
+
+    Every protocol is timed with the cached serializers of serialize() and
+    deserialize(), and with serialize_many() and deserialize_many() packing
+    a batch of structs into one buffer. The structs are those of
+    bench_binary_protocol.py.
+
+    Usage: python benchmarks/bench_serialization.py [--rounds N] [--batch N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zaailabcorelib.thrift import TSerialization
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolAcceleratedFactory
+from zaailabcorelib.thrift.protocol.TCompactProtocol import TCompactProtocolAcceleratedFactory
+from zaailabcorelib.thrift.protocol.TJSONProtocol import TJSONProtocolFactory
+
+from bench_binary_protocol import small, large
+
+PROTOCOLS = (
+    ('binary', TBinaryProtocolAcceleratedFactory()),
+    ('compact', TCompactProtocolAcceleratedFactory()),
+    ('json', TJSONProtocolFactory()),
+)
+
+
+def per_call_us(fn, rounds):
+    return timeit.timeit(fn, number=rounds) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+    for name, obj, rounds in (('small', small(), args.rounds * 10), ('large', large(), args.rounds // 10)):
+        cls = type(obj)
+        batch = [obj] * args.batch
+        batch_rounds = max(1, rounds // args.batch)
+        print('%s struct, %d rounds, batches of %d' % (name, rounds, args.batch))
+        print('  %-8s %8s %12s %12s %16s %16s'
+              % ('protocol', 'bytes', 'encode us', 'decode us', 'encode_many us', 'decode_many us'))
+        for protocol, factory in PROTOCOLS:
+            data = TSerialization.serialize(obj, factory)
+            assert TSerialization.deserialize(cls(), data, factory) == obj
+            packed = TSerialization.serialize_many(batch, factory)
+            assert TSerialization.deserialize_many(cls, packed, factory) == batch
+            timings = (
+                per_call_us(lambda: TSerialization.serialize(obj, factory), rounds),
+                per_call_us(lambda: TSerialization.deserialize(cls(), data, factory), rounds),
+                per_call_us(lambda: TSerialization.serialize_many(batch, factory), batch_rounds) / args.batch,
+                per_call_us(lambda: TSerialization.deserialize_many(cls, packed, factory), batch_rounds) / args.batch,
+            )
+            print('  %-8s %8d %12.1f %12.1f %16.1f %16.1f' % ((protocol, len(data)) + timings))
+
+
+if __name__ == '__main__':
+    main()
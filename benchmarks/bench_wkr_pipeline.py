@@ -0,0 +1,106 @@
+"""
+    Worker throughput with its stages run in sequence or pipelined
+
+    A WKRWorkerSkeleton whose preprocessing, predict and postprocessing
+    each sleep for a while, as a model releasing the GIL on a device would,
+    serves requests queued on its sockets in batches. "sequential" runs the
+    stages one after the other, "pipeline" overlaps them in threads with
+    -pipeline_depth batches queued between stages.
+
+    Usage: python benchmarks/bench_wkr_pipeline.py [--requests N] [--stage_ms 3,5,3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import zmq
+
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server.helper import get_args_parser
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server.protocol import send_to_next, recv_from_prev, recv_credit
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server.worker_skeleton import WKRWorkerSkeleton
+
+
+class SleepyWorker(WKRWorkerSkeleton):
+    stage_seconds = (0, 0, 0)
+
+    def get_preprocess(self, envs):
+        def preprocessing(input):
+            time.sleep(self.stage_seconds[0])
+            return input
+        return preprocessing
+
+    def get_postprocess(self, envs):
+        def post_process(output):
+            time.sleep(self.stage_seconds[2])
+            return output
+        return post_process
+
+    def predict(self, model, input):
+        time.sleep(self.stage_seconds[1])
+        return input
+
+
+def run(pipeline_depth, stage_seconds, requests, batch_size, port):
+    args = get_args_parser().parse_args(['-model_dir', '/tmp', '-protocol', 'numpy',
+                                         '-pipeline_depth', str(pipeline_depth)])
+    worker_addr = 'tcp://127.0.0.1:%d' % port
+    sink_addr = 'tcp://127.0.0.1:%d' % (port + 1)
+    ctx = zmq.Context()
+    jobs, results = ctx.socket(zmq.ROUTER), ctx.socket(zmq.PULL)
+    jobs.bind(worker_addr)
+    results.bind(sink_addr)
+    SleepyWorker.stage_seconds = stage_seconds
+    worker = SleepyWorker(0, args, [worker_addr], sink_addr, -1, 0, 'bench', batch_size, 1, 'tmp')
+    worker.start()
+    worker.is_ready.wait()
+    payload = np.zeros(128, dtype=np.float32)
+    start = time.time()
+    # jobs are sent to the worker as it gives free slots, as the navigator does
+    credits, sent, received = 0, 0, 0
+    poller = zmq.Poller()
+    poller.register(jobs, zmq.POLLIN)
+    poller.register(results, zmq.POLLIN)
+    while received < requests:
+        events = dict(poller.poll())
+        if jobs in events:
+            identity, num_job = recv_credit(jobs)
+            credits += num_job
+        if results in events:
+            recv_from_prev('numpy', results)
+            received += 1
+        while credits and sent < requests:
+            jobs.send(identity, zmq.SNDMORE)
+            send_to_next('numpy', b'bench', str(sent), payload, jobs)
+            credits -= 1
+            sent += 1
+    elapsed = time.time() - start
+    worker.close()
+    jobs.close(linger=0)
+    results.close(linger=0)
+    ctx.term()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=10)
+    parser.add_argument('--stage_ms', type=str, default='3,5,3')
+    args = parser.parse_args()
+    stage_seconds = tuple(float(ms) / 1000 for ms in args.stage_ms.split(','))
+    print('%d requests, batches of %d, preprocess/predict/postprocess %s ms per batch'
+          % (args.requests, args.batch_size, args.stage_ms))
+    print('  %-12s %12s %12s' % ('mode', 'requests/s', 'ms/batch'))
+    port = 17700
+    for name, depth in (('sequential', 0), ('pipeline', 2)):
+        elapsed = run(depth, stage_seconds, args.requests, args.batch_size, port)
+        port += 2
+        print('  %-12s %12.0f %12.2f' % (name, args.requests / elapsed, elapsed / args.requests * args.batch_size * 1e3))
+
+
+if __name__ == '__main__':
+    main()
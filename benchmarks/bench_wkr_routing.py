@@ -0,0 +1,81 @@
+"""
+    Request latency of a WKRServer whose workers do not run at the same speed
+
+    Two workers serve concurrent clients, worker 0 takes --slow_ms and
+    worker 1 --fast_ms to predict a batch, as a model on a busy or smaller
+    GPU would. Reports the share of jobs each worker got and the latency
+    percentiles seen by the clients.
+
+    Usage: python benchmarks/bench_wkr_routing.py [--clients N] [--requests N] [--slow_ms 40] [--fast_ms 5]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server import WKRServer, WKRHardWorker
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server.helper import get_args_parser
+from zaailabcorelib.zserver.zmq.client.wkr_serving.client import WKRClient
+
+
+class UnevenWorker(WKRHardWorker):
+    predict_seconds = (0, 0)
+
+    def predict(self, model, input):
+        time.sleep(self.predict_seconds[self.worker_id])
+        return [{'worker': self.worker_id} for _ in input]
+
+
+def client_loop(port, requests, latencies, workers):
+    with WKRClient(port=port, port_out=port + 1, check_version=False) as client:
+        for i in range(requests):
+            start = time.time()
+            result = client.encode({'i': i})
+            latencies.append(time.time() - start)
+            workers[result['worker']] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--slow_ms', type=float, default=40)
+    parser.add_argument('--fast_ms', type=float, default=5)
+    parser.add_argument('--port', type=int, default=17800)
+    args = parser.parse_args()
+    UnevenWorker.predict_seconds = (args.slow_ms / 1000, args.fast_ms / 1000)
+    server_args = get_args_parser().parse_args(['-model_dir', '/tmp', '-cpu', '-num_worker', '2', '-batch_size', '4',
+                                                '-port', str(args.port), '-port_out', str(args.port + 1)])
+    server = WKRServer(server_args, hardprocesser=UnevenWorker)
+    server.start()
+    server.is_ready.wait()
+
+    latencies, workers = [], Counter()
+    threads = [threading.Thread(target=client_loop, args=(args.port, args.requests, latencies, workers))
+               for _ in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    server.close()
+
+    total = args.clients * args.requests
+    print('%d clients x %d requests, predict %g ms on worker 0, %g ms on worker 1'
+          % (args.clients, args.requests, args.slow_ms, args.fast_ms))
+    print('  jobs on worker 0 / 1: %d / %d' % (workers[0], workers[1]))
+    print('  throughput: %.0f requests/s' % (total / elapsed))
+    print('  latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % tuple(
+        np.percentile(latencies, q) * 1000 for q in (50, 90, 99, 100)))
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
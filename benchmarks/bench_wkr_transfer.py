@@ -0,0 +1,151 @@
+"""
+    Payload bytes copied per request through the wkr_serving ZMQ hops
+
+    A request goes client -> navigator -> worker -> sink -> client over tcp.
+    "copy" is the previous behaviour: every hop receives with copy=True,
+    sends with copy=True and objects are pickled in-band. "zero_copy" sends
+    numpy buffers in place, pickles arrays as out-of-band frames, receives
+    zmq.Frame and forwards them as is.
+
+    Copies are counted from the frames pyzmq copies to or from libzmq and
+    the pickle streams materialized in Python, kernel copies of tcp excluded.
+
+    Usage: python benchmarks/bench_wkr_transfer.py [--rounds N] [--shape 224,224,3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import zmq
+
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server import protocol
+
+
+def nbytes(frame):
+    return len(frame) if isinstance(frame, (bytes, zmq.Frame)) else memoryview(frame).nbytes
+
+
+class CopyCounter(object):
+    """A zmq socket counting the payload bytes copied by pyzmq."""
+
+    def __init__(self, sock, stats):
+        self.sock = sock
+        self.stats = stats
+
+    def send_multipart(self, frames, flags=0, copy=True, track=False):
+        for frame in frames:
+            # pyzmq copies small buffers even with copy=False
+            if not isinstance(frame, zmq.Frame) and (copy or nbytes(frame) < zmq.COPY_THRESHOLD):
+                self.stats['copied'] += nbytes(frame)
+        return self.sock.send_multipart(frames, flags, copy=copy, track=track)
+
+    def recv_multipart(self, flags=0, copy=True, track=False):
+        frames = self.sock.recv_multipart(flags, copy=copy, track=track)
+        if copy:
+            self.stats['copied'] += sum(len(f) for f in frames)
+        return frames
+
+
+class CountingPickle(object):
+    """pickle, counting the bytes of the streams it writes and reads."""
+
+    HIGHEST_PROTOCOL = protocol.pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, stats, pickle):
+        self.stats = stats
+        self.pickle = pickle
+
+    def dumps(self, obj, *args, **kwargs):
+        data = self.pickle.dumps(obj, *args, **kwargs)
+        self.stats['copied'] += len(data)
+        return data
+
+    def loads(self, data, **kwargs):
+        # in-band arrays are copied out of the stream
+        self.stats['copied'] += memoryview(data).nbytes
+        return self.pickle.loads(data, **kwargs)
+
+
+def pipe(ctx, stats, port):
+    push, pull = ctx.socket(zmq.PUSH), ctx.socket(zmq.PULL)
+    pull.bind('tcp://127.0.0.1:%d' % port)
+    push.connect('tcp://127.0.0.1:%d' % port)
+    return CopyCounter(push, stats), CopyCounter(pull, stats)
+
+
+def forward_copy(src, dst):
+    client, req_id, msg, msg_info = src.recv_multipart()
+    protocol.send_to_next_raw(client, req_id, msg, msg_info, dst)
+
+
+def forward_zero_copy(src, dst):
+    client, req_id, msg, msg_info, buffers = protocol.recv_from_prev_frames(src)
+    protocol.send_to_next_raw(client, req_id, msg, msg_info, dst, copy=False, buffers=buffers)
+
+
+def recv_copy(transfer_protocol, src):
+    client, req_id, msg, msg_info = src.recv_multipart()
+    info = protocol.jsonapi.loads(msg_info)
+    if transfer_protocol == 'obj':
+        return protocol.decode_object(msg, info)
+    return protocol.decode_ndarray(msg, info)
+
+
+def run(mode, transfer_protocol, payload, rounds, ctx, port):
+    stats = {'copied': 0}
+    protocol.pickle = CountingPickle(stats, protocol.pickle)
+    try:
+        client_out, nav_in = pipe(ctx, stats, port)
+        nav_out, worker_in = pipe(ctx, stats, port + 1)
+        worker_out, sink_in = pipe(ctx, stats, port + 2)
+        sink_out, client_in = pipe(ctx, stats, port + 3)
+        zero_copy = mode == 'zero_copy'
+        forward = forward_zero_copy if zero_copy else forward_copy
+        start = time.time()
+        for i in range(rounds):
+            protocol.send_to_next(transfer_protocol, b'client', str(i), payload, client_out, zero_copy=zero_copy)
+            forward(nav_in, nav_out)
+            if zero_copy:
+                _, req_id, result, _ = protocol.recv_from_prev(transfer_protocol, worker_in)
+            else:
+                result = recv_copy(transfer_protocol, worker_in)
+            protocol.send_to_next(transfer_protocol, b'client', str(i), result, worker_out, zero_copy=zero_copy)
+            forward(sink_in, sink_out)
+            if zero_copy:
+                _, _, result, _ = protocol.recv_from_prev(transfer_protocol, client_in)
+            else:
+                result = recv_copy(transfer_protocol, client_in)
+        elapsed = time.time() - start
+        for sock in (client_out, nav_in, nav_out, worker_in, worker_out, sink_in, sink_out, client_in):
+            sock.sock.close(linger=0)
+    finally:
+        protocol.pickle = protocol.pickle.pickle
+    return stats['copied'] / rounds, elapsed / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--shape', type=str, default='224,224,3')
+    args = parser.parse_args()
+    shape = tuple(int(d) for d in args.shape.split(','))
+    array = np.random.rand(*shape).astype(np.float32)
+    payloads = {'numpy': array, 'obj': {'image': array, 'request': 'detect', 'threshold': 0.5}}
+    ctx = zmq.Context()
+    print('%s float32 payload, %d bytes, %d rounds, 4 hops' % (shape, array.nbytes, args.rounds))
+    print('  %-8s %-10s %18s %12s' % ('protocol', 'mode', 'copied bytes/req', 'ms/req'))
+    port = 17600
+    for transfer_protocol in ('numpy', 'obj'):
+        for mode in ('copy', 'zero_copy'):
+            copied, seconds = run(mode, transfer_protocol, payloads[transfer_protocol], args.rounds, ctx, port)
+            port += 4
+            print('  %-8s %-10s %18d %12.3f' % (transfer_protocol, mode, copied, seconds * 1e3))
+    ctx.term()
+
+
+if __name__ == '__main__':
+    main()
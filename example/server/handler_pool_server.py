@@ -87,7 +87,7 @@ if __name__ == "__main__":
                               lsocket=lsocket,
                               inputProtocolFactory=pfactory,
                               outputProtocolFactory=pfactory,
-                              batch_timeout=0.05,
+                              batch_timeout=5000,
                               n_handlers=1
                               )
     server.serve()
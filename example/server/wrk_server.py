@@ -88,7 +88,7 @@ if __name__ == "__main__":
                         lsocket=lsocket,
                         transport_factory=tfactory,
                         protocol_factory=pfactory, 
-                        batch_group_timeout=1,
+                        batch_group_timeout=1000,
                         n_handlers=4
                         )
     server.serve()
@@ -0,0 +1,218 @@
+import asyncio
+import struct
+
+import pytest
+
+from zaailabcorelib.thrift.Thrift import TMessageType
+from zaailabcorelib.thrift.transport import TTransport
+from zaailabcorelib.thriftpool.aio import AsyncClient, AsyncConnection, AsyncConnectionPool
+from zaailabcorelib.thriftpool.retry import ExponentialBackoff
+
+
+class Echo(object):
+    """Thrift client of a service echoing its string argument."""
+
+    def __init__(self, iprot, oprot=None):
+        self._iprot = iprot
+        self._oprot = oprot if oprot is not None else iprot
+        self._seqid = 0
+
+    def echo(self, data):
+        self.send_echo(data)
+        return self.recv_echo()
+
+    def send_echo(self, data):
+        self._oprot.writeMessageBegin('echo', TMessageType.CALL, self._seqid)
+        self._oprot.writeBinary(data)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+
+    def recv_echo(self):
+        self._iprot.readMessageBegin()
+        data = self._iprot.readBinary()
+        self._iprot.readMessageEnd()
+        return data
+
+
+async def echo_frames(reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(4)
+            frame = await reader.readexactly(struct.unpack('!i', header)[0])
+            writer.write(header + frame)
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+async def echo_slow_frames_last(reader, writer):
+    async def answer(header, frame):
+        if b'slow' in frame:
+            await asyncio.sleep(0.2)
+        writer.write(header + frame)
+
+    try:
+        while True:
+            header = await reader.readexactly(4)
+            frame = await reader.readexactly(struct.unpack('!i', header)[0])
+            asyncio.ensure_future(answer(header, frame))
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+async def never_answer(reader, writer):
+    await reader.read()
+    writer.close()
+
+
+async def close_on_request(reader, writer):
+    await reader.readexactly(4)
+    writer.close()
+
+
+async def start_server(handler=echo_frames):
+    server = await asyncio.start_server(handler, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def failing_connections(pool, failures):
+    """Makes the first `failures` connects of `pool` fail."""
+    get_connection = pool.get_connection
+    calls = []
+
+    async def flaky():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise TTransport.TTransportException(TTransport.TTransportException.NOT_OPEN, 'refused')
+        return await get_connection()
+
+    pool.get_connection = flaky
+    return calls
+
+
+def test_concurrent_calls():
+    async def main():
+        server, port = await start_server()
+        client = AsyncClient(Echo, '127.0.0.1', port, pool_size=2, timeout=5)
+        try:
+            data = [b'x%d' % idx for idx in range(200)]
+            assert await asyncio.gather(*[client.echo(d) for d in data]) == data
+        finally:
+            client.close()
+            server.close()
+    asyncio.run(main())
+
+
+def test_answers_are_matched_by_seqid():
+    async def main():
+        server, port = await start_server(echo_slow_frames_last)
+        client = AsyncClient(Echo, '127.0.0.1', port, pool_size=1, timeout=5)
+        answered = []
+
+        async def echo(data):
+            answered.append(await client.echo(data))
+            return answered[-1]
+
+        try:
+            assert await asyncio.gather(echo(b'slow'), echo(b'fast')) == [b'slow', b'fast']
+            assert answered == [b'fast', b'slow']
+        finally:
+            client.close()
+            server.close()
+    asyncio.run(main())
+
+
+def test_timeout():
+    async def main():
+        server, port = await start_server(never_answer)
+        client = AsyncClient(Echo, '127.0.0.1', port, timeout=0.1)
+        try:
+            with pytest.raises(TTransport.TTransportException) as excinfo:
+                await client.echo(b'abc')
+            assert excinfo.value.type == TTransport.TTransportException.TIMED_OUT
+        finally:
+            client.close()
+            server.close()
+    asyncio.run(main())
+
+
+def test_lost_connection_fails_the_call():
+    async def main():
+        server, port = await start_server(close_on_request)
+        client = AsyncClient(Echo, '127.0.0.1', port, retries=0, timeout=5)
+        try:
+            with pytest.raises(TTransport.TTransportException):
+                await client.echo(b'abc')
+        finally:
+            client.close()
+            server.close()
+    asyncio.run(main())
+
+
+def test_connect_failure_is_retried():
+    async def main():
+        server, port = await start_server()
+        client = AsyncClient(Echo, '127.0.0.1', port, retries=2, timeout=5,
+                             backoff=ExponentialBackoff(base=0.01))
+        calls = failing_connections(client._connection_pool, 2)
+        try:
+            assert await client.echo(b'abc') == b'abc'
+            assert len(calls) == 3
+        finally:
+            client.close()
+            server.close()
+    asyncio.run(main())
+
+
+def test_connect_failure_after_retries():
+    async def main():
+        client = AsyncClient(Echo, '127.0.0.1', 1, retries=1, timeout=5, backoff=None)
+        calls = failing_connections(client._connection_pool, 5)
+        try:
+            with pytest.raises(TTransport.TTransportException):
+                await client.echo(b'abc')
+            assert len(calls) == 2
+        finally:
+            client.close()
+    asyncio.run(main())
+
+
+def test_no_backoff_by_default():
+    client = AsyncClient(Echo, '127.0.0.1', 1)
+    assert client.backoff is None
+    assert isinstance(AsyncClient(Echo, '127.0.0.1', 1, backoff=True).backoff, ExponentialBackoff)
+
+
+def test_close_cancels_pending_connect(monkeypatch):
+    async def main():
+        started = asyncio.Event()
+
+        async def hanging_open(cls, host, port, timeout=None):
+            started.set()
+            await asyncio.sleep(60)
+
+        monkeypatch.setattr(AsyncConnection, 'open', classmethod(hanging_open))
+        pool = AsyncConnectionPool('127.0.0.1', 1)
+        getting = asyncio.ensure_future(pool.get_connection())
+        await started.wait()
+        pool.close()
+        with pytest.raises(RuntimeError):
+            await getting
+        assert pool._connecting is None
+    asyncio.run(main())
+
+
+def test_connection_opened_after_close_is_closed():
+    async def main():
+        server, port = await start_server()
+        pool = AsyncConnectionPool('127.0.0.1', port)
+        getting = asyncio.ensure_future(pool.get_connection())
+        # the connect completes, its caller did not resume yet
+        while pool._connecting is None or not pool._connecting.done():
+            await asyncio.sleep(0)
+        connection = pool._connecting.result()
+        pool.close()
+        with pytest.raises(RuntimeError):
+            await getting
+        assert connection.closed
+        server.close()
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+from multiprocessing import Queue
+
+import pytest
+
+from zaailabcorelib.zserver.thrift_server.TMultiPoolServer import THandlerBase, TModelBase
+from zaailabcorelib.zserver.thrift_server.TWkrServer import TModelBase as TWkrModelBase
+from zaailabcorelib.zserver.thrift_server.batcher import DynamicBatcher
+from zaailabcorelib.zserver.thrift_server.dispatcher import ResultDispatcher
+
+
+def request(inp, deadline=None, route=0):
+    return [route, inp, inp, time.time(), deadline]
+
+
+def make_batcher(items, **kwargs):
+    inference_queue = queue.Queue()
+    for item in items:
+        inference_queue.put(item)
+    return inference_queue, DynamicBatcher(inference_queue, **kwargs)
+
+
+def test_batches_up_to_max_batch_size():
+    _, batcher = make_batcher([request(idx) for idx in range(5)], max_batch_size=3, max_wait=0.05)
+    assert batcher.next_batch() == ([0, 0, 0], [0, 1, 2], [0, 1, 2])
+    assert batcher.next_batch() == ([0, 0], [3, 4], [3, 4])
+    assert batcher.stats()['batch_size']['buckets'] == {1: 0, 2: 1, 3: 2, float('inf'): 2}
+
+
+def test_waits_for_the_first_request():
+    inference_queue, batcher = make_batcher([], max_batch_size=4, max_wait=0)
+    timer = threading.Timer(0.1, inference_queue.put, args=(request('late'),))
+    timer.start()
+    assert batcher.next_batch()[2] == ['late']
+
+
+def test_max_wait_counts_from_the_first_request():
+    inference_queue, batcher = make_batcher([request(0)], max_batch_size=4, max_wait=0.2)
+    threading.Timer(0.05, inference_queue.put, args=(request(1),)).start()
+    started = time.time()
+    assert batcher.next_batch()[2] == [0, 1]
+    assert 0.15 < time.time() - started < 1
+
+
+def test_expired_requests_are_dropped():
+    past = time.time() - 1
+    _, batcher = make_batcher([request(0, past), request(1), request(2, past)], max_batch_size=4, max_wait=0.01)
+    assert batcher.next_batch()[2] == [1]
+    assert batcher.stats()['num_expired'] == 2
+
+
+def test_deadline_cuts_the_wait():
+    _, batcher = make_batcher([request(0, time.time() + 0.05)], max_batch_size=4, max_wait=10)
+    started = time.time()
+    assert batcher.next_batch()[2] == [0]
+    assert time.time() - started < 1
+
+
+def test_queue_wait_is_observed():
+    item = request(0)
+    item[3] -= 0.3
+    _, batcher = make_batcher([item], max_batch_size=1)
+    batcher.next_batch()
+    queue_wait = batcher.stats()['queue_wait']
+    assert queue_wait['count'] == 1 and queue_wait['sum'] >= 0.3
+
+
+class Model(TModelBase):
+    def model_init(self, model_config):
+        return None
+
+    def predict(self, list_input):
+        return [inp + 1 for inp in list_input]
+
+
+class WkrModel(TWkrModelBase):
+    def model_init(self, model_config):
+        return None
+
+    def predict(self, list_input):
+        return [inp + 1 for inp in list_input]
+
+
+class Handler(THandlerBase):
+    def process_input(self, input):
+        return input
+
+
+@pytest.mark.parametrize('model_cls,timeout_arg', [(Model, 'batch_timeout'), (WkrModel, 'batch_group_timeout')])
+def test_model_batches_concurrent_requests(model_cls, timeout_arg):
+    inference_queue, result_queue = Queue(), Queue()
+    # waits up to 50ms for a batch of 8
+    model = model_cls(inference_queue, [result_queue], {}, 8, **{timeout_arg: 50000})
+    model.daemon = True
+    model.start()
+    dispatcher = ResultDispatcher(result_queue)
+    dispatcher.start()
+    handler = Handler(inference_queue, dispatcher)
+    results = [None] * 16
+
+    def send(idx):
+        results[idx] = handler.send_to_model(idx, timeout=5)
+
+    threads = [threading.Thread(target=send, args=(idx,)) for idx in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == [idx + 1 for idx in range(16)]
+    batch_size = model.stats()['batch_size']
+    assert batch_size['sum'] == 16 and batch_size['count'] < 16
+    dispatcher.close()
+    dispatcher.join(5)
+    model.terminate()
+    model.join(5)
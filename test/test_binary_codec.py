@@ -0,0 +1,123 @@
+import struct
+
+import pytest
+
+from zaailabcorelib.thrift.protocol.TProtocol import TType, TProtocolException
+from zaailabcorelib.thrift.protocol.TBase import TBase
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from zaailabcorelib.thrift.transport.TTransport import TMemoryBuffer
+
+
+class Box(TBase):
+    __slots__ = ('label', 'score', 'coords')
+
+    def __init__(self, label=None, score=None, coords=None):
+        self.label = label
+        self.score = score
+        self.coords = coords
+
+
+Box.thrift_spec = (
+    None,
+    (1, TType.STRING, 'label', 'UTF8', None, ),
+    (2, TType.DOUBLE, 'score', None, None, ),
+    (3, TType.LIST, 'coords', (TType.I32, None, False), None, ),
+)
+
+
+class Prediction(TBase):
+    __slots__ = ('request_id', 'boxes', 'embedding', 'tags', 'payload', 'flags')
+
+    def __init__(self, request_id=None, boxes=None, embedding=None, tags=None, payload=None, flags=None):
+        self.request_id = request_id
+        self.boxes = boxes
+        self.embedding = embedding
+        self.tags = tags
+        self.payload = payload
+        self.flags = flags
+
+
+Prediction.thrift_spec = (
+    None,
+    (1, TType.I64, 'request_id', None, None, ),
+    (2, TType.LIST, 'boxes', (TType.STRUCT, [Box, Box.thrift_spec], False), None, ),
+    (3, TType.LIST, 'embedding', (TType.DOUBLE, None, False), None, ),
+    (4, TType.MAP, 'tags', (TType.STRING, 'UTF8', TType.I32, None, False), None, ),
+    (5, TType.STRING, 'payload', 'BINARY', None, ),
+    (6, TType.SET, 'flags', (TType.STRING, 'UTF8', False), None, ),
+)
+
+
+class Empty(TBase):
+    __slots__ = ()
+
+
+Empty.thrift_spec = (None, )
+
+
+def prediction():
+    return Prediction(request_id=123456789012,
+                      boxes=[Box(label=u'objé%d' % i, score=i / 8.0, coords=[i, -i, 2 ** 31 - 1])
+                             for i in range(5)],
+                      embedding=[i / 16.0 for i in range(16)],
+                      tags={'a': 1, 'b': -2},
+                      payload=b'\x00\xff' * 10,
+                      flags={'x', 'y'})
+
+
+def encode(protocol_cls, obj):
+    trans = TMemoryBuffer()
+    obj.write(protocol_cls(trans))
+    return trans.getvalue()
+
+
+def decode(protocol_cls, cls, data):
+    obj = cls()
+    obj.read(protocol_cls(TMemoryBuffer(data)))
+    return obj
+
+
+def test_same_bytes_as_generic_protocol():
+    obj = prediction()
+    assert encode(TBinaryProtocolAccelerated, obj) == encode(TBinaryProtocol, obj)
+
+
+def test_round_trip():
+    obj = prediction()
+    data = encode(TBinaryProtocolAccelerated, obj)
+    assert decode(TBinaryProtocolAccelerated, Prediction, data) == obj
+    assert decode(TBinaryProtocol, Prediction, data) == obj
+
+
+def test_unknown_fields_are_skipped():
+    data = encode(TBinaryProtocolAccelerated, prediction())
+    assert decode(TBinaryProtocolAccelerated, Empty, data) == Empty()
+
+
+@pytest.mark.parametrize('size', [0, 1, 10, 50])
+def test_truncated_input(size):
+    data = encode(TBinaryProtocolAccelerated, prediction())[:size]
+    with pytest.raises(EOFError):
+        decode(TBinaryProtocolAccelerated, Prediction, data)
+
+
+@pytest.mark.parametrize('ttype, value', [
+    (TType.STRING, struct.pack('!i', -7)),
+    (TType.LIST, struct.pack('!bi', TType.STRING, -1)),
+    (TType.LIST, struct.pack('!bi', TType.I32, -1)),
+    (TType.SET, struct.pack('!bi', TType.STRING, -1)),
+    (TType.MAP, struct.pack('!bbi', TType.STRING, TType.I32, -1)),
+])
+def test_negative_size_of_skipped_field(ttype, value):
+    # used to move back and loop forever
+    data = struct.pack('!bh', ttype, 9) + value + b'\x00'
+    with pytest.raises(TProtocolException) as e:
+        decode(TBinaryProtocolAccelerated, Empty, data)
+    assert e.value.type == TProtocolException.NEGATIVE_SIZE
+
+
+def test_negative_size_of_read_field():
+    data = struct.pack('!bh', TType.STRING, 5) + struct.pack('!i', -7) + b'\x00'
+    with pytest.raises(TProtocolException) as e:
+        decode(TBinaryProtocolAccelerated, Prediction, data)
+    assert e.value.type == TProtocolException.NEGATIVE_SIZE
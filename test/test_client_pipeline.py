@@ -0,0 +1,105 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from zaailabcorelib.thrift.Thrift import TMessageType
+from zaailabcorelib.thriftpool.client import Client
+
+
+class Echo(object):
+    """Thrift client of a service echoing its string argument."""
+
+    def __init__(self, iprot, oprot=None):
+        self._iprot = iprot
+        self._oprot = oprot if oprot is not None else iprot
+        self._seqid = 0
+
+    def echo(self, data):
+        self.send_echo(data)
+        return self.recv_echo()
+
+    def send_echo(self, data):
+        self._oprot.writeMessageBegin('echo', TMessageType.CALL, self._seqid)
+        self._oprot.writeBinary(data)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+
+    def recv_echo(self):
+        self._iprot.readMessageBegin()
+        data = self._iprot.readBinary()
+        self._iprot.readMessageEnd()
+        return data
+
+
+def read_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def serve_in_order(listener):
+    """Answers the frames of each connection one at a time, like a server
+    with a pipeline depth of 1: the next request is read once the answer
+    is written."""
+    def serve(conn):
+        with conn:
+            try:
+                while True:
+                    header = read_exactly(conn, 4)
+                    frame = read_exactly(conn, struct.unpack('!i', header)[0])
+                    conn.sendall(header + frame)
+            except (EOFError, OSError):
+                pass
+
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+@pytest.fixture
+def port():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    threading.Thread(target=serve_in_order, args=(listener,), daemon=True).start()
+    yield listener.getsockname()[1]
+    listener.close()
+
+
+def test_map_small_requests(port):
+    client = Client(Echo, '127.0.0.1', port, retries=0, network_timeout=10000)
+    try:
+        args = [(b'%d' % i,) for i in range(500)]
+        assert client.map('echo', args, concurrency=2) == [a[0] for a in args]
+    finally:
+        client.close()
+
+
+def test_map_large_requests_do_not_deadlock(port):
+    # 64 requests of 1MB in flight fill the socket buffers of both ends
+    client = Client(Echo, '127.0.0.1', port, retries=0, network_timeout=10000)
+    try:
+        args = [(bytes([i]) * (1 << 20),) for i in range(64)]
+        assert client.map('echo', args, concurrency=1, window=64) == [a[0] for a in args]
+    finally:
+        client.close()
+
+
+def test_batch(port):
+    client = Client(Echo, '127.0.0.1', port, retries=0, network_timeout=10000)
+    try:
+        batch = client.batch()
+        batch.echo(b'a')
+        batch.echo(b'b')
+        assert batch.execute() == [b'a', b'b']
+    finally:
+        client.close()
@@ -0,0 +1,170 @@
+import threading
+import time
+
+import pytest
+
+from zaailabcorelib.thrift.Thrift import TApplicationException, TMessageType
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
+from zaailabcorelib.thrift.transport import TSocket
+from zaailabcorelib.thriftpool.cluster import HEDGE_MIN_SAMPLES, ClusterClient
+from zaailabcorelib.zserver.thrift.TModelPoolServer import TModelPoolServer
+
+
+class Echo(object):
+    """Thrift client of a service echoing its string argument."""
+
+    def __init__(self, iprot, oprot=None):
+        self._iprot = iprot
+        self._oprot = oprot if oprot is not None else iprot
+        self._seqid = 0
+
+    def echo(self, data):
+        self.send_echo(data)
+        return self.recv_echo()
+
+    def send_echo(self, data):
+        self._oprot.writeMessageBegin('echo', TMessageType.CALL, self._seqid)
+        self._oprot.writeBinary(data)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+
+    def recv_echo(self):
+        _, mtype, _ = self._iprot.readMessageBegin()
+        if mtype == TMessageType.EXCEPTION:
+            x = TApplicationException()
+            x.read(self._iprot)
+            self._iprot.readMessageEnd()
+            raise x
+        data = self._iprot.readBinary()
+        self._iprot.readMessageEnd()
+        return data
+
+
+class Processor(object):
+    """Shape of a generated thrift Processor of the echo service."""
+
+    def __init__(self, handler):
+        self._handler = handler
+
+    def process(self, iprot, oprot):
+        name, _, seqid = iprot.readMessageBegin()
+        data = iprot.readBinary()
+        iprot.readMessageEnd()
+        try:
+            result = self._handler.echo(data)
+        except ValueError as e:
+            oprot.writeMessageBegin(name, TMessageType.EXCEPTION, seqid)
+            TApplicationException(TApplicationException.INTERNAL_ERROR, str(e)).write(oprot)
+        else:
+            oprot.writeMessageBegin(name, TMessageType.REPLY, seqid)
+            oprot.writeBinary(result)
+        oprot.writeMessageEnd()
+
+    def process_echo(self, seqid, iprot, oprot):
+        pass
+
+
+class Handler(object):
+    """Echoes with its name appended, `delays` and `errors` by argument."""
+
+    def __init__(self, name, delays=None, errors=()):
+        self.name = name
+        self.delays = delays or {}
+        self.errors = errors
+
+    def echo(self, data):
+        time.sleep(self.delays.get(data, 0))
+        if data in self.errors:
+            raise ValueError('failed %r' % data)
+        return data + self.name
+
+
+class Servers(object):
+    def __init__(self):
+        self.servers = []
+
+    def start(self, **config):
+        server = TModelPoolServer(Handler, Processor, TSocket.TServerSocket(host='127.0.0.1', port=0),
+                                  TBinaryProtocolFactory(), worker_type='thread',
+                                  list_model_config=[config, config])
+        server.prepare()
+        server.thread = threading.Thread(target=server.serve, daemon=True)
+        server.thread.start()
+        self.servers.append(server)
+        return '127.0.0.1:%d' % server.tsocket.handle.getsockname()[1]
+
+    def stop(self, idx):
+        server = self.servers[idx]
+        server.shutdown(0)
+        server.thread.join(5)
+
+
+@pytest.fixture
+def servers():
+    servers = Servers()
+    yield servers
+    for idx in range(len(servers.servers)):
+        servers.stop(idx)
+
+
+def warm_up(client):
+    for _ in range(HEDGE_MIN_SAMPLES):
+        client.echo(b'x')
+
+
+def test_calls_spread_over_endpoints(servers):
+    client = ClusterClient(Echo, [servers.start(name=b'a'), servers.start(name=b'b')],
+                           policy='round_robin', network_timeout=5000)
+    assert {client.echo(b'x') for _ in range(4)} == {b'xa', b'xb'}
+    client.close()
+
+
+def test_failover(servers):
+    client = ClusterClient(Echo, [servers.start(name=b'a'), servers.start(name=b'b')],
+                           policy='round_robin', network_timeout=5000, eject_after=1)
+    assert {client.echo(b'x') for _ in range(4)} == {b'xa', b'xb'}
+    servers.stop(0)
+    assert [client.echo(b'x') for _ in range(4)] == [b'xb'] * 4
+    stats = client.stats()['endpoints']
+    assert stats[0]['ejected'] and not stats[1]['ejected']
+    client.close()
+
+
+def test_application_error_is_not_retried(servers):
+    client = ClusterClient(Echo, [servers.start(name=b'a', errors=(b'bad',)), servers.start(name=b'b')],
+                           policy='round_robin', network_timeout=5000)
+    errors = 0
+    for _ in range(2):
+        try:
+            client.echo(b'bad')
+        except TApplicationException:
+            errors += 1
+    assert errors == 1
+    assert not any(endpoint['ejected'] for endpoint in client.stats()['endpoints'])
+    client.close()
+
+
+def test_hedging_answers_from_the_fast_endpoint(servers):
+    client = ClusterClient(Echo, [servers.start(name=b'a', delays={b'slow': 0.8}), servers.start(name=b'b')],
+                           policy='round_robin', network_timeout=5000, hedge_percentile=0.9)
+    warm_up(client)
+    assert client.stats()['hedged'] == 0
+    for _ in range(2):
+        started = time.time()
+        assert client.echo(b'slow') == b'slowb'
+        assert time.time() - started < 0.5
+    assert client.stats()['hedged'] >= 1
+    client.close()
+
+
+def test_hedging_returns_first_application_error(servers):
+    client = ClusterClient(Echo, [servers.start(name=b'a', delays={b'bad': 0.2}, errors=(b'bad',)),
+                                  servers.start(name=b'b', delays={b'bad': 0.8})],
+                           policy='round_robin', network_timeout=5000, hedge_percentile=0.9)
+    warm_up(client)
+    for _ in range(2):
+        started = time.time()
+        with pytest.raises(TApplicationException):
+            client.echo(b'bad')
+        assert time.time() - started < 0.5
+    client.close()
@@ -0,0 +1,65 @@
+import collections
+
+import pytest
+
+from zaailabcorelib.zdispatch.dispatch_policy import (DispatchPolicy, LeastOutstandingPolicy, PowerOfTwoChoicesPolicy,
+                                                     RoundRobinPolicy, WorkerLoad, get_dispatch_policy)
+
+
+def test_worker_load():
+    load = WorkerLoad(2, decay=0.5)
+    for _ in range(3):
+        load.on_dispatch(0)
+    load.on_complete(0, 1.0)
+    load.on_complete(0, 3.0)
+    load.on_drop(0)
+    stats = load.stats()
+    assert stats[0] == {'in_flight': 0, 'dispatched': 3, 'completed': 2, 'dropped': 1, 'ewma_latency': 2.0}
+    assert stats[1]['dispatched'] == 0
+
+
+def test_round_robin():
+    policy = RoundRobinPolicy()
+    load = WorkerLoad(3)
+    assert [policy.choose(load) for _ in range(6)] == [0, 1, 2, 0, 1, 2]
+
+
+def test_least_outstanding():
+    policy = LeastOutstandingPolicy()
+    load = WorkerLoad(3)
+    load.in_flight[:] = [2, 0, 1]
+    assert policy.choose(load) == 1
+    # idle workers share the load
+    load.in_flight[:] = [0, 0, 0]
+    assert {policy.choose(load) for _ in range(3)} == {0, 1, 2}
+
+
+@pytest.mark.parametrize('metric', ['depth', 'ewma'])
+def test_power_of_two_choices_avoids_loaded_worker(metric):
+    policy = PowerOfTwoChoicesPolicy(metric)
+    load = WorkerLoad(2)
+    load.in_flight[:] = [5, 0]
+    load.ewma_latency[:] = [1.0, 1.0]
+    assert all(policy.choose(load) == 1 for _ in range(20))
+
+
+def test_power_of_two_choices_spreads_load():
+    policy = PowerOfTwoChoicesPolicy()
+    load = WorkerLoad(4)
+    counts = collections.Counter(policy.choose(load) for _ in range(400))
+    assert set(counts) == {0, 1, 2, 3}
+
+
+def test_single_worker():
+    load = WorkerLoad(1)
+    for name in ['random', 'round_robin', 'least_outstanding', 'p2c', 'p2c_ewma']:
+        assert get_dispatch_policy(name).choose(load) == 0
+
+
+def test_get_dispatch_policy():
+    policy = LeastOutstandingPolicy()
+    assert get_dispatch_policy(policy) is policy
+    assert isinstance(get_dispatch_policy('p2c_ewma'), PowerOfTwoChoicesPolicy)
+    assert isinstance(get_dispatch_policy('round_robin'), DispatchPolicy)
+    with pytest.raises(ValueError):
+        get_dispatch_policy('fastest')
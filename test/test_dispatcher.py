@@ -0,0 +1,159 @@
+import concurrent.futures
+import queue
+import threading
+import time
+from multiprocessing import Queue
+
+import pytest
+
+from zaailabcorelib.zserver.thrift_server.TMultiPoolServer import THandlerBase, TModelBase
+from zaailabcorelib.zserver.thrift_server.dispatcher import ResultDispatcher
+
+
+class Model(TModelBase):
+    def model_init(self, model_config):
+        return model_config['scale']
+
+    def predict(self, list_input):
+        if 'fail' in list_input:
+            raise ValueError('cannot predict')
+        if 'slow' in list_input:
+            time.sleep(0.5)
+        return [inp * self.model for inp in list_input]
+
+
+class Handler(THandlerBase):
+    def process_input(self, input):
+        return input
+
+
+@pytest.fixture
+def model_pool():
+    """A model process and the dispatchers of two handler routes."""
+    inference_queue = Queue()
+    result_queues = [Queue(), Queue()]
+    model = Model(inference_queue, result_queues, {'scale': 2}, batch_infer_size=4)
+    model.daemon = True
+    model.start()
+    dispatchers = [ResultDispatcher(result_queue, route=route)
+                   for route, result_queue in enumerate(result_queues)]
+    for dispatcher in dispatchers:
+        dispatcher.start()
+    yield inference_queue, dispatchers
+    for dispatcher in dispatchers:
+        dispatcher.close()
+        dispatcher.join(5)
+    model.terminate()
+    model.join(5)
+
+
+def test_results_resolve_their_futures():
+    results = queue.Queue()
+    dispatcher = ResultDispatcher(results)
+    dispatcher.start()
+    (first_id, first), (second_id, second) = dispatcher.register(), dispatcher.register()
+    # a batch answers in any order, unknown requests are dropped
+    results.put([(second_id, 'b', None), ((1, 99), 'c', None), (first_id, None, ValueError('failed'))])
+    assert second.result(5) == 'b'
+    with pytest.raises(ValueError):
+        first.result(5)
+    dispatcher.close()
+    dispatcher.join(5)
+    assert not dispatcher.is_alive()
+
+
+def test_request_ids_never_collide():
+    dispatchers = [ResultDispatcher(queue.Queue(), route=route) for route in range(2)]
+    ids = []
+
+    def register(dispatcher):
+        ids.extend(dispatcher.register()[0] for _ in range(1000))
+
+    threads = [threading.Thread(target=register, args=(dispatchers[idx % 2],)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 8000
+    assert sum(dispatcher.num_pending for dispatcher in dispatchers) == 8000
+
+
+def test_discarded_request_is_forgotten():
+    dispatcher = ResultDispatcher(queue.Queue())
+    request_id, future = dispatcher.register()
+    dispatcher.discard(request_id)
+    assert dispatcher.num_pending == 0
+
+
+def test_send_to_model(model_pool):
+    inference_queue, dispatchers = model_pool
+    handler = Handler(inference_queue, dispatchers[0])
+    assert [handler.send_to_model(idx) for idx in range(5)] == [0, 2, 4, 6, 8]
+
+
+def test_results_go_back_to_their_route(model_pool):
+    inference_queue, dispatchers = model_pool
+    results = {}
+
+    def send(route):
+        handler = Handler(inference_queue, dispatchers[route])
+        results[route] = [handler.send_to_model(route * 100 + idx) for idx in range(50)]
+
+    threads = [threading.Thread(target=send, args=(route,)) for route in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == {route: [2 * (route * 100 + idx) for idx in range(50)] for route in range(2)}
+
+
+def test_concurrent_handlers_of_a_route(model_pool):
+    inference_queue, dispatchers = model_pool
+    results = {}
+
+    def send(thread_id):
+        handler = Handler(inference_queue, dispatchers[0])
+        results[thread_id] = [handler.send_to_model(thread_id * 100 + idx) for idx in range(50)]
+
+    threads = [threading.Thread(target=send, args=(thread_id,)) for thread_id in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == {thread_id: [2 * (thread_id * 100 + idx) for idx in range(50)] for thread_id in range(8)}
+    assert dispatchers[0].num_pending == 0
+
+
+def test_timeout(model_pool):
+    inference_queue, dispatchers = model_pool
+    handler = Handler(inference_queue, dispatchers[0])
+    with pytest.raises(concurrent.futures.TimeoutError):
+        handler.send_to_model('slow', timeout=0.1)
+    assert dispatchers[0].num_pending == 0
+    # the late result is dropped
+    assert handler.send_to_model(1, timeout=5) == 2
+
+
+def test_model_error_is_raised_by_the_handler(model_pool):
+    inference_queue, dispatchers = model_pool
+    handler = Handler(inference_queue, dispatchers[0])
+    with pytest.raises(RuntimeError):
+        handler.send_to_model('fail')
+    assert handler.send_to_model(1) == 2
+
+
+def test_late_results_of_discarded_requests_are_released():
+    results = queue.Queue()
+    released = []
+    dispatcher = ResultDispatcher(results, release=released.append)
+    dispatcher.start()
+    discarded, _ = dispatcher.register()
+    dispatcher.discard(discarded)
+    cancelled, future = dispatcher.register()
+    future.cancel()
+    failed, _ = dispatcher.register()
+    dispatcher.discard(failed)
+    results.put([(discarded, 'late', None), (cancelled, 'cancelled', None), (failed, None, ValueError())])
+    dispatcher.close()
+    dispatcher.join(5)
+    assert released == ['late', 'cancelled']
@@ -0,0 +1,116 @@
+import io
+import queue
+from urllib.request import urlopen
+
+import pytest
+
+from zaailabcorelib.thrift.Thrift import TMessageType
+from zaailabcorelib.thrift.protocol import TBinaryProtocol
+from zaailabcorelib.thrift.transport import TTransport
+from zaailabcorelib.zserver.metrics import Counter, Gauge, Histogram, Registry, ServerMetrics, processor_methods
+from zaailabcorelib.zserver.nonblocking import Message
+
+
+class Processor(object):
+    """Shape of a generated thrift Processor."""
+
+    def process(self, iprot, oprot):
+        pass
+
+    def process_ping(self, seqid, iprot, oprot):
+        pass
+
+    def process_predict(self, seqid, iprot, oprot):
+        pass
+
+
+def request(name):
+    trans = TTransport.TMemoryBuffer()
+    oprot = TBinaryProtocol.TBinaryProtocol(trans)
+    oprot.writeMessageBegin(name, TMessageType.CALL, 0)
+    oprot.writeMessageEnd()
+    data = trans.getvalue()
+    return Message(io.BytesIO(data), len(data))
+
+
+def requests_by_method(metrics):
+    return {values[0]: counter.value for values, counter in metrics.requests.items()}
+
+
+def test_counter_and_gauge():
+    counter = Counter()
+    counter.inc()
+    counter.inc(2)
+    assert counter.value == 3
+    gauge = Gauge()
+    gauge.set(5)
+    gauge.dec(2)
+    assert gauge.value == 3
+    gauge.set_function(lambda: 7)
+    assert gauge.value == 7
+
+
+def test_histogram():
+    hist = Histogram(buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 3, 10):
+        hist.observe(value)
+    assert hist.count == 4
+    assert hist.sum == 15
+    assert hist.snapshot()['buckets'] == {1: 1, 2: 2, 4: 3, float('inf'): 4}
+    assert hist.quantile(0.5) == pytest.approx(2)
+    assert hist.quantile(1) == 4
+    assert Histogram().quantile(0.5) is None
+
+
+def test_render():
+    registry = Registry()
+    registry.counter('calls_total', 'Calls.', ('method',)).labels('a"b').inc()
+    registry.histogram('latency_seconds', 'Latency.', buckets=(1,)).labels().observe(0.5)
+    lines = registry.render().splitlines()
+    assert '# TYPE calls_total counter' in lines
+    assert 'calls_total{method="a\\"b"} 1.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1.0' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 1.0' in lines
+    assert 'latency_seconds_count 1.0' in lines
+    with pytest.raises(ValueError):
+        registry.counter('calls_total', 'Calls.')
+
+
+def test_serve_http():
+    metrics = ServerMetrics()
+    waiting = queue.Queue()
+    waiting.put(1)
+    metrics.watch_queue('inference', waiting)
+    metrics.read_latency.observe(0.01)
+    server = metrics.serve_http(0, '127.0.0.1')
+    try:
+        with urlopen('http://127.0.0.1:%d/metrics' % server.port, timeout=5) as response:
+            lines = response.read().decode('utf-8').splitlines()
+    finally:
+        metrics.close()
+    assert 'zserver_queue_depth{queue="inference"} 1.0' in lines
+    assert 'zserver_read_seconds_count 1.0' in lines
+
+
+def test_processor_methods():
+    assert processor_methods(Processor) == {'ping', 'predict'}
+
+
+def test_count_request_known_method():
+    metrics = ServerMetrics()
+    msg = request('ping')
+    metrics.count_request(TBinaryProtocol.TBinaryProtocolFactory(), TTransport.TMemoryBuffer, msg,
+                          processor_methods(Processor))
+    assert requests_by_method(metrics) == {'ping': 1}
+    # the frame is left unread for the processor
+    assert msg.buffer.tell() == 0
+
+
+def test_count_request_bounds_method_names():
+    metrics = ServerMetrics()
+    methods = processor_methods(Processor)
+    factory = TBinaryProtocol.TBinaryProtocolFactory()
+    for idx in range(100):
+        metrics.count_request(factory, TTransport.TMemoryBuffer, request('method%d' % idx), methods)
+    metrics.count_request(factory, TTransport.TMemoryBuffer, Message(io.BytesIO(b'\x00'), 1), methods)
+    assert requests_by_method(metrics) == {'unknown': 101}
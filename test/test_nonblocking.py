@@ -0,0 +1,175 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from zaailabcorelib.thrift.transport import TSocket
+from zaailabcorelib.zserver.nonblocking import CLOSED, Connection, EventLoop
+
+
+class Loop(object):
+    """EventLoop run by a thread, keeping the messages it dispatches."""
+
+    def __init__(self, pipeline_depth):
+        self.messages = []
+        self.errors = []
+        self.dispatched = threading.Condition()
+        self.loop = EventLoop(TSocket.TServerSocket(host='127.0.0.1', port=0),
+                              self._dispatch, pipeline_depth)
+        self.loop.listen()
+        self.port = self.loop.server_socket.handle.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _dispatch(self, fileno, connection, message):
+        with self.dispatched:
+            self.messages.append(message)
+            self.dispatched.notify_all()
+
+    def _run(self):
+        while self.running:
+            try:
+                self.loop.handle(0.05)
+            except Exception as e:
+                self.errors.append(e)
+                return
+
+    def wait_messages(self, count, timeout=5):
+        with self.dispatched:
+            assert self.dispatched.wait_for(lambda: len(self.messages) >= count, timeout)
+        return self.messages[:count]
+
+    def stop(self):
+        self.running = False
+        self.thread.join(5)
+        self.loop.close()
+
+
+@pytest.fixture
+def loop():
+    loops = []
+
+    def start(pipeline_depth):
+        loops.append(Loop(pipeline_depth))
+        return loops[-1]
+    yield start
+    for started in loops:
+        started.stop()
+        assert not started.errors
+
+
+def connect(loop):
+    client = socket.create_connection(('127.0.0.1', loop.port))
+    client.settimeout(5)
+    return client
+
+
+def frame(payload):
+    return struct.pack('!i', len(payload)) + payload
+
+
+def payload(message):
+    return message.buffer.getvalue()[:message.len]
+
+
+def read_exactly(client, size):
+    data = b''
+    while len(data) < size:
+        chunk = client.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_frame(client):
+    """Returns the next answer, None once the server closed the connection."""
+    header = read_exactly(client, 4)
+    return header and read_exactly(client, struct.unpack('!i', header)[0])
+
+
+def test_out_of_order_answers_are_sent_in_order(loop):
+    loop = loop(4)
+    client = connect(loop)
+    client.sendall(b''.join(frame(b'req%d' % idx) for idx in range(4)))
+    messages = loop.wait_messages(4)
+    assert [payload(message) for message in messages] == [b'req%d' % idx for idx in range(4)]
+    for message in reversed(messages):
+        message.ready(True, payload(message).upper())
+    assert [read_frame(client) for _ in range(4)] == [b'REQ%d' % idx for idx in range(4)]
+    client.close()
+
+
+def test_requests_beyond_the_depth_wait(loop):
+    loop = loop(2)
+    client = connect(loop)
+    client.sendall(b''.join(frame(b'req%d' % idx) for idx in range(3)))
+    first, second = loop.wait_messages(2)
+    time.sleep(0.1)
+    assert len(loop.messages) == 2
+    second.ready(True, b'b')
+    first.ready(True, b'a')
+    third = loop.wait_messages(3)[2]
+    third.ready(True, b'c')
+    assert [read_frame(client) for _ in range(3)] == [b'a', b'b', b'c']
+    client.close()
+
+
+def test_close_mid_pipeline(loop):
+    loop = loop(4)
+    client = connect(loop)
+    client.sendall(b''.join(frame(b'req%d' % idx) for idx in range(3)))
+    messages = loop.wait_messages(3)
+    messages[1].ready(True, b'held behind the failed request')
+    messages[0].ready(False, b'')
+    # late answers of a closed connection are dropped
+    messages[2].ready(True, b'late')
+    assert read_frame(client) is None
+    client.close()
+    # the loop goes on serving other connections
+    client = connect(loop)
+    client.sendall(frame(b'next'))
+    loop.wait_messages(4)[3].ready(True, b'answer')
+    assert read_frame(client) == b'answer'
+    client.close()
+
+
+def test_close_while_reading(loop):
+    loop = loop(8)
+    for _ in range(20):
+        client = connect(loop)
+        count = len(loop.messages)
+
+        def answer():
+            # a worker closes the connection while the loop reads more of it
+            loop.wait_messages(count + 1)[count].ready(False, b'')
+
+        worker = threading.Thread(target=answer)
+        worker.start()
+        try:
+            for idx in range(200):
+                client.sendall(frame(b'x' * idx))
+        except OSError:
+            pass
+        worker.join(5)
+        client.close()
+    assert not loop.errors
+
+
+def test_closed_connection_parses_no_more_requests():
+    server, client = socket.socketpair()
+    connection = Connection(server, lambda: None, pipeline_depth=1)
+    client.sendall(frame(b'first') + frame(b'second'))
+    time.sleep(0.05)
+    connection.read()
+    first = connection.received.popleft()
+    assert payload(first) == b'first' and connection.remaining
+    # a worker fails the request while the loop still holds buffered bytes
+    first.ready(False, b'')
+    assert not connection._parse()
+    connection.read()
+    assert connection.status == CLOSED and not connection.received
+    client.close()
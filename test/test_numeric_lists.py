@@ -0,0 +1,81 @@
+import numpy
+import pytest
+
+from zaailabcorelib.thrift.protocol.TProtocol import TType, TProtocolException
+from zaailabcorelib.thrift.protocol.TBase import TBase
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocol, TBinaryProtocolAccelerated
+from zaailabcorelib.thrift.protocol.TCompactProtocol import TCompactProtocol
+from zaailabcorelib.thrift.transport.TTransport import TMemoryBuffer
+
+
+class Embedding(TBase):
+    __slots__ = ('vector', 'ids', 'mask')
+
+    def __init__(self, vector=None, ids=None, mask=None):
+        self.vector = vector
+        self.ids = ids
+        self.mask = mask
+
+
+Embedding.thrift_spec = (
+    None,
+    (1, TType.LIST, 'vector', (TType.DOUBLE, None, False), None, ),
+    (2, TType.LIST, 'ids', (TType.I32, None, False), None, ),
+    (3, TType.LIST, 'mask', (TType.BYTE, None, False), None, ),
+)
+
+PROTOCOLS = [TBinaryProtocol, TBinaryProtocolAccelerated, TCompactProtocol]
+
+
+def encode(protocol_cls, obj):
+    trans = TMemoryBuffer()
+    obj.write(protocol_cls(trans))
+    return trans.getvalue()
+
+
+def decode(protocol_cls, data, **kwargs):
+    obj = Embedding()
+    obj.read(protocol_cls(TMemoryBuffer(data), **kwargs))
+    return obj
+
+
+def embedding():
+    return Embedding(vector=[i / 8.0 for i in range(100)], ids=list(range(-50, 50)), mask=[0, 1, -1] * 10)
+
+
+@pytest.mark.parametrize('protocol_cls', PROTOCOLS)
+def test_lists_round_trip(protocol_cls):
+    obj = embedding()
+    assert decode(protocol_cls, encode(protocol_cls, obj)) == obj
+
+
+@pytest.mark.parametrize('protocol_cls', PROTOCOLS)
+def test_arrays_encode_as_lists(protocol_cls):
+    obj = embedding()
+    arrays = Embedding(vector=numpy.array(obj.vector), ids=numpy.array(obj.ids, dtype=numpy.int64),
+                       mask=numpy.array(obj.mask, dtype=numpy.int8))
+    data = encode(protocol_cls, obj)
+    assert encode(protocol_cls, arrays) == data
+    decoded = decode(protocol_cls, data, numpy_arrays=True)
+    assert isinstance(decoded.vector, numpy.ndarray)
+    assert decoded.vector.tolist() == obj.vector
+    assert decoded.ids.tolist() == obj.ids
+    assert decoded.mask.tolist() == obj.mask
+
+
+@pytest.mark.parametrize('protocol_cls', PROTOCOLS)
+def test_int_array_as_doubles(protocol_cls):
+    data = encode(protocol_cls, Embedding(vector=numpy.arange(4)))
+    assert decode(protocol_cls, data).vector == [0.0, 1.0, 2.0, 3.0]
+
+
+@pytest.mark.parametrize('protocol_cls', PROTOCOLS)
+def test_2d_array_is_rejected(protocol_cls):
+    with pytest.raises(TProtocolException):
+        encode(protocol_cls, Embedding(vector=numpy.ones((2, 3))))
+
+
+@pytest.mark.parametrize('protocol_cls', [TBinaryProtocol, TBinaryProtocolAccelerated])
+def test_float_array_as_ints_is_rejected(protocol_cls):
+    with pytest.raises(TProtocolException):
+        encode(protocol_cls, Embedding(ids=numpy.array([1.7, 2.2])))
@@ -0,0 +1,142 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from zaailabcorelib.thriftpool.pool import ConnectionPool
+
+
+class Iface(object):
+    def __init__(self, iprot, oprot=None):
+        self._iprot = iprot
+        self._oprot = oprot if oprot is not None else iprot
+
+
+class Server(object):
+    """Listener accepting connections, close_all() closes their server side."""
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        self.accepted = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                self.accepted.append(self.listener.accept()[0])
+            except OSError:
+                return
+
+    def close_all(self):
+        for conn in self.accepted:
+            conn.close()
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close_all()
+    server.listener.close()
+
+
+def make_pool(server, **kwargs):
+    return ConnectionPool('127.0.0.1', server.port, Iface, **kwargs)
+
+
+def test_checkout_and_return(server):
+    pool = make_pool(server, size=2)
+    conn = pool.get_connection()
+    assert pool.stats()['checked_out'] == 1
+    pool.return_connection(conn)
+    assert pool.get_connection() is conn
+    pool.release_conn(conn)
+    stats = pool.stats()
+    assert (stats['checked_out'], stats['idle'], stats['created'], stats['released']) == (0, 0, 1, 1)
+    pool.close()
+
+
+def test_min_idle(server):
+    pool = make_pool(server, min_idle=3)
+    assert pool.stats()['idle'] == 3
+    assert pool.stats()['created'] == 3
+    pool.close()
+
+
+def test_expired_connection_is_evicted(server):
+    pool = make_pool(server, max_lifetime=0.05)
+    conn = pool.get_connection()
+    pool.return_connection(conn)
+    time.sleep(0.1)
+    assert pool.get_connection() is not conn
+    assert pool.stats()['evicted'] == 1
+    pool.close()
+
+
+def test_dead_connection_is_evicted_on_checkout(server):
+    pool = make_pool(server, min_idle=1, check_on_checkout=True)
+    conn = pool.get_connection()
+    pool.return_connection(conn)
+    server.close_all()
+    time.sleep(0.1)
+    assert pool.get_connection() is not conn
+    assert pool.stats()['evicted'] == 1
+    pool.close()
+
+
+def test_reap(server):
+    pool = make_pool(server, min_idle=2, max_idle_time=0.05, reap_interval=None)
+    time.sleep(0.1)
+    pool.reap()
+    stats = pool.stats()
+    assert (stats['evicted'], stats['idle'], stats['created']) == (2, 2, 4)
+    pool.close()
+
+
+def test_counters_under_concurrency(server):
+    pool = make_pool(server, size=8, max_lifetime=0.001, reap_interval=None)
+
+    def use():
+        for _ in range(50):
+            pool.return_connection(pool.get_connection())
+            pool.reap()
+
+    threads = [threading.Thread(target=use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = pool.stats()
+    assert stats['checked_out'] == 0
+    assert stats['created'] == stats['evicted'] + stats['idle']
+    pool.close()
+
+
+def test_closed_pool_keeps_its_permits(server):
+    pool = make_pool(server, size=1)
+    conn = pool.get_connection()
+    errors = []
+
+    def wait():
+        try:
+            pool.get_connection()
+        except RuntimeError as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=wait, daemon=True)
+    waiter.start()
+    while pool.stats()['waiters'] == 0:
+        time.sleep(0.01)
+    pool.close()
+    # the returned permit wakes the waiter, which gives it back
+    pool.return_connection(conn)
+    waiter.join(5)
+    assert len(errors) == 1
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            pool.get_connection()
+    assert pool._semaphore.acquire(timeout=1)
@@ -0,0 +1,150 @@
+import socket
+import time
+
+import pytest
+
+from zaailabcorelib.thrift.transport import TTransport
+from zaailabcorelib.thriftpool.client import Client
+from zaailabcorelib.thriftpool.retry import (CircuitBreaker, CircuitOpenError, ExponentialBackoff, RetryBudget, deadline,
+                                            remaining_time)
+
+
+class Echo(object):
+    def __init__(self, iprot, oprot=None):
+        pass
+
+    def echo(self, data):
+        pass
+
+
+class ClosedPool(object):
+    """Connection pool failing like a pool closed under the client."""
+
+    def get_connection(self):
+        raise RuntimeError('connection pool closed')
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def half_open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, capacity=2)
+    assert budget.try_withdraw() and budget.try_withdraw()
+    assert not budget.try_withdraw()
+    assert budget.num_rejected == 1
+    budget.deposit()
+    budget.deposit()
+    assert budget.try_withdraw()
+
+
+def test_backoff_is_capped():
+    backoff = ExponentialBackoff(base=1, max_delay=2)
+    assert all(0 <= backoff.delay(0) <= 1 for _ in range(20))
+    assert all(0 <= backoff.delay(10) <= 2 for _ in range(20))
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.on_failure()
+    assert breaker.allow()
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+    time.sleep(0.1)
+    # a single trial call
+    assert breaker.allow() and not breaker.allow()
+    breaker.on_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.num_opened == 1
+
+
+def test_deadlines_nest():
+    assert remaining_time() is None
+    with deadline(5):
+        with deadline(10):
+            assert remaining_time() <= 5
+        with deadline(1):
+            assert remaining_time() <= 1
+        assert 1 < remaining_time() <= 5
+    assert remaining_time() is None
+
+
+def test_open_circuit_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    client = Client(Echo, '127.0.0.1', unused_port(), retries=0, circuit_breaker=breaker)
+    with pytest.raises(TTransport.TTransportException) as info:
+        client.echo(b'')
+    assert not isinstance(info.value, CircuitOpenError)
+    with pytest.raises(CircuitOpenError):
+        client.echo(b'')
+
+
+def test_call_timeout_bounds_retries():
+    client = Client(Echo, '127.0.0.1', unused_port(), retries=1000, call_timeout=0.2,
+                    retry_budget=False, backoff=ExponentialBackoff(base=0.01, max_delay=0.01),
+                    circuit_breaker=False)
+    started = time.time()
+    with pytest.raises(TTransport.TTransportException):
+        client.echo(b'')
+    assert time.time() - started < 1
+
+
+def test_defaults_are_disabled():
+    client = Client(Echo, '127.0.0.1', unused_port())
+    assert client.retry_budget is None
+    assert client.backoff is None
+    assert client.circuit_breaker is None
+
+
+def test_true_creates_defaults():
+    client = Client(Echo, '127.0.0.1', unused_port(), retry_budget=True, backoff=True, circuit_breaker=True)
+    assert client.retry_budget is not None
+    assert client.backoff is not None
+    assert isinstance(client.circuit_breaker, CircuitBreaker)
+
+
+def test_connection_errors_do_not_open_circuit_by_default():
+    client = Client(Echo, '127.0.0.1', unused_port(), retries=0)
+    for _ in range(10):
+        with pytest.raises(Exception) as info:
+            client._call('echo', b'')
+        assert not isinstance(info.value, CircuitOpenError)
+
+
+def test_breaker_release_ends_trial():
+    breaker = half_open_breaker()
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_unexpected_error_releases_trial():
+    breaker = half_open_breaker()
+    client = Client(Echo, '127.0.0.1', unused_port(), retries=0, circuit_breaker=breaker)
+    client._connection_pool = ClosedPool()
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            client._call('echo', b'')
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_unexpected_error_releases_trial_of_map():
+    breaker = half_open_breaker()
+    client = Client(Echo, '127.0.0.1', unused_port(), retries=0, circuit_breaker=breaker)
+    client._connection_pool = ClosedPool()
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            client.map('echo', [(b'',)])
+    assert breaker.state == CircuitBreaker.HALF_OPEN
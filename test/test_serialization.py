@@ -0,0 +1,75 @@
+import pytest
+
+from zaailabcorelib.thrift import TSerialization
+from zaailabcorelib.thrift.protocol.TProtocol import TType
+from zaailabcorelib.thrift.protocol.TBase import TBase
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory, TBinaryProtocolAcceleratedFactory
+from zaailabcorelib.thrift.protocol.TCompactProtocol import TCompactProtocolAcceleratedFactory
+from zaailabcorelib.thrift.protocol.TJSONProtocol import TJSONProtocolFactory
+
+
+class Item(TBase):
+    __slots__ = ('id', 'name', 'scores')
+
+    def __init__(self, id=None, name=None, scores=None):
+        self.id = id
+        self.name = name
+        self.scores = scores
+
+
+Item.thrift_spec = (
+    None,
+    (1, TType.I64, 'id', None, None, ),
+    (2, TType.STRING, 'name', 'UTF8', None, ),
+    (3, TType.LIST, 'scores', (TType.DOUBLE, None, False), None, ),
+)
+
+FACTORIES = [
+    TBinaryProtocolFactory(),
+    TBinaryProtocolAcceleratedFactory(),
+    TCompactProtocolAcceleratedFactory(),
+    TJSONProtocolFactory(),
+]
+
+
+def items(n):
+    return [Item(id=i, name='item %d' % i, scores=[i / 4.0, -1.5]) for i in range(n)]
+
+
+@pytest.mark.parametrize('factory', FACTORIES)
+def test_round_trip(factory):
+    item = items(3)[2]
+    data = TSerialization.serialize(item, factory)
+    assert TSerialization.deserialize(Item(), data, factory) == item
+    # the write buffer reused by the next call is not shared with the result
+    assert TSerialization.serialize(items(1)[0], factory) != data
+    assert TSerialization.deserialize(Item(), data, factory) == item
+
+
+@pytest.mark.parametrize('factory', FACTORIES)
+def test_deserialize_fills_base(factory):
+    base = Item()
+    data = TSerialization.serialize(Item(id=7), factory)
+    assert TSerialization.deserialize(base, data, factory) is base
+    assert base.id == 7
+
+
+@pytest.mark.parametrize('factory', FACTORIES)
+@pytest.mark.parametrize('n', [0, 1, 10])
+def test_many_round_trip(factory, n):
+    data = TSerialization.serialize_many(items(n), factory)
+    assert TSerialization.deserialize_many(Item, data, factory) == items(n)
+
+
+@pytest.mark.parametrize('factory', FACTORIES[:3])
+def test_truncated_input(factory):
+    data = TSerialization.serialize_many(items(3), factory)
+    for size in (3, len(data) // 2, len(data) - 1):
+        with pytest.raises(EOFError):
+            TSerialization.deserialize_many(Item, data[:size], factory)
+
+
+def test_serializers_are_cached():
+    factory = FACTORIES[1]
+    assert TSerialization.get_serializer(Item, factory) is TSerialization.get_serializer(Item, factory)
+    assert TSerialization.get_serializer(Item, factory) is not TSerialization.get_serializer(Item, FACTORIES[0])
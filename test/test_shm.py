@@ -0,0 +1,117 @@
+import threading
+import time
+from multiprocessing import Queue
+
+import numpy as np
+import pytest
+
+from zaailabcorelib.zserver.thrift_server.TMultiPoolServer import THandlerBase, TModelBase
+from zaailabcorelib.zserver.thrift_server.dispatcher import ResultDispatcher
+from zaailabcorelib.zserver.thrift_server.shm import SharedMemoryRing, ShmArrayRef
+
+
+@pytest.fixture
+def ring():
+    ring = SharedMemoryRing(2, 1000)
+    yield ring
+    ring.close(unlink=True)
+
+
+def num_free(ring):
+    return ring._top.value
+
+
+def test_put_and_view(ring):
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    ref = ring.put(array)
+    assert isinstance(ref, ShmArrayRef) and ref.shape == (3, 4)
+    view = ring.view(ref)
+    np.testing.assert_array_equal(view, array)
+    # the view shares the slot, not the source array
+    array[0, 0] = 42
+    assert view[0, 0] == 0
+    ring.release(ref)
+    assert num_free(ring) == 2
+
+
+def test_slots_are_aligned(ring):
+    assert ring.slot_size == 1024
+
+
+def test_fits(ring):
+    assert ring.fits(np.zeros(128, dtype=np.float64))
+    assert not ring.fits(np.zeros(129, dtype=np.float64))
+    assert not ring.fits(np.array([None, 1], dtype=object))
+    assert not ring.fits([1, 2, 3])
+
+
+def test_store_reuses_a_slot(ring):
+    ref = ring.put(np.ones(4))
+    out = ring.store(ref.slot, np.arange(3, dtype=np.int8))
+    assert out.slot == ref.slot
+    np.testing.assert_array_equal(ring.view(out), [0, 1, 2])
+    ring.discard(out)
+    ring.discard('not a ref')
+    assert num_free(ring) == 2
+
+
+def test_put_blocks_while_the_ring_is_full(ring):
+    refs = [ring.put(np.zeros(1)) for _ in range(2)]
+    with pytest.raises(TimeoutError):
+        ring.put(np.zeros(1), timeout=0.05)
+    threading.Timer(0.05, ring.release, args=(refs[0],)).start()
+    assert ring.put(np.zeros(1), timeout=5).slot == refs[0].slot
+
+
+class Model(TModelBase):
+    def model_init(self, model_config):
+        return None
+
+    def predict(self, list_input):
+        if any(isinstance(inp, np.ndarray) and inp[0] < 0 for inp in list_input):
+            time.sleep(0.3)
+        return [inp * 2 if isinstance(inp, np.ndarray) else inp for inp in list_input]
+
+
+class Handler(THandlerBase):
+    def process_input(self, input):
+        return input
+
+
+@pytest.fixture
+def handler(ring):
+    inference_queue, result_queue = Queue(), Queue()
+    model = Model(inference_queue, [result_queue], {}, batch_infer_size=2, shm_ring=ring)
+    model.daemon = True
+    model.start()
+    dispatcher = ResultDispatcher(result_queue, release=ring.discard)
+    dispatcher.start()
+    yield Handler(inference_queue, dispatcher, shm_ring=ring)
+    dispatcher.close()
+    dispatcher.join(5)
+    model.terminate()
+    model.join(5)
+
+
+def test_send_to_model_returns_a_copy(ring, handler):
+    for _ in range(5):
+        result = handler.send_to_model(np.arange(6, dtype=np.int32))
+        np.testing.assert_array_equal(result, np.arange(0, 12, 2))
+    assert handler.send_to_model('not an array') == 'not an array'
+    assert num_free(ring) == 2
+
+
+def test_borrow_from_model(ring, handler):
+    with handler.borrow_from_model(np.ones(3)) as result:
+        np.testing.assert_array_equal(result, [2, 2, 2])
+        assert num_free(ring) == 1
+    assert num_free(ring) == 2
+
+
+def test_result_of_a_timed_out_request_is_released(ring, handler):
+    with pytest.raises(TimeoutError):
+        handler.send_to_model(np.full(2, -1.0), timeout=0.1)
+    deadline = time.time() + 5
+    while num_free(ring) < 2:
+        assert time.time() < deadline
+        time.sleep(0.05)
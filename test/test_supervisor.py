@@ -0,0 +1,189 @@
+import os
+import signal
+import stat
+import threading
+import time
+
+import pytest
+
+from zaailabcorelib.thrift.Thrift import TMessageType
+from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
+from zaailabcorelib.thrift.transport import TSocket
+from zaailabcorelib.thriftpool.client import Client
+from zaailabcorelib.zserver.thrift.TModelPoolServer import TModelPoolServer
+
+
+class Echo(object):
+    """Thrift client of a service echoing its string argument."""
+
+    def __init__(self, iprot, oprot=None):
+        self._iprot = iprot
+        self._oprot = oprot if oprot is not None else iprot
+        self._seqid = 0
+
+    def echo(self, data):
+        self.send_echo(data)
+        return self.recv_echo()
+
+    def send_echo(self, data):
+        self._oprot.writeMessageBegin('echo', TMessageType.CALL, self._seqid)
+        self._oprot.writeBinary(data)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+
+    def recv_echo(self):
+        self._iprot.readMessageBegin()
+        data = self._iprot.readBinary()
+        self._iprot.readMessageEnd()
+        return data
+
+
+class Processor(object):
+    """Shape of a generated thrift Processor of the echo service."""
+
+    def __init__(self, handler):
+        self._handler = handler
+
+    def process(self, iprot, oprot):
+        name, _, seqid = iprot.readMessageBegin()
+        data = iprot.readBinary()
+        iprot.readMessageEnd()
+        oprot.writeMessageBegin(name, TMessageType.REPLY, seqid)
+        oprot.writeBinary(self._handler.echo(data))
+        oprot.writeMessageEnd()
+
+    def process_echo(self, seqid, iprot, oprot):
+        pass
+
+
+class Handler(object):
+    def __init__(self, suffix=b''):
+        self.suffix = suffix
+
+    def echo(self, data):
+        if data == b'hang':
+            time.sleep(60)
+        if data == b'slow':
+            time.sleep(0.5)
+        return data + self.suffix
+
+
+@pytest.fixture
+def server():
+    server = TModelPoolServer(Handler, Processor, TSocket.TServerSocket(host='127.0.0.1', port=0),
+                              TBinaryProtocolFactory(), list_model_config=[{}], supervise_interval=0.1)
+    server.prepare()
+    server.port = server.tsocket.handle.getsockname()[1]
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    server.thread = thread
+    yield server
+    if thread.is_alive():
+        server.shutdown(0)
+        thread.join(5)
+
+
+def make_client(server):
+    # a hung call only ends with this 10s socket timeout
+    return Client(Echo, '127.0.0.1', server.port, retries=0, network_timeout=10000)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def sockets_of(pid):
+    count = 0
+    for name in os.listdir('/proc/%d/fd' % pid):
+        try:
+            count += stat.S_ISSOCK(os.stat('/proc/%d/fd/%s' % (pid, name)).st_mode)
+        except OSError:
+            pass
+    return count
+
+
+def test_dead_worker_is_respawned(server):
+    client = make_client(server)
+    assert client.echo(b'x') == b'x'
+    old = server.workers[0]
+    os.kill(old.pid, signal.SIGKILL)
+    wait_for(lambda: server.supervisor.num_respawned == 1)
+    assert server.workers[0] is not old and server.workers[0].is_alive()
+    assert server.stats()['num_respawned'] == 1
+    assert client.echo(b'y') == b'y'
+
+
+def test_killed_worker_fails_its_request_promptly(server):
+    client = make_client(server)
+    assert client.echo(b'x') == b'x'
+    errors = []
+
+    def hang():
+        try:
+            make_client(server).echo(b'hang')
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=hang)
+    thread.start()
+    wait_for(lambda: server.load.in_flight[0] == 1)
+    # the respawned worker must not hold the connection of the hung call
+    started = time.time()
+    os.kill(server.workers[0].pid, signal.SIGKILL)
+    thread.join(10)
+    assert errors and time.time() - started < 3
+    wait_for(lambda: server.supervisor.num_respawned == 1)
+    assert client.echo(b'y') == b'y'
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc')
+def test_respawned_worker_holds_no_socket(server):
+    clients = [make_client(server) for _ in range(3)]
+    for client in clients:
+        assert client.echo(b'x') == b'x'
+    old = server.workers[0]
+    os.kill(old.pid, signal.SIGKILL)
+    wait_for(lambda: server.workers[0] is not old)
+    # dropped as soon as the worker runs
+    wait_for(lambda: sockets_of(server.workers[0].pid) == 0)
+    for client in clients:
+        assert client.echo(b'y') == b'y'
+
+
+def test_reload(server):
+    client = make_client(server)
+    assert client.echo(b'x') == b'x'
+    old_histogram = server.metrics.predict_latency.labels(0)
+    list_model_config = [{'suffix': b'!'}]
+    server.reload(list_model_config, warmup_timeout=10, drain_timeout=1)
+    assert client.echo(b'x') == b'x!'
+    assert list_model_config == [{'suffix': b'!'}]
+    assert server.list_model_config == list_model_config
+    assert server.list_model_config is not list_model_config
+    # the new worker writes its own histograms, exported after the drain
+    assert server.metrics.predict_latency.labels(0) is not old_histogram
+    assert server.metrics.predict_latency.labels(0).count == 1
+
+
+def test_failed_warmup_keeps_the_old_worker(server):
+    client = make_client(server)
+    old = server.workers[0]
+    with pytest.raises(RuntimeError):
+        server.reload([{'unknown': True}], warmup_timeout=5)
+    assert server.workers[0] is old
+    assert client.echo(b'x') == b'x'
+
+
+def test_shutdown_drains_pending_requests(server):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(make_client(server).echo(b'slow')))
+    thread.start()
+    wait_for(lambda: server.load.in_flight[0] == 1)
+    server.shutdown(5)
+    thread.join(5)
+    server.thread.join(5)
+    assert results == [b'slow']
+    assert not server.thread.is_alive()
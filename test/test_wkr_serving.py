@@ -0,0 +1,206 @@
+import socket
+import time
+
+import numpy as np
+import pytest
+import zmq
+
+from zaailabcorelib.zserver.zmq.client.wkr_serving.client import ServerBusyError, WKRClient
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server import WKRHardWorker, WKRServer
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server.helper import get_args_parser
+from zaailabcorelib.zserver.zmq.server.wkr_serving.server.worker_skeleton import pad_batch
+
+MAX_UNDELIVERED = 4
+
+
+class BatchSizeWorker(WKRHardWorker):
+    """Answers every request with the size of its batch."""
+
+    def predict(self, model, input):
+        return [len(input)] * len(input)
+
+
+class SlowFirstWorker(WKRHardWorker):
+    """Answers with its worker id, the first worker is slow."""
+
+    def predict(self, model, input):
+        if self.worker_id == 0:
+            time.sleep(0.2)
+        return [self.worker_id] * len(input)
+
+
+def free_ports():
+    """Returns two consecutive free ports, for port and port_out."""
+    while True:
+        with socket.socket() as first:
+            first.bind(('127.0.0.1', 0))
+            port = first.getsockname()[1]
+            with socket.socket() as second:
+                try:
+                    second.bind(('127.0.0.1', port + 1))
+                except OSError:
+                    continue
+                return port
+
+
+@pytest.fixture(scope='module')
+def start_server(tmp_path_factory):
+    servers = []
+
+    def start(*argv, worker=WKRHardWorker):
+        port = free_ports()
+        args = get_args_parser().parse_args(['-model_dir', str(tmp_path_factory.mktemp('model')), '-cpu',
+                                             '-port', str(port), '-port_out', str(port + 1)] + list(argv))
+        server = WKRServer(args, worker)
+        server.start()
+        server.is_ready.wait()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture(scope='module')
+def server(start_server):
+    return start_server('-max_undelivered', str(MAX_UNDELIVERED))
+
+
+def make_client(server, **kwargs):
+    return WKRClient(port=server.port, port_out=server.args.port_out, timeout=5000, check_version=False, **kwargs)
+
+
+def fetch(client, count):
+    """Returns the results of `count` non-blocking requests, in request order."""
+    client.receiver.setsockopt(zmq.RCVTIMEO, 5000)
+    responses = client.fetch()
+    return [response.embedding for response in
+            sorted((next(responses) for _ in range(count)), key=lambda response: int(response.id))]
+
+
+def sink_status(server):
+    with make_client(server) as client:
+        return client.server_status['statistic_postsink']
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def replace_receiver(client):
+    """Closes the result socket of the client, its replacement is not connected yet."""
+    client.receiver.close()
+    client.receiver = client.context.socket(zmq.DEALER)
+    client.receiver.setsockopt(zmq.LINGER, 0)
+    client.receiver.setsockopt(zmq.IDENTITY, client.identity)
+
+
+def test_echo(server):
+    with make_client(server) as client:
+        assert [client.encode({'x': idx}) for idx in range(3)] == [{'x': idx} for idx in range(3)]
+
+
+def test_zero_copy_numpy(start_server):
+    server = start_server('-protocol', 'numpy', '-zero_copy')
+    with make_client(server, protocol='numpy', zero_copy=True) as client:
+        assert client.server_status['zero_copy']
+        for dtype in (np.float32, np.int64):
+            array = np.arange(1000, dtype=dtype).reshape(10, 100)
+            result = client.encode(array)
+            assert result.dtype == array.dtype
+            np.testing.assert_array_equal(result, array)
+
+
+def test_zero_copy_arrays_inside_objects(start_server):
+    server = start_server('-zero_copy')
+    with make_client(server, zero_copy=True) as client:
+        result = client.encode({'id': 1, 'array': np.arange(100.0), 'name': 'x'})
+        assert (result['id'], result['name']) == (1, 'x')
+        np.testing.assert_array_equal(result['array'], np.arange(100.0))
+
+
+def test_pad_batch():
+    batch = pad_batch([np.ones((1, 2)), np.ones((2, 1))])
+    np.testing.assert_array_equal(batch, [[[1, 1], [0, 0]], [[1, 0], [1, 0]]])
+    with pytest.raises(ValueError):
+        pad_batch([np.ones(2), np.ones((2, 2))])
+
+
+def test_batch_waits_for_the_deadline_of_its_first_request(start_server):
+    server = start_server('-batch_size', '4', '-batch_group_timeout', '300', worker=BatchSizeWorker)
+    with make_client(server) as client:
+        for idx in range(4):
+            client.encode(idx, blocking=False)
+        assert fetch(client, 4) == [4] * 4
+        # a single request waits batch_group_timeout, not batch_size times it
+        started = time.time()
+        assert client.encode('alone') == 1
+        assert 0.25 < time.time() - started < 0.9
+
+
+def test_pipelined_worker(start_server):
+    server = start_server('-pipeline_depth', '2', '-batch_size', '4', '-batch_group_timeout', '10')
+    with make_client(server) as client:
+        for idx in range(50):
+            client.encode(idx, blocking=False)
+        assert fetch(client, 50) == list(range(50))
+
+
+def test_jobs_go_to_the_least_loaded_worker(start_server):
+    server = start_server('-num_worker', '2', '-batch_size', '1', '-worker_credits', '1', worker=SlowFirstWorker)
+    with make_client(server) as client:
+        for idx in range(20):
+            client.encode(idx, blocking=False)
+        assert fetch(client, 20).count(1) >= 15
+        # each worker gets its credit back once idle
+        wait_for(lambda: client.server_status['free_credits'] == [1, 1])
+        assert client.server_status['worker_credits'] == 1
+
+
+def test_results_wait_for_a_client_connecting_late(server):
+    client = make_client(server)
+    replace_receiver(client)
+    for idx in range(3):
+        client.encode(idx, blocking=False)
+    time.sleep(0.2)
+    client.receiver.connect('tcp://%s:%d' % (client.ip, client.port_out))
+    assert fetch(client, 3) == [0, 1, 2]
+    client.close()
+
+
+def test_clients_receive_their_own_results_only(server):
+    with make_client(server) as first, make_client(server) as second:
+        for idx in range(5):
+            first.encode('first', blocking=False)
+            second.encode('second', blocking=False)
+        assert fetch(first, 5) == ['first'] * 5
+        assert fetch(second, 5) == ['second'] * 5
+        assert not first.pending_response and not second.pending_response
+
+
+def test_slow_client_is_answered_busy(server):
+    client = make_client(server)
+    # the client goes away, its results wait in the sink
+    replace_receiver(client)
+    time.sleep(0.2)
+    for idx in range(3 * MAX_UNDELIVERED):
+        client.encode(idx, blocking=False)
+    # the sink keeps as many busy replies as results and drops the rest
+    wait_for(lambda: sink_status(server)['total_undelivered_job'] == 2 * MAX_UNDELIVERED)
+    status = sink_status(server)
+    assert status['busy_clients'] == 1
+    assert status['total_busy_job'] == 2 * MAX_UNDELIVERED
+    assert status['total_dropped_job'] == MAX_UNDELIVERED
+
+    client.receiver.connect('tcp://%s:%d' % (client.ip, client.port_out))
+    responses = client.fetch()
+    assert [next(responses).embedding for _ in range(MAX_UNDELIVERED)] == list(range(MAX_UNDELIVERED))
+    with pytest.raises(ServerBusyError):
+        next(responses)
+    # served again once it caught up
+    wait_for(lambda: sink_status(server)['busy_clients'] == 0)
+    assert client.encode('again') == 'again'
+    client.close()
@@ -17,22 +17,194 @@
 # under the License.
 #
 
-from .protocol import TBinaryProtocol
+import struct
+import threading
+import weakref
+
+from .protocol import TBinaryProtocol, TBinaryCodec
+from .protocol.TBase import TFrozenBase
 from .transport import TTransport
 
+__all__ = ['serialize', 'deserialize', 'serialize_many', 'deserialize_many',
+           'StructSerializer', 'get_serializer']
+
+# records of serialize_many() are prefixed by their length, as frames
+_LENGTH = struct.Struct('!i')
+
+_DEFAULT_PROTOCOL_FACTORY = TBinaryProtocol.TBinaryProtocolAcceleratedFactory()
+
+
+class StructSerializer(object):
+    """Serializes the structs of one class with one protocol factory.
+
+    Each thread reuses its own memory buffer and protocol to write instead
+    of allocating them for every struct. When the protocol encodes with the
+    pure-Python binary codec, the compiled encoder and decoder of the class
+    are called directly on bytes, without transport at all.
+    """
+
+    def __init__(self, struct_cls, protocol_factory=_DEFAULT_PROTOCOL_FACTORY):
+        self.struct_cls = struct_cls
+        self.protocol_factory = protocol_factory
+        self._frozen = issubclass(struct_cls, TFrozenBase)
+        self._local = threading.local()
+        self._encoder = self._decoder = None
+        protocol = protocol_factory.getProtocol(TTransport.TMemoryBuffer())
+        if (protocol._fast_encode is TBinaryCodec.encode_binary and
+                protocol._fast_decode is TBinaryCodec.decode_binary and
+                struct_cls.thrift_spec is not None):
+            self._encoder = TBinaryCodec.struct_encoder(struct_cls.thrift_spec)
+            self._decoder = TBinaryCodec.struct_decoder(struct_cls.thrift_spec, protocol.numpy_arrays)
+
+    def _write_protocol(self):
+        protocol = getattr(self._local, 'protocol', None)
+        if protocol is None:
+            protocol = self.protocol_factory.getProtocol(TTransport.TMemoryBuffer())
+            self._local.protocol = protocol
+        else:
+            buf = protocol.trans.cstringio_buf
+            buf.seek(0)
+            buf.truncate()
+        return protocol
+
+    def _write(self, obj):
+        protocol = self._write_protocol()
+        try:
+            obj.write(protocol)
+        except Exception:
+            # the protocol may be left in the middle of a struct
+            self._local.protocol = None
+            raise
+        return protocol.trans.getvalue()
+
+    def _read(self, protocol, base):
+        if self._frozen:
+            return self.struct_cls.read(protocol)
+        if base is None:
+            base = self.struct_cls()
+        base.read(protocol)
+        return base
+
+    def _decode(self, data, pos, end, base):
+        try:
+            values, pos = self._decoder(data, pos)
+        except (TBinaryCodec._Underflow, IndexError, struct.error):
+            pos = end + 1
+        if pos > end:
+            raise EOFError()
+        if base is None:
+            return self.struct_cls(**values)
+        for name, value in values.items():
+            setattr(base, name, value)
+        return base
+
+    def serialize(self, obj):
+        if self._encoder is None:
+            return self._write(obj)
+        buf = bytearray()
+        self._encoder(buf, obj)
+        return bytes(buf)
+
+    def deserialize(self, buf, base=None):
+        """Returns the struct read from `buf`, filling `base` when given."""
+        if self._decoder is None:
+            protocol = self.protocol_factory.getProtocol(TTransport.TMemoryBuffer(buf))
+            return self._read(protocol, base)
+        if not isinstance(buf, bytes):
+            buf = bytes(buf)
+        return self._decode(buf, 0, len(buf), None if self._frozen else base)
+
+    def append(self, out, obj):
+        """Appends `obj` to the bytearray `out` as a length-prefixed record."""
+        if self._encoder is None:
+            data = self._write(obj)
+            out += _LENGTH.pack(len(data))
+            out += data
+            return
+        start = len(out)
+        out += b'\0\0\0\0'
+        self._encoder(out, obj)
+        _LENGTH.pack_into(out, start, len(out) - start - 4)
+
+    def serialize_many(self, objs):
+        out = bytearray()
+        for obj in objs:
+            self.append(out, obj)
+        return bytes(out)
+
+    def deserialize_many(self, buf):
+        """Returns the list of structs written by serialize_many()."""
+        if not isinstance(buf, bytes):
+            buf = bytes(buf)
+        objs = []
+        size = len(buf)
+        pos = 0
+        if self._decoder is not None:
+            while pos < size:
+                length, pos = _read_length(buf, pos, size)
+                objs.append(self._decode(buf, pos, pos + length, None))
+                pos += length
+            return objs
+        trans = TTransport.TMemoryBuffer(buf)
+        protocol = self.protocol_factory.getProtocol(trans)
+        while pos < size:
+            length, pos = _read_length(buf, pos, size)
+            # protocols may not read a record to its last byte
+            trans.cstringio_buf.seek(pos)
+            objs.append(self._read(protocol, None))
+            pos += length
+            if trans.cstringio_buf.tell() > pos:
+                raise EOFError()
+        return objs
+
+
+def _read_length(buf, pos, size):
+    if pos + 4 > size:
+        raise EOFError()
+    length = _LENGTH.unpack_from(buf, pos)[0]
+    pos += 4
+    if length < 0 or pos + length > size:
+        raise EOFError()
+    return length, pos
+
+
+# serializers by protocol factory, then by struct class
+_serializers = weakref.WeakKeyDictionary()
+_serializers_lock = threading.Lock()
+
+
+def get_serializer(struct_cls, protocol_factory=_DEFAULT_PROTOCOL_FACTORY):
+    """Returns the cached StructSerializer of `struct_cls`."""
+    by_class = _serializers.get(protocol_factory)
+    serializer = by_class.get(struct_cls) if by_class is not None else None
+    if serializer is None:
+        with _serializers_lock:
+            by_class = _serializers.setdefault(protocol_factory, {})
+            serializer = by_class.get(struct_cls)
+            if serializer is None:
+                serializer = by_class[struct_cls] = StructSerializer(struct_cls, protocol_factory)
+    return serializer
+
+
+def serialize(thrift_object, protocol_factory=_DEFAULT_PROTOCOL_FACTORY):
+    return get_serializer(thrift_object.__class__, protocol_factory).serialize(thrift_object)
+
+
+def deserialize(base, buf, protocol_factory=_DEFAULT_PROTOCOL_FACTORY):
+    return get_serializer(base.__class__, protocol_factory).deserialize(buf, base)
+
 
-def serialize(thrift_object,
-              protocol_factory=TBinaryProtocol.TBinaryProtocolFactory()):
-    transport = TTransport.TMemoryBuffer()
-    protocol = protocol_factory.getProtocol(transport)
-    thrift_object.write(protocol)
-    return transport.getvalue()
+def serialize_many(thrift_objects, protocol_factory=_DEFAULT_PROTOCOL_FACTORY):
+    """Packs structs into one buffer, each prefixed by its 4 bytes length."""
+    out = bytearray()
+    serializer = None
+    for obj in thrift_objects:
+        if serializer is None or serializer.struct_cls is not obj.__class__:
+            serializer = get_serializer(obj.__class__, protocol_factory)
+        serializer.append(out, obj)
+    return bytes(out)
 
 
-def deserialize(base,
-                buf,
-                protocol_factory=TBinaryProtocol.TBinaryProtocolFactory()):
-    transport = TTransport.TMemoryBuffer(buf)
-    protocol = protocol_factory.getProtocol(transport)
-    base.read(protocol)
-    return base
+def deserialize_many(struct_cls, buf, protocol_factory=_DEFAULT_PROTOCOL_FACTORY):
+    """Returns the list of `struct_cls` packed by serialize_many()."""
+    return get_serializer(struct_cls, protocol_factory).deserialize_many(buf)
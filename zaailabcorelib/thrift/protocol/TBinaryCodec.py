@@ -0,0 +1,421 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements. See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership. The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+"""Pure-Python stand-in for the fastbinary C extension.
+
+encode_binary() and decode_binary() have the signatures of their
+fastbinary counterparts, so generated structs call them through
+TBinaryProtocolAccelerated._fast_encode and _fast_decode.
+
+The thrift_spec of a struct is compiled once into a chain of closures:
+every scalar field is packed together with its field header by a single
+precomputed struct.Struct, lists of scalars are packed or unpacked in one
+call, and a whole struct is written into a single bytearray instead of one
+trans.write() per value. Decoding reads the buffer of the transport in
+place and only consumes it once the struct is complete.
+
+Numeric lists given as numpy arrays are byte swapped at once, and are
+decoded as numpy arrays when the protocol has numpy_arrays set.
+"""
+
+import struct
+from struct import Struct
+
+from .TProtocol import TType, TFrozenDict, TProtocolException, NUMPY_DTYPES, _numpy, _numbers_array
+
+__all__ = ['encode_binary', 'decode_binary', 'struct_encoder', 'struct_decoder']
+
+_SCALAR_CODES = {
+    TType.BOOL: '?',
+    TType.BYTE: 'b',
+    TType.DOUBLE: 'd',
+    TType.I16: 'h',
+    TType.I32: 'i',
+    TType.I64: 'q',
+}
+_SCALAR_SIZES = dict((ttype, struct.calcsize('!' + code)) for ttype, code in _SCALAR_CODES.items())
+_NUMPY_DTYPES = dict((ttype, '>' + dtype) for ttype, dtype in NUMPY_DTYPES.items())
+
+_I16 = Struct('!h')
+_I32 = Struct('!i')
+_FIELD_HEADER = Struct('!bh')
+_LIST_HEADER = Struct('!bi')
+_MAP_HEADER = Struct('!bbi')
+
+_STOP = b'\x00'
+
+# compiled closures by id() of their spec, which is kept alive alongside,
+# decoders by (id(spec), numpy_arrays)
+_encoders = {}
+_decoders = {}
+
+
+class _Underflow(Exception):
+    """The buffer ends before `end`."""
+
+    def __init__(self, end):
+        Exception.__init__(self, end)
+        self.end = end
+
+
+def _negative_size(size):
+    raise TProtocolException(TProtocolException.NEGATIVE_SIZE, 'Negative length: %d' % size)
+
+
+def _struct_spec(spec_args):
+    cls, spec = spec_args
+    return cls, spec if spec is not None else cls.thrift_spec
+
+
+# Encoding
+
+def _value_writer(ttype, spec_args):
+    """Returns write(buf, value) appending `value` without field header."""
+    code = _SCALAR_CODES.get(ttype)
+    if code is not None:
+        pack = Struct('!' + code).pack
+
+        def write_scalar(buf, value):
+            buf += pack(value)
+        return write_scalar
+
+    if ttype == TType.STRING:
+        if spec_args == 'BINARY':
+            def write_binary(buf, value):
+                buf += _I32.pack(len(value))
+                buf += value
+            return write_binary
+
+        def write_string(buf, value):
+            value = value.encode('utf-8')
+            buf += _I32.pack(len(value))
+            buf += value
+        return write_string
+
+    if ttype == TType.STRUCT:
+        cls, spec = _struct_spec(spec_args)
+        encoder = []
+
+        def write_struct(buf, value):
+            # resolved on first use, the spec may be recursive
+            if not encoder:
+                encoder.append(struct_encoder(spec))
+            encoder[0](buf, value)
+        return write_struct
+
+    if ttype in (TType.LIST, TType.SET):
+        etype, espec = spec_args[0], spec_args[1]
+        ecode = _SCALAR_CODES.get(etype)
+        if ecode is not None:
+            fmt = '!%d' + ecode
+            numpy = _numpy()
+            ndarray = numpy.ndarray if numpy is not None else ()
+            dtype = _NUMPY_DTYPES[etype]
+
+            def write_scalars(buf, value):
+                if isinstance(value, ndarray):
+                    value = _numbers_array(value, dtype)
+                    buf += _LIST_HEADER.pack(etype, value.size)
+                    buf += value.tobytes()
+                else:
+                    size = len(value)
+                    buf += _LIST_HEADER.pack(etype, size)
+                    buf += struct.pack(fmt % size, *value)
+            return write_scalars
+        write_elem = _value_writer(etype, espec)
+
+        def write_list(buf, value):
+            buf += _LIST_HEADER.pack(etype, len(value))
+            for elem in value:
+                write_elem(buf, elem)
+        return write_list
+
+    if ttype == TType.MAP:
+        ktype, kspec, vtype, vspec = spec_args[:4]
+        write_key = _value_writer(ktype, kspec)
+        write_val = _value_writer(vtype, vspec)
+
+        def write_map(buf, value):
+            buf += _MAP_HEADER.pack(ktype, vtype, len(value))
+            for key, val in value.items():
+                write_key(buf, key)
+                write_val(buf, val)
+        return write_map
+
+    raise TProtocolException(TProtocolException.INVALID_DATA, 'Invalid type %d' % ttype)
+
+
+def _field_writer(fid, ttype, spec_args):
+    """Returns write(buf, value) appending the field header and `value`."""
+    code = _SCALAR_CODES.get(ttype)
+    if code is not None:
+        pack = Struct('!bh' + code).pack
+
+        def write_scalar_field(buf, value):
+            buf += pack(ttype, fid, value)
+        return write_scalar_field
+    header = _FIELD_HEADER.pack(ttype, fid)
+    write_value = _value_writer(ttype, spec_args)
+
+    def write_field(buf, value):
+        buf += header
+        write_value(buf, value)
+    return write_field
+
+
+def struct_encoder(spec):
+    """Returns encode(buf, obj) appending `obj` to the bytearray `buf`."""
+    cached = _encoders.get(id(spec))
+    if cached is not None and cached[0] is spec:
+        return cached[1]
+    fields = []
+
+    def encode(buf, obj):
+        for name, write in fields:
+            value = getattr(obj, name)
+            if value is not None:
+                write(buf, value)
+        buf += _STOP
+
+    _encoders[id(spec)] = (spec, encode)
+    for field in spec:
+        if field is None:
+            continue
+        fid, ttype, name, spec_args = field[:4]
+        fields.append((name, _field_writer(fid, ttype, spec_args)))
+    return encode
+
+
+def encode_binary(obj, spec_pair):
+    """Returns `obj` encoded with the binary protocol, as a bytearray."""
+    buf = bytearray()
+    struct_encoder(spec_pair[1])(buf, obj)
+    return buf
+
+
+# Decoding
+
+def _skip(data, pos, ttype):
+    """Returns the position after a value of `ttype` starting at `pos`."""
+    size = _SCALAR_SIZES.get(ttype)
+    if size is not None:
+        return pos + size
+    if ttype == TType.STRING:
+        size = _I32.unpack_from(data, pos)[0]
+        if size < 0:
+            _negative_size(size)
+        return pos + 4 + size
+    if ttype == TType.STRUCT:
+        while True:
+            ftype = data[pos]
+            if ftype == TType.STOP:
+                return pos + 1
+            pos = _skip(data, pos + 3, ftype)
+    if ttype == TType.MAP:
+        ktype, vtype, count = _MAP_HEADER.unpack_from(data, pos)
+        if count < 0:
+            _negative_size(count)
+        pos += 6
+        for _ in range(count):
+            pos = _skip(data, _skip(data, pos, ktype), vtype)
+        return pos
+    if ttype in (TType.LIST, TType.SET):
+        etype, count = _LIST_HEADER.unpack_from(data, pos)
+        if count < 0:
+            _negative_size(count)
+        pos += 5
+        size = _SCALAR_SIZES.get(etype)
+        if size is not None:
+            return pos + count * size
+        for _ in range(count):
+            pos = _skip(data, pos, etype)
+        return pos
+    raise TProtocolException(TProtocolException.INVALID_DATA, 'Invalid type %d' % ttype)
+
+
+def _value_reader(ttype, spec_args, numpy_arrays):
+    """Returns read(data, pos) -> (value, position after it)."""
+    code = _SCALAR_CODES.get(ttype)
+    if code is not None:
+        unpack_from = Struct('!' + code).unpack_from
+        size = _SCALAR_SIZES[ttype]
+
+        def read_scalar(data, pos):
+            return unpack_from(data, pos)[0], pos + size
+        return read_scalar
+
+    if ttype == TType.STRING:
+        binary = spec_args == 'BINARY'
+
+        def read_string(data, pos):
+            size = _I32.unpack_from(data, pos)[0]
+            if size < 0:
+                _negative_size(size)
+            pos += 4
+            end = pos + size
+            if end > len(data):
+                raise _Underflow(end)
+            if binary:
+                return bytes(data[pos:end]), end
+            return data[pos:end].decode('utf-8'), end
+        return read_string
+
+    if ttype == TType.STRUCT:
+        cls, spec = _struct_spec(spec_args)
+        decoder = []
+
+        def read_struct(data, pos):
+            if not decoder:
+                decoder.append(struct_decoder(spec, numpy_arrays))
+            values, pos = decoder[0](data, pos)
+            return cls(**values), pos
+        return read_struct
+
+    if ttype in (TType.LIST, TType.SET):
+        etype, espec, is_immutable = spec_args
+        if ttype == TType.LIST:
+            container = tuple if is_immutable else list
+        else:
+            container = frozenset if is_immutable else set
+        ecode = _SCALAR_CODES.get(etype)
+        if ecode is not None:
+            fmt = '!%d' + ecode
+            esize = _SCALAR_SIZES[etype]
+            if numpy_arrays and container is list:
+                frombuffer = _numpy().frombuffer
+                dtype = _NUMPY_DTYPES[etype]
+                native_dtype = NUMPY_DTYPES[etype]
+
+                def read_array(data, pos):
+                    _, count = _LIST_HEADER.unpack_from(data, pos)
+                    if count < 0:
+                        _negative_size(count)
+                    pos += 5
+                    end = pos + count * esize
+                    if end > len(data):
+                        raise _Underflow(end)
+                    return frombuffer(data, dtype, count, pos).astype(native_dtype), end
+                return read_array
+
+            def read_scalars(data, pos):
+                _, count = _LIST_HEADER.unpack_from(data, pos)
+                if count < 0:
+                    _negative_size(count)
+                pos += 5
+                end = pos + count * esize
+                if end > len(data):
+                    raise _Underflow(end)
+                return container(struct.unpack_from(fmt % count, data, pos)), end
+            return read_scalars
+        read_elem = _value_reader(etype, espec, numpy_arrays)
+
+        def read_list(data, pos):
+            _, count = _LIST_HEADER.unpack_from(data, pos)
+            if count < 0:
+                _negative_size(count)
+            pos += 5
+            elems = []
+            for _ in range(count):
+                elem, pos = read_elem(data, pos)
+                elems.append(elem)
+            return container(elems), pos
+        return read_list
+
+    if ttype == TType.MAP:
+        ktype, kspec, vtype, vspec, is_immutable = spec_args
+        container = TFrozenDict if is_immutable else dict
+        read_key = _value_reader(ktype, kspec, numpy_arrays)
+        read_val = _value_reader(vtype, vspec, numpy_arrays)
+
+        def read_map(data, pos):
+            _, _, count = _MAP_HEADER.unpack_from(data, pos)
+            if count < 0:
+                _negative_size(count)
+            pos += 6
+            items = []
+            for _ in range(count):
+                key, pos = read_key(data, pos)
+                val, pos = read_val(data, pos)
+                items.append((key, val))
+            return container(items), pos
+        return read_map
+
+    raise TProtocolException(TProtocolException.INVALID_DATA, 'Invalid type %d' % ttype)
+
+
+def struct_decoder(spec, numpy_arrays=False):
+    """Returns decode(data, pos) -> ({field name: value}, position after)."""
+    key = (id(spec), numpy_arrays)
+    cached = _decoders.get(key)
+    if cached is not None and cached[0] is spec:
+        return cached[1]
+    fields = {}
+
+    def decode(data, pos):
+        values = {}
+        while True:
+            ftype = data[pos]
+            if ftype == TType.STOP:
+                return values, pos + 1
+            field = fields.get(_I16.unpack_from(data, pos + 1)[0])
+            pos += 3
+            if field is not None and field[0] == ftype:
+                values[field[1]], pos = field[2](data, pos)
+            else:
+                pos = _skip(data, pos, ftype)
+
+    _decoders[key] = (spec, decode)
+    for field in spec:
+        if field is None:
+            continue
+        fid, ttype, name, spec_args = field[:4]
+        fields[fid] = (ttype, name, _value_reader(ttype, spec_args, numpy_arrays))
+    return decode
+
+
+def decode_binary(obj, iprot, spec_pair):
+    """Reads a struct from the CReadableTransport of `iprot`.
+
+    Fills `obj`, or returns a new instance of the struct class when `obj`
+    is None, as done for immutable structs.
+    """
+    cls, spec = spec_pair
+    decode = struct_decoder(spec, iprot.numpy_arrays)
+    trans = iprot.trans
+    buf = trans.cstringio_buf
+    while True:
+        start = buf.tell()
+        # no copy for the buffer of a frame, see BytesIO.getvalue
+        data = buf.getvalue()
+        try:
+            values, end = decode(data, start)
+            if end > len(data):
+                raise _Underflow(end)
+            break
+        except _Underflow as e:
+            needed = e.end - start
+        except (IndexError, struct.error):
+            needed = len(data) - start + 1
+        buf = trans.cstringio_refill(buf.read(), needed)
+    buf.seek(end)
+    if obj is None:
+        return cls(**values)
+    for name, value in values.items():
+        setattr(obj, name, value)
+    return obj
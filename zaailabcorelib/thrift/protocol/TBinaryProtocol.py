@@ -17,9 +17,13 @@
 # under the License.
 #
 
-from .TProtocol import TType, TProtocolBase, TProtocolException
+from .TProtocol import TType, TProtocolBase, TProtocolException, NUMPY_DTYPES, _numpy, _numbers_array
+from .TBinaryCodec import _SCALAR_CODES, _SCALAR_SIZES
 from struct import pack, unpack
 
+# big-endian numpy dtypes of the numeric types
+_NUMPY_DTYPES = dict((ttype, '>' + dtype) for ttype, dtype in NUMPY_DTYPES.items())
+
 
 class TBinaryProtocol(TProtocolBase):
     """Binary implementation of the Thrift protocol driver."""
@@ -37,7 +41,7 @@ class TBinaryProtocol(TProtocolBase):
     TYPE_MASK = 0x000000ff
 
     def __init__(self, trans, strictRead=False, strictWrite=True, **kwargs):
-        TProtocolBase.__init__(self, trans)
+        TProtocolBase.__init__(self, trans, kwargs.get('numpy_arrays', False))
         self.strictRead = strictRead
         self.strictWrite = strictWrite
         self.string_length_limit = kwargs.get('string_length_limit', None)
@@ -130,6 +134,14 @@ class TBinaryProtocol(TProtocolBase):
         self.writeI32(len(str))
         self.trans.write(str)
 
+    def writeNumbers(self, etype, values):
+        numpy = _numpy()
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            # byte swap of the whole array
+            self.trans.write(_numbers_array(values, _NUMPY_DTYPES[etype]).tobytes())
+        else:
+            self.trans.write(pack('!%d%s' % (len(values), _SCALAR_CODES[etype]), *values))
+
     def readMessageBegin(self):
         sz = self.readI32()
         if sz < 0:
@@ -234,6 +246,12 @@ class TBinaryProtocol(TProtocolBase):
         s = self.trans.readAll(size)
         return s
 
+    def readNumbers(self, etype, size):
+        buff = self.trans.readAll(size * _SCALAR_SIZES[etype])
+        if self.numpy_arrays:
+            return _numpy().frombuffer(buff, dtype=_NUMPY_DTYPES[etype]).astype(NUMPY_DTYPES[etype])
+        return list(unpack('!%d%s' % (size, _SCALAR_CODES[etype]), buff))
+
 
 class TBinaryProtocolFactory(object):
     def __init__(self, strictRead=False, strictWrite=True, **kwargs):
@@ -241,14 +259,30 @@ class TBinaryProtocolFactory(object):
         self.strictWrite = strictWrite
         self.string_length_limit = kwargs.get('string_length_limit', None)
         self.container_length_limit = kwargs.get('container_length_limit', None)
+        self.numpy_arrays = kwargs.get('numpy_arrays', False)
 
     def getProtocol(self, trans):
         prot = TBinaryProtocol(trans, self.strictRead, self.strictWrite,
                                string_length_limit=self.string_length_limit,
-                               container_length_limit=self.container_length_limit)
+                               container_length_limit=self.container_length_limit,
+                               numpy_arrays=self.numpy_arrays)
         return prot
 
 
+_FASTBINARY = []
+
+
+def _fastbinary():
+    """Returns the fastbinary C module, None if it is not installed."""
+    if not _FASTBINARY:
+        try:
+            from thrift.protocol import fastbinary
+        except ImportError:
+            fastbinary = None
+        _FASTBINARY.append(fastbinary)
+    return _FASTBINARY[0]
+
+
 class TBinaryProtocolAccelerated(TBinaryProtocol):
     """C-Accelerated version of TBinaryProtocol.
 
@@ -259,6 +293,8 @@ class TBinaryProtocolAccelerated(TBinaryProtocol):
     encoding can happen if the fastbinary module doesn't work for some
     reason.  (TODO(dreiss): Make this happen sanely in more cases.)
     To disable this behavior, pass fallback=False constructor argument.
+    Without the C module, structs are encoded by the compiled pure-Python
+    codec of TBinaryCodec.
 
     In order to take advantage of the C module, just use
     TBinaryProtocolAccelerated instead of TBinaryProtocol.
@@ -274,28 +310,33 @@ class TBinaryProtocolAccelerated(TBinaryProtocol):
     def __init__(self, *args, **kwargs):
         fallback = kwargs.pop('fallback', True)
         super(TBinaryProtocolAccelerated, self).__init__(*args, **kwargs)
-        try:
-            from thrift.protocol import fastbinary
-        except ImportError:
+        fastbinary = _fastbinary()
+        if fastbinary is None:
             if not fallback:
-                raise
-        else:
-            self._fast_decode = fastbinary.decode_binary
-            self._fast_encode = fastbinary.encode_binary
+                from thrift.protocol import fastbinary  # raises the ImportError
+            # compiled pure-Python codec, it does not enforce length limits
+            if self.string_length_limit is not None or self.container_length_limit is not None:
+                return
+            from . import TBinaryCodec as fastbinary
+        self._fast_decode = fastbinary.decode_binary
+        self._fast_encode = fastbinary.encode_binary
 
 
 class TBinaryProtocolAcceleratedFactory(object):
     def __init__(self,
                  string_length_limit=None,
                  container_length_limit=None,
-                 fallback=True):
+                 fallback=True,
+                 numpy_arrays=False):
         self.string_length_limit = string_length_limit
         self.container_length_limit = container_length_limit
         self._fallback = fallback
+        self.numpy_arrays = numpy_arrays
 
     def getProtocol(self, trans):
         return TBinaryProtocolAccelerated(
             trans,
             string_length_limit=self.string_length_limit,
             container_length_limit=self.container_length_limit,
-            fallback=self._fallback)
+            fallback=self._fallback,
+            numpy_arrays=self.numpy_arrays)
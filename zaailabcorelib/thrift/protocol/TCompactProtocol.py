@@ -17,7 +17,8 @@
 # under the License.
 #
 
-from .TProtocol import TType, TProtocolBase, TProtocolException, checkIntegerLimits
+from .TProtocol import TType, TProtocolBase, TProtocolException, checkIntegerLimits, NUMPY_DTYPES, _numpy, _numbers_array
+from .TBinaryProtocol import _fastbinary
 from struct import pack, unpack
 
 from ..compat import binary_to_str, str_to_binary
@@ -119,6 +120,20 @@ TTYPES[CompactType.FALSE] = TType.BOOL
 del k
 del v
 
+# list elements written without varint, read and written at once
+_FIXED_SIZE_FORMATS = {
+    TType.BYTE: '<%db',
+    TType.DOUBLE: '<%dd',
+}
+_FIXED_SIZES = {
+    TType.BYTE: 1,
+    TType.DOUBLE: 8,
+}
+_FIXED_SIZE_DTYPES = {
+    TType.BYTE: 'i1',
+    TType.DOUBLE: '<f8',
+}
+
 
 class TCompactProtocol(TProtocolBase):
     """Compact implementation of the Thrift protocol driver."""
@@ -132,8 +147,9 @@ class TCompactProtocol(TProtocolBase):
 
     def __init__(self, trans,
                  string_length_limit=None,
-                 container_length_limit=None):
-        TProtocolBase.__init__(self, trans)
+                 container_length_limit=None,
+                 numpy_arrays=False):
+        TProtocolBase.__init__(self, trans, numpy_arrays)
         self.state = CLEAR
         self.__last_fid = 0
         self.__bool_fid = None
@@ -275,6 +291,18 @@ class TCompactProtocol(TProtocolBase):
         self.trans.write(s)
     writeBinary = writer(__writeBinary)
 
+    def writeNumbers(self, etype, values):
+        fmt = _FIXED_SIZE_FORMATS.get(etype)
+        if fmt is None:
+            # varints
+            return TProtocolBase.writeNumbers(self, etype, values)
+        assert self.state == CONTAINER_WRITE, self.state
+        numpy = _numpy()
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            self.trans.write(_numbers_array(values, _FIXED_SIZE_DTYPES[etype]).tobytes())
+        else:
+            self.trans.write(pack(fmt % len(values), *values))
+
     def readFieldBegin(self):
         assert self.state == FIELD_READ, self.state
         type = self.__readUByte()
@@ -412,6 +440,16 @@ class TCompactProtocol(TProtocolBase):
         return self.trans.readAll(size)
     readBinary = reader(__readBinary)
 
+    def readNumbers(self, etype, size):
+        fmt = _FIXED_SIZE_FORMATS.get(etype)
+        if fmt is None:
+            return TProtocolBase.readNumbers(self, etype, size)
+        assert self.state == CONTAINER_READ, self.state
+        buff = self.trans.readAll(size * _FIXED_SIZES[etype])
+        if self.numpy_arrays:
+            return _numpy().frombuffer(buff, dtype=_FIXED_SIZE_DTYPES[etype]).astype(NUMPY_DTYPES[etype])
+        return list(unpack(fmt % size, buff))
+
     def __getTType(self, byte):
         return TTYPES[byte & 0x0f]
 
@@ -419,14 +457,17 @@ class TCompactProtocol(TProtocolBase):
 class TCompactProtocolFactory(object):
     def __init__(self,
                  string_length_limit=None,
-                 container_length_limit=None):
+                 container_length_limit=None,
+                 numpy_arrays=False):
         self.string_length_limit = string_length_limit
         self.container_length_limit = container_length_limit
+        self.numpy_arrays = numpy_arrays
 
     def getProtocol(self, trans):
         return TCompactProtocol(trans,
                                 self.string_length_limit,
-                                self.container_length_limit)
+                                self.container_length_limit,
+                                self.numpy_arrays)
 
 
 class TCompactProtocolAccelerated(TCompactProtocol):
@@ -448,28 +489,30 @@ class TCompactProtocolAccelerated(TCompactProtocol):
     def __init__(self, *args, **kwargs):
         fallback = kwargs.pop('fallback', True)
         super(TCompactProtocolAccelerated, self).__init__(*args, **kwargs)
-        try:
-            from thrift.protocol import fastbinary
-        except ImportError:
+        fastbinary = _fastbinary()
+        if fastbinary is None:
             if not fallback:
-                raise
-        else:
-            self._fast_decode = fastbinary.decode_compact
-            self._fast_encode = fastbinary.encode_compact
+                from thrift.protocol import fastbinary  # raises the ImportError
+            return
+        self._fast_decode = fastbinary.decode_compact
+        self._fast_encode = fastbinary.encode_compact
 
 
 class TCompactProtocolAcceleratedFactory(object):
     def __init__(self,
                  string_length_limit=None,
                  container_length_limit=None,
-                 fallback=True):
+                 fallback=True,
+                 numpy_arrays=False):
         self.string_length_limit = string_length_limit
         self.container_length_limit = container_length_limit
         self._fallback = fallback
+        self.numpy_arrays = numpy_arrays
 
     def getProtocol(self, trans):
         return TCompactProtocolAccelerated(
             trans,
             string_length_limit=self.string_length_limit,
             container_length_limit=self.container_length_limit,
-            fallback=self._fallback)
+            fallback=self._fallback,
+            numpy_arrays=self.numpy_arrays)
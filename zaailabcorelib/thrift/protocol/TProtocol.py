@@ -43,13 +43,62 @@ class TProtocolException(TException):
         self.type = type
 
 
+# list elements read and written at once by readNumbers() and writeNumbers()
+NUMERIC_TTYPES = frozenset((TType.BOOL, TType.BYTE, TType.I16, TType.I32, TType.I64, TType.DOUBLE))
+
+# native numpy dtypes of the numeric types
+NUMPY_DTYPES = {
+    TType.BOOL: '?',
+    TType.BYTE: 'i1',
+    TType.I16: 'i2',
+    TType.I32: 'i4',
+    TType.I64: 'i8',
+    TType.DOUBLE: 'f8',
+}
+
+_NUMPY = []
+
+
+def _numpy():
+    """Returns the numpy module, None if it is not installed."""
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+
+def _numbers_array(values, dtype):
+    """Returns the numpy array `values` as `dtype`, to write as a list.
+
+    Only 1-D arrays are lists, and casts must keep the kind of the values,
+    as struct.pack() would refuse to write 1.7 as an i32.
+    """
+    if values.ndim != 1:
+        raise TProtocolException(TProtocolException.INVALID_DATA,
+                                 'Expected a 1-D array for a list, got shape %s' % (values.shape,))
+    if not _numpy().can_cast(values.dtype, dtype, 'same_kind'):
+        raise TProtocolException(TProtocolException.INVALID_DATA,
+                                 'Can not write a %s array as %s' % (values.dtype, dtype))
+    return values.astype(dtype, copy=False)
+
+
 class TProtocolBase(object):
-    """Base class for Thrift protocol driver."""
+    """Base class for Thrift protocol driver.
+
+    With numpy_arrays, the lists of numbers read by readContainerList()
+    are numpy arrays instead of lists.
+    """
 
-    def __init__(self, trans):
+    def __init__(self, trans, numpy_arrays=False):
         self.trans = trans
         self._fast_decode = None
         self._fast_encode = None
+        if numpy_arrays and _numpy() is None:
+            import numpy  # noqa, raises the ImportError
+        self.numpy_arrays = numpy_arrays
 
     @staticmethod
     def _check_length(limit, length):
@@ -189,6 +238,23 @@ class TProtocolBase(object):
     def readUtf8(self):
         return self.readString().decode('utf8')
 
+    def writeNumbers(self, etype, values):
+        """Writes the elements of a list of NUMERIC_TTYPES, after writeListBegin()."""
+        writer = getattr(self, self._TTYPE_HANDLERS[etype][1])
+        for value in values:
+            writer(value)
+
+    def readNumbers(self, etype, size):
+        """Reads `size` elements of a list of NUMERIC_TTYPES.
+
+        Returns a list, or a numpy array with numpy_arrays.
+        """
+        reader = getattr(self, self._TTYPE_HANDLERS[etype][0])
+        values = [reader() for _ in range(size)]
+        if self.numpy_arrays:
+            return _numpy().array(values, dtype=NUMPY_DTYPES[etype])
+        return values
+
     def skip(self, ttype):
         if ttype == TType.STOP:
             return
@@ -283,6 +349,13 @@ class TProtocolBase(object):
     def readContainerList(self, spec):
         ttype, tspec, is_immutable = spec
         (list_type, list_len) = self.readListBegin()
+        if list_type == ttype and ttype in NUMERIC_TTYPES:
+            results = self.readNumbers(ttype, list_len)
+            if is_immutable:
+                # numpy arrays are not hashable
+                results = tuple(results.tolist() if self.numpy_arrays else results)
+            self.readListEnd()
+            return results
         # TODO: compare types we just decoded with thrift_spec
         elems = islice(self._read_by_ttype(ttype, spec, tspec), list_len)
         results = (tuple if is_immutable else list)(elems)
@@ -350,8 +423,11 @@ class TProtocolBase(object):
     def writeContainerList(self, val, spec):
         ttype, tspec, _ = spec
         self.writeListBegin(ttype, len(val))
-        for _ in self._write_by_ttype(ttype, val, spec, tspec):
-            pass
+        if ttype in NUMERIC_TTYPES:
+            self.writeNumbers(ttype, val)
+        else:
+            for _ in self._write_by_ttype(ttype, val, spec, tspec):
+                pass
         self.writeListEnd()
 
     def writeContainerSet(self, val, spec):
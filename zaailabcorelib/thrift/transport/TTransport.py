@@ -17,7 +17,11 @@
 # under the License.
 #
 
+from abc import ABCMeta
 from struct import pack, unpack
+
+import six
+
 from thrift.Thrift import TException
 from ..compat import BufferIO
 
@@ -75,9 +79,19 @@ class TTransportBase(object):
 
 
 # This class should be thought of as an interface.
+@six.add_metaclass(ABCMeta)
 class CReadableTransport(object):
     """base class for transports that are readable from C"""
 
+    @classmethod
+    def __subclasshook__(cls, klass):
+        # this package is imported both as thrift and zaailabcorelib.thrift,
+        # the transports of one copy must take the fast path of the other
+        if cls is CReadableTransport:
+            if any(base.__name__ == 'CReadableTransport' for base in klass.__mro__):
+                return True
+        return NotImplemented
+
     # TODO(dreiss): Think about changing this interface to allow us to use
     #               a (Python, not c) StringIO instead, because it allows
     #               you to write after reading.
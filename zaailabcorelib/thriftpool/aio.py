@@ -0,0 +1,255 @@
+import asyncio
+import inspect
+import itertools
+import struct
+
+from zaailabcorelib.thrift.transport import TTransport
+from zaailabcorelib.thrift.protocol import TBinaryProtocol
+from .retry import ExponentialBackoff
+
+"""
+    asyncio counterpart of `Client`: framed binary thrift over asyncio streams.
+
+    Requests are multiplexed by seqid over a few pooled connections, so many
+    coroutines can wait on the same server without a thread or a socket each.
+    The server must answer with the seqid of the request, which every thrift
+    server does.
+"""
+
+__all__ = ['AsyncConnection', 'AsyncConnectionPool', 'AsyncClient']
+
+_FRAME_HEADER = struct.Struct('!i')
+
+
+class AsyncConnection(object):
+    """One framed connection with any number of requests in flight."""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._seqids = itertools.count(1)
+        self._pending = {}
+        self._closed = False
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def open(cls, host, port, timeout=None):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise TTransport.TTransportException(
+                TTransport.TTransportException.NOT_OPEN,
+                'Could not connect to %s:%s: %s' % (host, port, e))
+        return cls(reader, writer)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    def next_seqid(self):
+        # seqids are signed i32 on the wire
+        return next(self._seqids) & 0x7fffffff
+
+    async def request(self, seqid, payload, oneway=False):
+        """Sends an encoded request, returns the frame of its answer."""
+        if self._closed:
+            raise TTransport.TTransportException(
+                TTransport.TTransportException.NOT_OPEN, 'connection closed')
+        future = None
+        if not oneway:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[seqid] = future
+        try:
+            self._writer.write(_FRAME_HEADER.pack(len(payload)) + payload)
+            await self._writer.drain()
+        except (OSError, RuntimeError) as e:
+            self._fail(e)
+        if future is None:
+            return None
+        try:
+            return await future
+        finally:
+            self._pending.pop(seqid, None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(_FRAME_HEADER.size)
+                frame = await self._reader.readexactly(_FRAME_HEADER.unpack(header)[0])
+                iprot = TBinaryProtocol.TBinaryProtocol(TTransport.TMemoryBuffer(frame))
+                _, _, seqid = iprot.readMessageBegin()
+                future = self._pending.get(seqid)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except asyncio.CancelledError:
+            self._fail(None)
+            raise
+        except Exception as e:
+            self._fail(e)
+
+    def _fail(self, error):
+        """Closes the connection and fails the requests waiting on it."""
+        if self._closed:
+            return
+        self._closed = True
+        self._writer.close()
+        exc = TTransport.TTransportException(
+            TTransport.TTransportException.END_OF_FILE,
+            'connection lost: %r' % (error,))
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
+
+    def close(self):
+        self._fail(None)
+        self._reader_task.cancel()
+
+
+class AsyncConnectionPool(object):
+    """Up to `size` connections to `host:port` shared by all callers.
+
+    A request goes to the connection with the fewest requests in flight; a
+    new connection is opened while all of them have `max_pending` or more.
+    """
+
+    DEFAULT_POOL_SIZE = 4
+    DEFAULT_MAX_PENDING = 32
+
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE, max_pending=DEFAULT_MAX_PENDING,
+                 connect_timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_pending = max_pending
+        self.connect_timeout = connect_timeout
+        self._connections = []
+        self._connecting = None
+        self._closed = False
+
+    async def get_connection(self):
+        if self._closed:
+            raise RuntimeError('connection pool closed')
+        self._connections = [c for c in self._connections if not c.closed]
+        best = min(self._connections, key=lambda c: c.num_pending, default=None)
+        if best is not None and (best.num_pending < self.max_pending
+                                 or len(self._connections) >= self.size):
+            return best
+        # one connect at a time, concurrent callers share its result
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(
+                AsyncConnection.open(self.host, self.port, self.connect_timeout))
+        connecting = self._connecting
+        try:
+            conn = await asyncio.shield(connecting)
+        except asyncio.CancelledError:
+            if not connecting.cancelled():
+                raise
+            # cancelled by close()
+            raise RuntimeError('connection pool closed')
+        finally:
+            if self._connecting is connecting and connecting.done():
+                self._connecting = None
+        if self._closed:
+            conn.close()
+            raise RuntimeError('connection pool closed')
+        if conn not in self._connections:
+            self._connections.append(conn)
+        return conn
+
+    def close(self):
+        self._closed = True
+        if self._connecting is not None:
+            self._connecting.cancel()
+            self._connecting = None
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+
+
+class AsyncClient(object):
+    """
+        Thrift Client proxying thrift methods defined on `iface_cls` as coroutines
+
+        Params:
+            iface_cls       : thrift generated Client class
+            host            : thrift server hostname
+            port            : thirft server port
+            pool_size       : number of maximum connections in pool
+            max_pending     : requests in flight per connection before opening another
+            retries         : number of retries in case network errors occur
+                              (default: 3)
+            timeout         : per call timeout in seconds (default: None, disabled)
+            backoff         : ExponentialBackoff before each retry, True creates
+                              one (default: None, retries are immediate)
+    """
+
+    def __init__(self, iface_cls, host, port,
+                 pool_size=AsyncConnectionPool.DEFAULT_POOL_SIZE,
+                 max_pending=AsyncConnectionPool.DEFAULT_MAX_PENDING,
+                 retries=3,
+                 timeout=None,
+                 backoff=None):
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = ExponentialBackoff() if backoff is True else backoff
+        self._iface_cls = iface_cls
+        self._connection_pool = AsyncConnectionPool(host, port, size=pool_size, max_pending=max_pending,
+                                                    connect_timeout=timeout)
+        # inject all methods defined in the thrift Iface class
+        for name, _ in inspect.getmembers(self._iface_cls, predicate=inspect.isfunction):
+            if hasattr(self._iface_cls, 'send_' + name):
+                setattr(self, name, self.__create_thrift_proxy__(name))
+
+    def close(self):
+        self._connection_pool.close()
+
+    def __create_thrift_proxy__(self, methodName):
+        async def __thrift_proxy(*args):
+            return await self.__thrift_call__(methodName, *args)
+        __thrift_proxy.__name__ = methodName
+        return __thrift_proxy
+
+    def _encode(self, method, seqid, args):
+        otrans = TTransport.TMemoryBuffer()
+        client = self._iface_cls(TBinaryProtocol.TBinaryProtocol(otrans))
+        client._seqid = seqid
+        getattr(client, 'send_' + method)(*args)
+        return otrans.getvalue()
+
+    def _decode(self, method, frame):
+        client = self._iface_cls(TBinaryProtocol.TBinaryProtocol(TTransport.TMemoryBuffer(frame)))
+        return getattr(client, 'recv_' + method)()
+
+    async def __thrift_call__(self, method, *args):
+        oneway = not hasattr(self._iface_cls, 'recv_' + method)
+        attempt = 0
+        while True:
+            try:
+                conn = await self._connection_pool.get_connection()
+                seqid = conn.next_seqid()
+                frame = await asyncio.wait_for(
+                    conn.request(seqid, self._encode(method, seqid, args), oneway),
+                    self.timeout)
+            except TTransport.TTransportException:
+                if attempt >= self.retries:
+                    raise
+                if self.backoff:
+                    await asyncio.sleep(self.backoff.delay(attempt))
+                attempt += 1
+                continue
+            except asyncio.TimeoutError:
+                # the answer may still come, the connection stays usable
+                raise TTransport.TTransportException(
+                    TTransport.TTransportException.TIMED_OUT,
+                    '%s timed out after %ss' % (method, self.timeout))
+            if oneway:
+                return None
+            return self._decode(method, frame)
@@ -1,8 +1,16 @@
+import collections
 import operator
 import inspect
+import logging
+import select
+import threading
+import time
 
-from thrift.transport import TTransport
+from zaailabcorelib.thrift.transport import TTransport
 from ..thriftpool.pool import ConnectionPool
+from ..thriftpool.metrics import ClientMetrics
+from ..thriftpool.retry import (RetryBudget, ExponentialBackoff, CircuitBreaker, CircuitOpenError,
+                                remaining_time)
 
 """
     Thrift Client proxying thrift methods defined on `iface_cls`
@@ -21,9 +29,86 @@ from ..thriftpool.pool import ConnectionPool
                           (default: 3)
         network_timeout : thrift socket timeout in millis
                           (default: 0, disabled)
+        timeout         : timeout of each attempt in seconds
+                          (default: None, network_timeout applies)
+        call_timeout    : deadline of a call in seconds, retries included,
+                          see also `retry.deadline` (default: None, disabled)
+        retry_budget    : RetryBudget, may be shared by several clients,
+                          True creates one (default: None, disabled)
+        backoff         : ExponentialBackoff before each retry, True creates
+                          one (default: None, retries are immediate)
+        circuit_breaker : CircuitBreaker failing calls fast while the server
+                          is down, True creates one (default: None, disabled)
+        hooks           : CallHook instances called around every call
+        metrics         : ClientMetrics recording calls and pool usage,
+                          True creates one (default: None, disabled)
         debug           : Enable thrift calls debugging
+        pool_kwargs     : passed to ConnectionPool, e.g. max_idle_time,
+                          max_lifetime, min_idle, check_on_checkout,
+                          transport_factory, protocol_factory,
+                          tcp_nodelay, keepalive
+
+    Bulk calls are pipelined with `map(method, iterable_of_args)` or
+    `batch()`: up to `window` requests, and `window_bytes` of them, are in
+    flight on each of `concurrency` connections and results come back in
+    order.
 
 """
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAP_CONCURRENCY = 4
+DEFAULT_MAP_WINDOW = 64
+# below the socket buffers of both ends, so that sending never blocks while
+# the server blocks sending answers nobody reads
+DEFAULT_MAP_WINDOW_BYTES = 64 * 1024
+
+
+def _run_threads(funcs):
+    threads = [threading.Thread(target=f, daemon=True) for f in funcs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def _readable(sock):
+    """Tells if data waits to be read on the TSocket `sock`."""
+    handle = sock.handle
+    return handle is not None and bool(select.select([handle], [], [], 0)[0])
+
+
+class Batch(object):
+    """Calls recorded through the thrift proxies of a Client, sent at once.
+
+        batch = client.batch()
+        batch.pong(1)
+        batch.pong(2)
+        results = batch.execute()
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self._client._iface_cls, 'send_' + name):
+            raise AttributeError(name)
+
+        def __record(*args):
+            self._calls.append((name, args))
+        return __record
+
+    def execute(self, concurrency=DEFAULT_MAP_CONCURRENCY, window=DEFAULT_MAP_WINDOW,
+                return_exceptions=False, window_bytes=DEFAULT_MAP_WINDOW_BYTES):
+        """Pipelines the recorded calls, returns their results in order."""
+        calls, self._calls = self._calls, []
+        return self._client._pipeline(calls, concurrency, window, return_exceptions, window_bytes)
+
+
 class Client(object):
     def __init__(self, iface_cls,
                  host, port,
@@ -31,49 +116,356 @@ class Client(object):
                  retries = 3,
                  asyn = False,
                  network_timeout = ConnectionPool.DEFAULT_NETWORK_TIMEOUT,
-                 debug = False):
+                 debug = False,
+                 timeout = None,
+                 call_timeout = None,
+                 retry_budget = None,
+                 backoff = None,
+                 circuit_breaker = None,
+                 hooks = None,
+                 metrics = None,
+                 **pool_kwargs):
         self.host = host
         self.port = port
         self.debug = debug
         self.retries = retries
-        self._connection_pool = ConnectionPool(host, port, iface_cls, asyn=asyn, size=pool_size, network_timeout=network_timeout)
+        self.timeout = timeout
+        self.call_timeout = call_timeout
+        self.retry_budget = RetryBudget() if retry_budget is True else retry_budget
+        self.backoff = ExponentialBackoff() if backoff is True else backoff
+        self.circuit_breaker = CircuitBreaker() if circuit_breaker is True else circuit_breaker
+        if asyn:
+            import gevent
+            self._sleep = gevent.sleep
+            self._run_all = lambda funcs: gevent.joinall([gevent.spawn(f) for f in funcs])
+        else:
+            self._sleep = time.sleep
+            self._run_all = _run_threads
+        self._connection_pool = ConnectionPool(host, port, iface_cls, asyn=asyn, size=pool_size,
+                                               network_timeout=network_timeout, **pool_kwargs)
         self._iface_cls = iface_cls
+        self.hooks = list(hooks or [])
+        self.metrics = ClientMetrics() if metrics is True else metrics
+        if self.metrics:
+            self.metrics.watch_pool(self._connection_pool)
+            self.hooks.append(self.metrics)
         #inject all methods defined in the thrift Iface class
-        for m in inspect.getmembers(self._iface_cls,predicate = lambda x: inspect.isfunction(x) or inspect.ismethod(x)):
+        for m in inspect.getmembers(self._iface_cls, predicate=lambda x: (
+                inspect.isfunction(x) or inspect.ismethod(x))):
         # for m in inspect.getmembers(self._iface_cls, predicate=inspect.ismethod):
             setattr(self, m[0], self.__create_thrift_proxy__(m[0]))
 
     def close(self):
         self._connection_pool.close()
 
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _before_call(self, method, args):
+        for hook in self.hooks:
+            hook.before_call(method, args)
+
+    def _after_call(self, method, args, result, error, latency):
+        for hook in self.hooks:
+            try:
+                hook.after_call(method, args, result, error, latency)
+            except Exception:
+                logger.exception('call hook %r failed', hook)
+
+    def batch(self):
+        """Returns a Batch collecting calls to pipeline with execute()."""
+        return Batch(self)
+
+    def map(self, method, iterable_of_args, concurrency=DEFAULT_MAP_CONCURRENCY,
+            window=DEFAULT_MAP_WINDOW, return_exceptions=False,
+            window_bytes=DEFAULT_MAP_WINDOW_BYTES):
+        """Calls `method` with each tuple of args, returns the results in order.
+
+        Requests are pipelined: each of `concurrency` pooled connections
+        keeps up to `window` requests, and at most `window_bytes` of them,
+        in flight instead of waiting for every answer. The first exception
+        raised by a call is raised once all calls are done, unless
+        `return_exceptions` which puts exceptions in the results. Requests
+        left unanswered by a broken connection are sent again on a new one,
+        within the retry policy of the client.
+        """
+        calls = [(method, tuple(args)) for args in iterable_of_args]
+        return self._pipeline(calls, concurrency, window, return_exceptions, window_bytes)
+
+    def _pipeline(self, calls, concurrency, window, return_exceptions,
+                  window_bytes=DEFAULT_MAP_WINDOW_BYTES):
+        results = [None] * len(calls)
+        if not calls:
+            return results
+        for method, args in calls:
+            self._before_call(method, args)
+        # first time each call was sent and time of its answer
+        sent_at = [None] * len(calls)
+        answered_at = [None] * len(calls)
+        started = time.time()
+        deadline = self._deadline()
+        if self.retry_budget:
+            for _ in calls:
+                self.retry_budget.deposit()
+        # indexes of the calls to send, the ones to send again go first
+        todo = collections.deque(range(len(calls)))
+        lock = threading.Lock()
+        state = {'attempt': 0, 'error': None}
+
+        def take():
+            with lock:
+                if state['error'] is not None or not todo:
+                    return None
+                return todo.popleft()
+
+        def fail(e):
+            with lock:
+                state['error'] = state['error'] or e
+
+        def should_retry(e):
+            if self.circuit_breaker:
+                self.circuit_breaker.on_failure()
+            with lock:
+                attempt = state['attempt']
+                state['attempt'] += 1
+            if self._can_retry(attempt, deadline):
+                return True
+            fail(e)
+            return False
+
+        def worker():
+            while True:
+                with lock:
+                    if state['error'] is not None or not todo:
+                        return
+                try:
+                    timeout = self._attempt_timeout(deadline)
+                    if self.circuit_breaker and not self.circuit_breaker.allow():
+                        raise CircuitOpenError('circuit open to %s:%s' % (self.host, self.port))
+                except Exception as e:
+                    fail(e)
+                    return
+                try:
+                    if not attempt(timeout):
+                        return
+                except Exception as e:
+                    fail(e)
+                    return
+                finally:
+                    if self.circuit_breaker:
+                        self.circuit_breaker.release()
+
+        def attempt(timeout):
+            """Pipelines calls on one connection, True to try again."""
+            try:
+                conn = self._connection_pool.get_connection()
+            except (TTransport.TTransportException, OSError) as e:
+                return should_retry(e)
+            pending = collections.deque()
+            try:
+                self._set_timeout(conn, timeout)
+                self._pipeline_connection(conn, calls, results, take, pending, window, window_bytes,
+                                          sent_at, answered_at)
+            except (TTransport.TTransportException, OSError) as e:
+                #broken connection, send its unanswered calls again
+                self._connection_pool.release_conn(conn)
+                with lock:
+                    todo.extendleft(reversed(pending))
+                return should_retry(e)
+            self._set_timeout(conn, None)
+            self._connection_pool.return_connection(conn)
+            if self.circuit_breaker:
+                self.circuit_breaker.on_success()
+            return False
+
+        concurrency = max(1, min(concurrency, len(calls)))
+        if concurrency == 1:
+            worker()
+        else:
+            self._run_all([worker] * concurrency)
+        if self.hooks:
+            ended = time.time()
+            for idx, (method, args) in enumerate(calls):
+                result, error = results[idx], state['error']
+                if answered_at[idx] is not None:
+                    error = result if isinstance(result, Exception) else None
+                    result = None if error is not None else result
+                self._after_call(method, args, result, error,
+                                 (answered_at[idx] or ended) - (sent_at[idx] or started))
+        if state['error'] is not None:
+            raise state['error']
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def _pipeline_connection(self, conn, calls, results, take, pending, window, window_bytes,
+                             sent_at, answered_at):
+        """Sends calls taken from `take` on `conn`, `window` at a time.
+
+        `pending` holds the indexes of the calls sent and not answered yet,
+        answers come in the order of the requests. Answers already received
+        are read between two requests, and no request is sent once
+        `window_bytes` are in flight: a server answering in order may block
+        writing answers until they are read, this thread must not block
+        writing requests meanwhile.
+        """
+        info = getattr(conn, '_pool_info', None)
+        sock = info.socket if info is not None else None
+        # bytes sent for each pending call
+        sizes = collections.deque()
+        in_flight = [0]
+
+        def read_answer():
+            idx = pending[0]
+            try:
+                results[idx] = getattr(conn, 'recv_' + calls[idx][0])()
+            except (TTransport.TTransportException, OSError):
+                raise
+            except Exception as e:
+                #data exceptions, the answer was read entirely
+                results[idx] = e
+            answered_at[idx] = time.time()
+            pending.popleft()
+            in_flight[0] -= sizes.popleft()
+
+        while True:
+            while len(pending) < window and (not pending or in_flight[0] < window_bytes):
+                idx = take()
+                if idx is None:
+                    break
+                method, args = calls[idx]
+                if self.debug:
+                    print ("Thrift Call:%s Args:%s" % (method, args))
+                conn._seqid = idx
+                if sent_at[idx] is None:
+                    sent_at[idx] = time.time()
+                sent = sock.bytes_sent if sock is not None else 0
+                getattr(conn, 'send_' + method)(*args)
+                if hasattr(conn, 'recv_' + method):
+                    pending.append(idx)
+                    size = sock.bytes_sent - sent if sock is not None else 0
+                    sizes.append(size)
+                    in_flight[0] += size
+                else:
+                    answered_at[idx] = sent_at[idx]
+                while pending and sock is not None and _readable(sock):
+                    read_answer()
+            if not pending:
+                return
+            read_answer()
+
 
     def __create_thrift_proxy__(self, methodName):
         def __thrift_proxy(*args):
             return self.__thrift_call__(methodName, *args)
         return __thrift_proxy
 
+    def _attempt_timeout(self, deadline):
+        """Socket timeout in millis of the next attempt, None if unbounded."""
+        timeout = self.timeout
+        if deadline is not None:
+            left = deadline - time.time()
+            if left <= 0:
+                raise TTransport.TTransportException(
+                    TTransport.TTransportException.TIMED_OUT, 'deadline exceeded')
+            timeout = left if timeout is None else min(timeout, left)
+        return None if timeout is None else timeout * 1000
+
+    def _set_timeout(self, conn, ms):
+        info = getattr(conn, '_pool_info', None)
+        if info is None:
+            return
+        if ms is None:
+            network_timeout = self._connection_pool.network_timeout
+            ms = network_timeout if network_timeout > 0 else None
+        info.socket.setTimeout(ms)
+
+    def _deadline(self):
+        deadlines = []
+        if self.call_timeout is not None:
+            deadlines.append(time.time() + self.call_timeout)
+        left = remaining_time()
+        if left is not None:
+            deadlines.append(time.time() + left)
+        return min(deadlines) if deadlines else None
+
+    def _can_retry(self, attempt, deadline):
+        """Sleeps the backoff of `attempt` and tells if a retry may follow."""
+        if attempt >= self.retries:
+            return False
+        if self.retry_budget and not self.retry_budget.try_withdraw():
+            return False
+        delay = self.backoff.delay(attempt) if self.backoff else 0
+        if deadline is not None and time.time() + delay >= deadline:
+            return False
+        if delay > 0:
+            self._sleep(delay)
+        return True
+
     def __thrift_call__(self, method, *args):
-        attempts_left = self.retries #self._connection_pool.size + 1
+        if not self.hooks:
+            return self._call(method, *args)
+        self._before_call(method, args)
+        started = time.time()
+        try:
+            result = self._call(method, *args)
+        except Exception as e:
+            self._after_call(method, args, None, e, time.time() - started)
+            raise
+        self._after_call(method, args, result, None, time.time() - started)
+        return result
+
+    def _call(self, method, *args):
+        deadline = self._deadline()
+        if self.retry_budget:
+            self.retry_budget.deposit()
+        attempt = 0
         result = None
         while True:
-            conn = self._connection_pool.get_connection()
+            timeout = self._attempt_timeout(deadline)
+            if self.circuit_breaker and not self.circuit_breaker.allow():
+                raise CircuitOpenError('circuit open to %s:%s' % (self.host, self.port))
             try:
-                if self.debug:
-                    print ("Thrift Call:%s Args:%s" % (method, args))
-                result = getattr(conn, method)(*args)
-            except TTransport.TTransportException as e:
-                #broken connection, release it
-                self._connection_pool.release_conn(conn)
-                if attempts_left > 0:
-                    attempts_left -= 1
-                    continue
-                raise e
-            except Exception as e:
-                #data exceptions, return connection and don't retry
-                self._connection_pool.return_connection(conn)
-                raise
-
-            #call completed succesfully, return connection to pool
-            self._connection_pool.return_connection(conn)
-            return result
+                try:
+                    conn = self._connection_pool.get_connection()
+                except (TTransport.TTransportException, OSError):
+                    if self.circuit_breaker:
+                        self.circuit_breaker.on_failure()
+                    if self._can_retry(attempt, deadline):
+                        attempt += 1
+                        continue
+                    raise
+                try:
+                    if self.debug:
+                        print ("Thrift Call:%s Args:%s" % (method, args))
+                    self._set_timeout(conn, timeout)
+                    result = getattr(conn, method)(*args)
+                except (TTransport.TTransportException, OSError) as e:
+                    #broken connection or timeout, release it
+                    self._connection_pool.release_conn(conn)
+                    if self.circuit_breaker:
+                        self.circuit_breaker.on_failure()
+                    if self._can_retry(attempt, deadline):
+                        attempt += 1
+                        continue
+                    raise e
+                except Exception as e:
+                    #data exceptions, return connection and don't retry
+                    self._set_timeout(conn, None)
+                    self._connection_pool.return_connection(conn, error=True)
+                    if self.circuit_breaker:
+                        self.circuit_breaker.on_success()
+                    raise
 
+                #call completed succesfully, return connection to pool
+                self._set_timeout(conn, None)
+                self._connection_pool.return_connection(conn)
+                if self.circuit_breaker:
+                    self.circuit_breaker.on_success()
+                return result
+            finally:
+                #a trial call of a half open circuit that ended any other way
+                if self.circuit_breaker:
+                    self.circuit_breaker.release()
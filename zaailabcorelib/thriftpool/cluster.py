@@ -0,0 +1,268 @@
+import collections
+import inspect
+import logging
+import threading
+import time
+from concurrent import futures
+
+from zaailabcorelib.thrift.transport import TTransport
+from ..thriftpool.pool import ConnectionPool
+from ..zdispatch.dispatch_policy import WorkerLoad, get_dispatch_policy
+
+"""
+    Thrift Client load balancing thrift methods defined on `iface_cls`
+    over several servers, each with its own pool of persistent connections
+
+    Params:
+        iface_cls       : thrift generated Client class
+        endpoints       : list of `(host, port)` tuples or "host:port" strings
+        policy          : endpoint selection, 'least_outstanding' or
+                          'p2c_ewma' (latency aware power of two choices),
+                          any name or instance accepted by get_dispatch_policy
+                          (default: 'least_outstanding')
+        asyn            : socket mode, see Client
+        pool_size       : number of maximum connections in pool, per endpoint
+                          (default: 100)
+        retries         : number of retries on another endpoint in case
+                          network errors occur (default: 3)
+        network_timeout : thrift socket timeout in millis
+                          (default: 0, disabled)
+        eject_after     : consecutive transport errors before an endpoint is
+                          ejected (default: 5)
+        eject_backoff   : seconds an endpoint stays ejected, doubled each
+                          time it fails again once back (default: 1)
+        max_eject_backoff : upper bound of eject_backoff (default: 60)
+        hedge_percentile : when set, e.g. 0.95, a call still running after
+                          this percentile of the recent latencies is sent
+                          to a second endpoint as well, the first answer
+                          wins (default: None, disabled)
+        hedge_workers   : threads running hedged calls (default: 32)
+        debug           : Enable thrift calls debugging
+        pool_kwargs     : passed to every ConnectionPool
+
+    If all endpoints are ejected they are all used again rather than
+    failing every call.
+"""
+
+logger = logging.getLogger(__name__)
+
+# latencies kept to compute the hedging deadline
+HEDGE_WINDOW = 1000
+# no hedging before this many calls completed
+HEDGE_MIN_SAMPLES = 20
+
+
+class Endpoint(object):
+    """A server of the cluster and its health."""
+
+    def __init__(self, host, port, pool):
+        self.host = host
+        self.port = port
+        self.pool = pool
+        self.consecutive_errors = 0
+        self.num_ejections = 0
+        self.ejected_until = 0.0
+
+    @property
+    def ejected(self):
+        return self.ejected_until > time.time()
+
+    def __repr__(self):
+        return 'Endpoint(%s:%s)' % (self.host, self.port)
+
+
+class _Candidates(object):
+    """The load of a subset of endpoints, as seen by a DispatchPolicy."""
+
+    def __init__(self, load, indexes):
+        self.indexes = indexes
+        self.in_flight = [load.in_flight[i] for i in indexes]
+        self.ewma_latency = [load.ewma_latency[i] for i in indexes]
+
+    def __len__(self):
+        return len(self.indexes)
+
+
+def _parse_endpoint(endpoint):
+    if isinstance(endpoint, str):
+        host, _, port = endpoint.rpartition(':')
+        return host, int(port)
+    host, port = endpoint
+    return host, int(port)
+
+
+class ClusterClient(object):
+    def __init__(self, iface_cls, endpoints,
+                 policy='least_outstanding',
+                 asyn=False,
+                 pool_size=ConnectionPool.DEFAULT_POOL_SIZE,
+                 retries=3,
+                 network_timeout=ConnectionPool.DEFAULT_NETWORK_TIMEOUT,
+                 eject_after=5,
+                 eject_backoff=1.0,
+                 max_eject_backoff=60.0,
+                 hedge_percentile=None,
+                 hedge_workers=32,
+                 debug=False,
+                 **pool_kwargs):
+        if not endpoints:
+            raise ValueError('at least one endpoint is required')
+        self.debug = debug
+        self.retries = retries
+        self.eject_after = eject_after
+        self.eject_backoff = eject_backoff
+        self.max_eject_backoff = max_eject_backoff
+        self.hedge_percentile = hedge_percentile
+        self.num_hedged = 0
+        self.endpoints = []
+        for endpoint in endpoints:
+            host, port = _parse_endpoint(endpoint)
+            pool = ConnectionPool(host, port, iface_cls, asyn=asyn, size=pool_size,
+                                  network_timeout=network_timeout, **pool_kwargs)
+            self.endpoints.append(Endpoint(host, port, pool))
+        self.load = WorkerLoad(len(self.endpoints))
+        self._policy = get_dispatch_policy(policy)
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=HEDGE_WINDOW)
+        self._executor = None
+        if hedge_percentile is not None:
+            assert 0 < hedge_percentile < 1
+            self._executor = futures.ThreadPoolExecutor(max_workers=hedge_workers)
+        self._iface_cls = iface_cls
+        #inject all methods defined in the thrift Iface class
+        for m in inspect.getmembers(self._iface_cls, predicate=lambda x: inspect.isfunction(x) or inspect.ismethod(x)):
+            setattr(self, m[0], self.__create_thrift_proxy__(m[0]))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for endpoint in self.endpoints:
+            endpoint.pool.close()
+
+    def stats(self):
+        load = self.load.stats()
+        for i, endpoint in enumerate(self.endpoints):
+            load[i].update(host=endpoint.host, port=endpoint.port,
+                           ejected=endpoint.ejected,
+                           consecutive_errors=endpoint.consecutive_errors,
+                           num_ejections=endpoint.num_ejections)
+        return {'endpoints': load, 'hedged': self.num_hedged}
+
+    def _choose(self, exclude=()):
+        """Returns the index of the endpoint of the next call, or None."""
+        indexes = [i for i, e in enumerate(self.endpoints) if i not in exclude and not e.ejected]
+        if not indexes:
+            # everything ejected: better try them than fail every call
+            indexes = [i for i in range(len(self.endpoints)) if i not in exclude]
+            if not indexes:
+                return None
+        with self._lock:
+            return indexes[self._policy.choose(_Candidates(self.load, indexes))]
+
+    def _on_success(self, idx, latency):
+        endpoint = self.endpoints[idx]
+        endpoint.consecutive_errors = 0
+        endpoint.num_ejections = 0
+        self.load.on_complete(idx, latency)
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _on_error(self, idx):
+        endpoint = self.endpoints[idx]
+        self.load.on_drop(idx)
+        with self._lock:
+            endpoint.consecutive_errors += 1
+            # an endpoint back from ejection is ejected again on its first error
+            if endpoint.consecutive_errors >= self.eject_after and not endpoint.ejected:
+                backoff = min(self.eject_backoff * 2 ** endpoint.num_ejections, self.max_eject_backoff)
+                endpoint.ejected_until = time.time() + backoff
+                endpoint.num_ejections += 1
+                logger.warning('ejecting %s:%s for %.1fs after %d consecutive errors',
+                               endpoint.host, endpoint.port, backoff, endpoint.consecutive_errors)
+
+    def _hedge_delay(self):
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * self.hedge_percentile), len(latencies) - 1)]
+
+    def _call_endpoint(self, idx, method, *args):
+        pool = self.endpoints[idx].pool
+        self.load.on_dispatch(idx)
+        start = time.time()
+        try:
+            conn = pool.get_connection()
+        except Exception:
+            self._on_error(idx)
+            raise
+        try:
+            if self.debug:
+                print ("Thrift Call:%s Args:%s Endpoint:%s" % (method, args, self.endpoints[idx]))
+            result = getattr(conn, method)(*args)
+        except (TTransport.TTransportException, OSError):
+            #broken connection or timeout, release it
+            pool.release_conn(conn)
+            self._on_error(idx)
+            raise
+        except Exception:
+            #data exceptions, the server answered
+            pool.return_connection(conn, error=True)
+            self._on_success(idx, time.time() - start)
+            raise
+        pool.return_connection(conn)
+        self._on_success(idx, time.time() - start)
+        return result
+
+    def _hedged_call(self, idx, tried, method, *args):
+        """Calls `idx`, and a second endpoint too if the answer is late.
+
+        The first answer wins, be it a result or an exception raised by the
+        server. A transport error waits for the other call.
+        """
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._call_endpoint(idx, method, *args)
+        primary = self._executor.submit(self._call_endpoint, idx, method, *args)
+        done, _ = futures.wait([primary], timeout=delay)
+        second = None if done else self._choose(exclude=tried)
+        if second is None:
+            return primary.result()
+        tried.add(second)
+        with self._lock:
+            self.num_hedged += 1
+        pending = {primary, self._executor.submit(self._call_endpoint, second, method, *args)}
+        error = None
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if not isinstance(future.exception(), (TTransport.TTransportException, OSError)):
+                    return future.result()
+                if error is None:
+                    error = future.exception()
+        raise error
+
+    def __create_thrift_proxy__(self, methodName):
+        def __thrift_proxy(*args):
+            return self.__thrift_call__(methodName, *args)
+        return __thrift_proxy
+
+    def __thrift_call__(self, method, *args):
+        attempts_left = self.retries
+        tried = set()
+        while True:
+            idx = self._choose(exclude=tried)
+            if idx is None:
+                # every endpoint failed once, start over
+                tried.clear()
+                idx = self._choose()
+            tried.add(idx)
+            try:
+                if self._executor is not None:
+                    return self._hedged_call(idx, tried, method, *args)
+                return self._call_endpoint(idx, method, *args)
+            except (TTransport.TTransportException, OSError):
+                if attempts_left > 0:
+                    attempts_left -= 1
+                    continue
+                raise
@@ -0,0 +1,109 @@
+import threading
+
+from zaailabcorelib.thrift.transport import TTransport
+from ..zserver.metrics import Registry, Gauge, MetricsHTTPServer
+
+__all__ = ['CallHook', 'ClientMetrics']
+
+
+class CallHook(object):
+    """Called around every thrift call of a Client.
+
+    before_call() runs before the first attempt. after_call() runs once the
+    call is over, retries included, with its result or the exception it
+    raised and its latency in seconds.
+    """
+
+    def before_call(self, method, args):
+        pass
+
+    def after_call(self, method, args, result, error, latency):
+        pass
+
+
+def _call_status(error):
+    if error is None:
+        return 'ok'
+    if isinstance(error, (TTransport.TTransportException, OSError)):
+        return 'transport_error'
+    return 'error'
+
+
+class ClientMetrics(CallHook):
+    """Per method call counters and latencies, and connection pool gauges.
+
+    Calls are counted by status: 'ok', 'error' for exceptions sent by the
+    server and 'transport_error' for network failures. Comparing the call
+    latency with the pool waiters tells pool starvation from server time.
+    """
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, registry=None, prefix='thriftpool'):
+        self.registry = registry if registry is not None else Registry()
+        registry = self.registry
+        self.calls = registry.counter(
+            prefix + '_calls_total', 'Calls per thrift method and status.', ('method', 'status'))
+        self.call_latency = registry.histogram(
+            prefix + '_call_seconds', 'Time of a call, retries included.', ('method',))
+        self.checked_out = registry.gauge(
+            prefix + '_connections_checked_out', 'Connections in use.', ('endpoint',))
+        self.idle = registry.gauge(
+            prefix + '_connections_idle', 'Connections waiting in the pool.', ('endpoint',))
+        self.waiters = registry.gauge(
+            prefix + '_pool_waiters', 'Callers blocked waiting for a connection.', ('endpoint',))
+        self.created = registry.counter(
+            prefix + '_connections_created_total', 'Connections opened.', ('endpoint',))
+        self.released = registry.counter(
+            prefix + '_connections_released_total', 'Broken connections closed.', ('endpoint',))
+        self.evicted = registry.counter(
+            prefix + '_connections_evicted_total', 'Idle connections closed by health checks.', ('endpoint',))
+        self.http_server = None
+        self._pools = {}
+        # metrics have a single writer, calls come from many threads
+        self._lock = threading.Lock()
+
+    def watch_pool(self, pool):
+        endpoint = '%s:%s' % (pool.host, pool.port)
+        self._pools[endpoint] = pool
+        for family, attr in ((self.checked_out, 'num_checked_out'),
+                             (self.waiters, 'num_waiters'),
+                             (self.created, 'num_created'),
+                             (self.released, 'num_released'),
+                             (self.evicted, 'num_evicted')):
+            gauge = Gauge()
+            gauge.set_function(lambda attr=attr: getattr(pool, attr))
+            family.add(gauge, endpoint)
+        self.idle.labels(endpoint).set_function(pool._connection_queue.qsize)
+
+    def after_call(self, method, args, result, error, latency):
+        with self._lock:
+            self.calls.labels(method, _call_status(error)).inc()
+            self.call_latency.labels(method).observe(latency)
+
+    def to_dict(self):
+        methods = {}
+        for (method, status), counter in self.calls.items():
+            methods.setdefault(method, {})[status] = int(counter.value)
+        for (method,), histogram in self.call_latency.items():
+            latency = {'count': histogram.count, 'sum': histogram.sum}
+            for q in self.QUANTILES:
+                latency['p%d' % round(q * 100)] = histogram.quantile(q)
+            methods.setdefault(method, {})['latency'] = latency
+        return {'methods': methods,
+                'pools': dict((endpoint, pool.stats()) for endpoint, pool in self._pools.items())}
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        return self.registry.render()
+
+    def serve_http(self, port, host='0.0.0.0'):
+        """Starts serving the metrics on http://host:port/metrics."""
+        self.http_server = MetricsHTTPServer(self.registry, port, host)
+        self.http_server.start()
+        return self.http_server
+
+    def close(self):
+        if self.http_server is not None:
+            self.http_server.close()
+            self.http_server = None
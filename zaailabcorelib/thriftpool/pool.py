@@ -1,24 +1,133 @@
+import logging
+import select
+import socket
+import time
+
 from zaailabcorelib.thrift.transport import TTransport
 from zaailabcorelib.thrift.transport import TSocket
+from zaailabcorelib.thrift.transport import TZlibTransport
 from zaailabcorelib.thrift.protocol import TBinaryProtocol
 
+logger = logging.getLogger(__name__)
+
+
+class ConnectionInfo(object):
+    """Bookkeeping of a pooled connection, kept on it as `_pool_info`."""
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.num_calls = 0
+        self.num_errors = 0
+
+    @property
+    def age(self):
+        return time.time() - self.created_at
+
+    @property
+    def idle_time(self):
+        return time.time() - self.last_used
+
+
+class PoolSocket(TSocket.TSocket):
+    """TSocket setting TCP_NODELAY and SO_KEEPALIVE before connecting,
+    counting the bytes it sends."""
+
+    def __init__(self, host, port, tcp_nodelay=True, keepalive=False):
+        TSocket.TSocket.__init__(self, host, port)
+        self.tcp_nodelay = tcp_nodelay
+        self.keepalive = keepalive
+        # counts what pipelined calls have in flight
+        self.bytes_sent = 0
+
+    def write(self, buff):
+        TSocket.TSocket.write(self, buff)
+        self.bytes_sent += len(buff)
+
+    def _do_open(self, family, socktype):
+        handle = TSocket.TSocket._do_open(self, family, socktype)
+        if self.tcp_nodelay and family in (socket.AF_INET, socket.AF_INET6):
+            handle.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            handle.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return handle
+
+
+class ZlibTransportFactory(object):
+    """Wraps the socket in a TZlibTransport, then in the `inner` factory.
+
+    Unlike TZlibTransportFactory it caches nothing, so connections can be
+    created concurrently. The server must decompress the stream before
+    reading frames, e.g. a TZlibTransportFactory in front of its transport.
+    """
+
+    def __init__(self, inner=None, compresslevel=6):
+        self.inner = inner if inner is not None else TTransport.TFramedTransportFactory()
+        self.compresslevel = compresslevel
+
+    def getTransport(self, trans):
+        return self.inner.getTransport(TZlibTransport.TZlibTransport(trans, self.compresslevel))
+
+
 #Thrift connection pool
 class ConnectionPool(object):
+    """Pool of thrift connections to `host:port`.
+
+    Idle connections are evicted after `max_idle_time` seconds and any
+    connection older than `max_lifetime` seconds is replaced instead of
+    being reused. A reaper checks idle connections every `reap_interval`
+    seconds and keeps at least `min_idle` of them connected, these are also
+    opened when the pool is created. With `check_on_checkout`, an idle
+    connection is probed before being handed out, a socket the server
+    closed in the meantime is replaced without a failed call.
+
+    Connections stack `transport_factory` (framed by default, use
+    TBufferedTransportFactory or ZlibTransportFactory to match the server)
+    and `protocol_factory` (TBinaryProtocolAccelerated by default, which
+    encodes with the fastbinary extension when it is installed and falls
+    back to TBinaryProtocol otherwise; TCompactProtocolAcceleratedFactory
+    needs a compact server) over a socket with `tcp_nodelay` and
+    `keepalive` options.
+    """
 
     DEFAULT_NETWORK_TIMEOUT = 0
     DEFAULT_POOL_SIZE = 100
+    DEFAULT_REAP_INTERVAL = 30
 
-    def __init__(self, host, port, iface_cls, size=DEFAULT_POOL_SIZE, asyn=False, network_timeout=DEFAULT_NETWORK_TIMEOUT):
+    def __init__(self, host, port, iface_cls, size=DEFAULT_POOL_SIZE, asyn=False, network_timeout=DEFAULT_NETWORK_TIMEOUT,
+                 max_idle_time=None, max_lifetime=None, min_idle=0, check_on_checkout=False,
+                 reap_interval=DEFAULT_REAP_INTERVAL,
+                 transport_factory=None, protocol_factory=None, tcp_nodelay=True, keepalive=False):
         self.host = host
         self.port = port
         self.iface_cls = iface_cls
+        self.transport_factory = transport_factory if transport_factory is not None \
+            else TTransport.TFramedTransportFactory()
+        self.protocol_factory = protocol_factory if protocol_factory is not None \
+            else TBinaryProtocol.TBinaryProtocolAcceleratedFactory()
+        self.tcp_nodelay = tcp_nodelay
+        self.keepalive = keepalive
 
         self.network_timeout = network_timeout
         self.size = size
+        self.max_idle_time = max_idle_time
+        self.max_lifetime = max_lifetime
+        self.min_idle = min(int(min_idle), size)
+        self.check_on_checkout = check_on_checkout
+        self.reap_interval = reap_interval
+        self.num_created = 0
+        self.num_evicted = 0
+        self.num_released = 0
+        # connections handed out, and callers blocked waiting for one
+        self.num_checked_out = 0
+        self.num_waiters = 0
 
         self._closed = False
         self._async = asyn
         if self._async:
+            import gevent
+            import gevent.event
             import gevent.queue
             try:
                 from gevent import lock as glock
@@ -28,6 +137,10 @@ class ConnectionPool(object):
             self._semaphore = glock.BoundedSemaphore(size)
             self._connection_queue = gevent.queue.LifoQueue(size)
             self._QueueEmpty = gevent.queue.Empty
+            self._QueueFull = gevent.queue.Full
+            self._reaper_stopped = gevent.event.Event()
+            self._spawn = gevent.spawn
+            self._stats_lock = glock.Semaphore()
 
         else:
             import threading
@@ -35,9 +148,96 @@ class ConnectionPool(object):
             self._semaphore = threading.BoundedSemaphore(size)
             self._connection_queue = queue.LifoQueue(size)
             self._QueueEmpty = queue.Empty
+            self._QueueFull = queue.Full
+            self._reaper_stopped = threading.Event()
+            self._spawn = lambda func: threading.Thread(target=func, daemon=True).start()
+            self._stats_lock = threading.Lock()
+
+        self._fill_min_idle()
+        if reap_interval and (max_idle_time or max_lifetime or self.min_idle):
+            self._spawn(self._reaper_loop)
+
+    def _is_expired(self, info):
+        if self.max_lifetime is not None and info.age > self.max_lifetime:
+            return True
+        return self.max_idle_time is not None and info.idle_time > self.max_idle_time
+
+    def _is_alive(self, info):
+        """Cheap liveness probe of an idle connection, no request is sent.
+
+        Nothing should be readable on an idle socket: readable means the
+        server closed it, or sent something nobody will read.
+        """
+        handle = info.socket.handle
+        if handle is None:
+            return False
+        try:
+            readable, _, _ = select.select([handle], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def _is_usable(self, conn):
+        info = getattr(conn, '_pool_info', None)
+        if info is None:
+            return True
+        if self._is_expired(info):
+            return False
+        return not self.check_on_checkout or self._is_alive(info)
+
+    def _evict(self, conn):
+        with self._stats_lock:
+            self.num_evicted += 1
+        try:
+            self._close_thrift_connection(conn)
+        except:
+            pass
+
+    def _fill_min_idle(self):
+        while not self._closed and self._connection_queue.qsize() < self.min_idle:
+            try:
+                conn = self._create_thrift_connection()
+            except Exception:
+                logger.warning('failed to pre-connect to %s:%s', self.host, self.port, exc_info=True)
+                return
+            try:
+                self._connection_queue.put(conn, block=False)
+            except self._QueueFull:
+                self._close_thrift_connection(conn)
+                return
+
+    def reap(self):
+        """Evicts expired or dead idle connections, then tops up min_idle."""
+        idle = []
+        while True:
+            try:
+                idle.append(self._connection_queue.get(block=False))
+            except self._QueueEmpty:
+                break
+        # the most recently used connections go back on top of the stack
+        for conn in reversed(idle):
+            info = getattr(conn, '_pool_info', None)
+            if info is not None and (self._is_expired(info) or not self._is_alive(info)):
+                self._evict(conn)
+                continue
+            try:
+                self._connection_queue.put(conn, block=False)
+            except self._QueueFull:
+                self._close_thrift_connection(conn)
+        self._fill_min_idle()
+
+    def _reaper_loop(self):
+        while not self._reaper_stopped.wait(self.reap_interval):
+            if self._closed:
+                break
+            try:
+                self.reap()
+            except Exception:
+                logger.exception('failed to reap idle connections')
 
     def close(self):
         self._closed = True
+        self._reaper_stopped.set()
         while not self._connection_queue.empty():
             try:
                 conn = self._connection_queue.get(block=False)
@@ -49,17 +249,17 @@ class ConnectionPool(object):
                 pass
 
     def _create_thrift_connection(self):
-        socket = TSocket.TSocket(self.host, self.port)
+        sock = PoolSocket(self.host, self.port, self.tcp_nodelay, self.keepalive)
         if self.network_timeout > 0:
-            socket.setTimeout(self.network_timeout)
-        # chuyen doi transport
-        # transport = TTransport.TBufferedTransport(socket)
-        # protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
-        transport = TTransport.TFramedTransport(socket)
+            sock.setTimeout(self.network_timeout)
+        transport = self.transport_factory.getTransport(sock)
         # Wrap in a protocol
-        protocol = TBinaryProtocol.TBinaryProtocol(transport)
+        protocol = self.protocol_factory.getProtocol(transport)
         connection = self.iface_cls(protocol)
         transport.open()
+        connection._pool_info = ConnectionInfo(sock)
+        with self._stats_lock:
+            self.num_created += 1
         return connection
 
     def _close_thrift_connection(self, conn):
@@ -77,33 +277,77 @@ class ConnectionPool(object):
     def get_connection(self):
         """ get a connection from the pool. This blocks until one is available.
         """
-        self._semaphore.acquire()
         if self._closed:
             raise RuntimeError('connection pool closed')
+        with self._stats_lock:
+            self.num_waiters += 1
         try:
-            return self._connection_queue.get(block=False)
-        except self._QueueEmpty:
+            self._semaphore.acquire()
+        finally:
+            with self._stats_lock:
+                self.num_waiters -= 1
+        if self._closed:
+            # closed while waiting, the next waiter raises as well
+            self._semaphore.release()
+            raise RuntimeError('connection pool closed')
+        while True:
             try:
-                return self._create_thrift_connection()
-            except:
-                self._semaphore.release()
-                raise
+                conn = self._connection_queue.get(block=False)
+            except self._QueueEmpty:
+                try:
+                    conn = self._create_thrift_connection()
+                except:
+                    self._semaphore.release()
+                    raise
+                break
+            if self._is_usable(conn):
+                break
+            self._evict(conn)
+        with self._stats_lock:
+            self.num_checked_out += 1
+        return conn
 
-    def return_connection(self, conn):
+    def stats(self):
+        return {'size': self.size,
+                'checked_out': self.num_checked_out,
+                'idle': self._connection_queue.qsize(),
+                'waiters': self.num_waiters,
+                'created': self.num_created,
+                'released': self.num_released,
+                'evicted': self.num_evicted}
+
+    def return_connection(self, conn, error=False):
         """ return a thrift connection to the pool.
+
+        `error` tells the call failed with an application error, the
+        connection itself is still usable.
         """
+        with self._stats_lock:
+            self.num_checked_out -= 1
+        info = getattr(conn, '_pool_info', None)
+        if info is not None:
+            info.last_used = time.time()
+            info.num_calls += 1
+            if error:
+                info.num_errors += 1
         if self._closed:
             self._close_thrift_connection(conn)
-            return
-        self._connection_queue.put(conn)
+        else:
+            try:
+                self._connection_queue.put(conn, block=False)
+            except self._QueueFull:
+                # more connections than the pool size while the reaper ran
+                self._close_thrift_connection(conn)
         self._semaphore.release()
 
     def release_conn(self, conn):
         """ call when the connect is no usable anymore
         """
+        with self._stats_lock:
+            self.num_checked_out -= 1
+            self.num_released += 1
         try:
             self._close_thrift_connection(conn)
         except:
             pass
-        if not self._closed:
-            self._semaphore.release()
+        self._semaphore.release()
@@ -0,0 +1,167 @@
+import contextlib
+import random
+import threading
+import time
+
+from zaailabcorelib.thrift.transport import TTransport
+
+__all__ = ['RetryBudget', 'ExponentialBackoff', 'CircuitBreaker', 'CircuitOpenError',
+           'deadline', 'remaining_time']
+
+
+class RetryBudget(object):
+    """Token bucket limiting retries to a fraction of the calls.
+
+    Every call deposits `ratio` token and every retry withdraws one, on top
+    of `min_per_second` tokens refilled over time so that a quiet client can
+    still retry. The bucket holds at most `capacity` tokens. When a server
+    fails everything, retries are capped to `ratio` of the traffic instead
+    of multiplying it by the number of attempts.
+
+    One budget can be shared by several clients.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=10, capacity=100):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.num_rejected = 0
+        self._tokens = float(capacity)
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.min_per_second)
+        self._last_refill = now
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill(time.time())
+            return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.time())
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def try_withdraw(self):
+        """Takes the token of a retry, False if the budget is exhausted."""
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens < 1:
+                self.num_rejected += 1
+                return False
+            self._tokens -= 1
+            return True
+
+
+class ExponentialBackoff(object):
+    """Delay before the n-th retry, with "full jitter".
+
+    The delay is drawn uniformly between 0 and `base * 2 ** n` seconds,
+    capped to `max_delay`, so that clients failing together do not retry in
+    lockstep.
+    """
+
+    def __init__(self, base=0.05, max_delay=2.0):
+        self.base = base
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base * 2 ** attempt))
+
+
+class CircuitOpenError(TTransport.TTransportException):
+    def __init__(self, message):
+        TTransport.TTransportException.__init__(self, TTransport.TTransportException.NOT_OPEN, message)
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while a server is down.
+
+    After `failure_threshold` consecutive transport errors the circuit
+    opens and calls raise CircuitOpenError without touching the network.
+    After `reset_timeout` seconds a single trial call is let through: its
+    success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.num_opened = 0
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a call may be attempted."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_running = False
+            self.state = self.CLOSED
+
+    def release(self):
+        """Ends the trial call of a half open circuit that neither succeeded
+        nor failed, e.g. it could not get a connection, so another call can
+        be tried."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_running = False
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.num_opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.time()
+
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Bounds the thrift calls made in this block to `seconds` in total.
+
+    Deadlines nest, the earliest one wins, so a handler calling other
+    services within a deadline passes what is left of it down.
+    """
+    previous = getattr(_local, 'deadline', None)
+    at = time.time() + seconds
+    _local.deadline = at if previous is None else min(previous, at)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining_time():
+    """Seconds left before the current deadline, None without deadline."""
+    at = getattr(_local, 'deadline', None)
+    if at is None:
+        return None
+    return at - time.time()
@@ -0,0 +1 @@
+from zaailabcorelib.zdispatch.dispatch_policy import *
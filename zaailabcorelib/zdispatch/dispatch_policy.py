@@ -0,0 +1,144 @@
+import itertools
+import random
+import threading
+
+__all__ = ['WorkerLoad', 'DispatchPolicy', 'RandomPolicy', 'RoundRobinPolicy',
+           'LeastOutstandingPolicy', 'PowerOfTwoChoicesPolicy', 'get_dispatch_policy']
+
+
+class WorkerLoad(object):
+    """Load of workers as seen by whoever dispatches to them: the model
+    workers of a server, or the endpoints of a ClusterClient.
+
+    `in_flight` counts the requests dispatched to a worker and not answered
+    yet, which is its queue depth plus the request being processed.
+    `ewma_latency` is an exponentially weighted moving average of the time
+    between dispatch and answer, in seconds.
+    """
+
+    def __init__(self, num_workers, decay=0.2):
+        self.decay = decay
+        self.in_flight = [0] * num_workers
+        self.dispatched = [0] * num_workers
+        self.completed = [0] * num_workers
+        self.dropped = [0] * num_workers
+        self.ewma_latency = [0.0] * num_workers
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def on_dispatch(self, wrk_id):
+        with self._lock:
+            self.in_flight[wrk_id] += 1
+            self.dispatched[wrk_id] += 1
+
+    def on_complete(self, wrk_id, latency):
+        with self._lock:
+            self.in_flight[wrk_id] -= 1
+            self.completed[wrk_id] += 1
+            if self.completed[wrk_id] == 1:
+                self.ewma_latency[wrk_id] = latency
+            else:
+                self.ewma_latency[wrk_id] += self.decay * (latency - self.ewma_latency[wrk_id])
+
+    def on_drop(self, wrk_id):
+        """Accounts a request which will never be answered by its worker."""
+        with self._lock:
+            self.in_flight[wrk_id] -= 1
+            self.dropped[wrk_id] += 1
+
+    def stats(self):
+        with self._lock:
+            return [{'in_flight': self.in_flight[i],
+                     'dispatched': self.dispatched[i],
+                     'completed': self.completed[i],
+                     'dropped': self.dropped[i],
+                     'ewma_latency': self.ewma_latency[i]}
+                    for i in range(len(self.in_flight))]
+
+
+class DispatchPolicy(object):
+    """Chooses the worker of the next request.
+
+    choose() is called from the server main thread for every request and
+    returns the index of a worker given their WorkerLoad.
+    """
+
+    def choose(self, load):
+        raise NotImplementedError()
+
+
+class RandomPolicy(DispatchPolicy):
+    def choose(self, load):
+        return random.randrange(len(load))
+
+
+class RoundRobinPolicy(DispatchPolicy):
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, load):
+        return next(self._counter) % len(load)
+
+
+class LeastOutstandingPolicy(DispatchPolicy):
+    """Picks the worker with the fewest requests in flight.
+
+    Ties are broken in round-robin order so that idle workers share the load.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, load):
+        in_flight = load.in_flight
+        n = len(in_flight)
+        start = next(self._counter) % n
+        return min(((start + i) % n for i in range(n)), key=in_flight.__getitem__)
+
+
+class PowerOfTwoChoicesPolicy(DispatchPolicy):
+    """Samples two workers at random and keeps the less loaded one.
+
+    With `metric` 'depth' the load is the number of requests in flight, with
+    'ewma' it is the expected time to answer, i.e. the EWMA latency weighted
+    by the requests in flight, so a throttled worker is avoided even before
+    its queue grows.
+    """
+
+    def __init__(self, metric='depth'):
+        assert metric in ('depth', 'ewma')
+        self.metric = metric
+
+    def _cost(self, load, wrk_id):
+        if self.metric == 'depth':
+            return load.in_flight[wrk_id]
+        return load.ewma_latency[wrk_id] * (load.in_flight[wrk_id] + 1)
+
+    def choose(self, load):
+        if len(load) == 1:
+            return 0
+        first, second = random.sample(range(len(load)), 2)
+        if self._cost(load, second) < self._cost(load, first):
+            return second
+        return first
+
+
+_POLICIES = {
+    'random': RandomPolicy,
+    'round_robin': RoundRobinPolicy,
+    'least_outstanding': LeastOutstandingPolicy,
+    'p2c': PowerOfTwoChoicesPolicy,
+    'p2c_ewma': lambda: PowerOfTwoChoicesPolicy(metric='ewma'),
+}
+
+
+def get_dispatch_policy(policy):
+    """Returns a DispatchPolicy given one or its name."""
+    if isinstance(policy, DispatchPolicy):
+        return policy
+    if policy not in _POLICIES:
+        raise ValueError('Unknown dispatch policy %r, expected one of %s'
+                         % (policy, sorted(_POLICIES)))
+    return _POLICIES[policy]()
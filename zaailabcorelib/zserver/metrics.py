@@ -0,0 +1,323 @@
+import logging
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'DEFAULT_LATENCY_BUCKETS',
+           'MetricFamily', 'Registry', 'MetricsHTTPServer', 'ServerMetrics',
+           'processor_methods']
+
+logger = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """Monotonic counter.
+
+    The value lives in shared memory, so a counter created before a worker
+    process is started can be incremented by the worker and read by the
+    server process. Each counter should have a single writing process.
+    """
+
+    def __init__(self):
+        self._value = RawValue('d', 0)
+
+    def inc(self, amount=1):
+        self._value.value += amount
+
+    @property
+    def value(self):
+        return self._value.value
+
+
+class Gauge(object):
+    """Value which can go up and down, or be computed when collected."""
+
+    def __init__(self):
+        self._value = RawValue('d', 0)
+        self._function = None
+
+    def set(self, value):
+        self._value.value = value
+
+    def inc(self, amount=1):
+        self._value.value += amount
+
+    def dec(self, amount=1):
+        self._value.value -= amount
+
+    def set_function(self, function):
+        """Makes the gauge report `function()` instead of its own value."""
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._value.value
+
+
+class Histogram(object):
+    """Histogram over fixed bucket upper bounds.
+
+    Like Counter, the bucket counts live in shared memory and a histogram
+    should have a single writing process. observe() is a bisect and two
+    additions, cheap enough for the hot path.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # one slot per bucket, one for +Inf, and the sum of observed values
+        self._values = RawArray('d', len(self.buckets) + 2)
+
+    def observe(self, value):
+        self._values[bisect_left(self.buckets, value)] += 1
+        self._values[-1] += value
+
+    @property
+    def count(self):
+        return int(sum(self._values[:-1]))
+
+    @property
+    def sum(self):
+        return self._values[-1]
+
+    def quantile(self, q):
+        """Estimates the `q` quantile, None before any observation.
+
+        Like Prometheus histogram_quantile(), the value is interpolated
+        linearly within its bucket, observations above the last bound are
+        reported as that bound.
+        """
+        counts = self._values[:-1]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = upper
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """Returns cumulative bucket counts keyed by upper bound."""
+        values = self._values[:]
+        cumulative = {}
+        total = 0
+        for bound, value in zip(self.buckets + (float('inf'),), values[:-1]):
+            total += value
+            cumulative[bound] = int(total)
+        return {'buckets': cumulative, 'count': int(total), 'sum': values[-1]}
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values))
+    return '{%s}' % ','.join(pairs)
+
+
+class MetricFamily(object):
+    """Metrics sharing a name, one per set of label values."""
+
+    def __init__(self, kind, name, documentation, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = OrderedDict()
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Returns the metric of the given label values, created on first use."""
+        assert len(values) == len(self.labelnames)
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def items(self):
+        """Returns (label values, metric) pairs."""
+        return list(self._children.items())
+
+    def add(self, metric, *values):
+        """Exports an existing metric, e.g. one created before a fork."""
+        assert len(values) == len(self.labelnames)
+        with self._lock:
+            self._children[tuple(str(value) for value in values)] = metric
+        return metric
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in self.items():
+            if self.kind != 'histogram':
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, values),
+                                          _format_value(child.value)))
+                continue
+            snapshot = child.snapshot()
+            names = self.labelnames + ('le',)
+            for bound, count in snapshot['buckets'].items():
+                lines.append('%s_bucket%s %s' % (self.name, _format_labels(names, values + (_format_value(bound),)),
+                                                 _format_value(count)))
+            labels = _format_labels(self.labelnames, values)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(snapshot['sum'])))
+            lines.append('%s_count%s %s' % (self.name, labels, _format_value(snapshot['count'])))
+        return lines
+
+
+class Registry(object):
+    """Collection of metric families rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._families = OrderedDict()
+
+    def _family(self, kind, name, documentation, labelnames, factory):
+        if name in self._families:
+            raise ValueError('Duplicated metric name %s' % name)
+        family = MetricFamily(kind, name, documentation, labelnames, factory)
+        self._families[name] = family
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._family('counter', name, documentation, labelnames, Counter)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._family('gauge', name, documentation, labelnames, Gauge)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._family('histogram', name, documentation, labelnames,
+                            lambda: Histogram(buckets))
+
+    def render(self):
+        lines = []
+        for family in list(self._families.values()):
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHTTPServer(threading.Thread):
+    """Serves the metrics of a registry over HTTP from a daemon thread."""
+
+    def __init__(self, registry, port, host='0.0.0.0'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry_.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.httpd = HTTPServer((host, port), Handler)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def processor_methods(processor_cls):
+    """Returns the names of the thrift methods of a generated Processor."""
+    return frozenset(name[len('process_'):] for name in dir(processor_cls)
+                     if name.startswith('process_'))
+
+
+def _queue_size(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        # multiprocessing queues on macOS
+        return float('nan')
+
+
+class ServerMetrics(object):
+    """Metrics exported by the zserver thrift servers.
+
+    Histograms labelled by worker are written by a single worker each, they
+    must be created (or added) before worker processes are started.
+    """
+
+    def __init__(self, registry=None, prefix='zserver'):
+        self.registry = registry if registry is not None else Registry()
+        registry = self.registry
+        self.connections_open = registry.gauge(
+            prefix + '_connections_open', 'Open client connections.').labels()
+        self.requests = registry.counter(
+            prefix + '_requests_total', 'Requests received per thrift method.', ('method',))
+        self.queue_depth = registry.gauge(
+            prefix + '_queue_depth', 'Items waiting in a queue.', ('queue',))
+        self.batch_size = registry.histogram(
+            prefix + '_batch_size', 'Requests per predicted batch.', ('worker',))
+        self.read_latency = registry.histogram(
+            prefix + '_read_seconds', 'Time to receive a request frame.').labels()
+        self.queue_wait = registry.histogram(
+            prefix + '_queue_wait_seconds', 'Time requests wait for a worker.', ('worker',))
+        self.predict_latency = registry.histogram(
+            prefix + '_predict_seconds', 'Time to process a request or predict a batch.', ('worker',))
+        self.write_latency = registry.histogram(
+            prefix + '_write_seconds', 'Time from answer ready to fully sent.').labels()
+        self.http_server = None
+
+    def watch_queue(self, name, queue):
+        self.queue_depth.labels(name).set_function(lambda: _queue_size(queue))
+
+    def count_request(self, protocol_factory, memory_buffer_cls, msg, methods):
+        """Counts a request frame by its method name, leaving the frame unread.
+
+        Names are sent by clients, the ones outside `methods` are counted as
+        'unknown' so that they cannot grow the metrics without bound.
+        """
+        try:
+            iprot = protocol_factory.getProtocol(msg.transport(memory_buffer_cls))
+            name = iprot.readMessageBegin()[0]
+        except Exception:
+            name = 'unknown'
+        finally:
+            msg.buffer.seek(0)
+        if name not in methods:
+            name = 'unknown'
+        self.requests.labels(name).inc()
+
+    def serve_http(self, port, host='0.0.0.0'):
+        """Starts serving the metrics on http://host:port/metrics."""
+        self.http_server = MetricsHTTPServer(self.registry, port, host)
+        self.http_server.start()
+        return self.http_server
+
+    def close(self):
+        if self.http_server is not None:
+            self.http_server.close()
+            self.http_server = None
@@ -0,0 +1,479 @@
+"""Core shared by the non-blocking thrift servers.
+
+Requests are received and answers sent only from the main thread, which
+waits on a selectors.DefaultSelector (epoll on Linux). Interest in a
+connection is registered or modified only when its state changes, so an
+idle keep-alive connection costs nothing per wake up.
+"""
+
+import logging
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from functools import partial
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['EventLoop', 'Connection', 'Message',
+           'WAIT_LEN', 'WAIT_MESSAGE', 'CLOSED']
+
+WAIT_LEN = 0
+WAIT_MESSAGE = 1
+CLOSED = 2
+
+READ_SIZE = 8192
+
+
+def locked(func):
+    """Decorator which locks self.lock."""
+
+    def nested(self, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.lock.release()
+    return nested
+
+
+def socket_exception(func):
+    """Decorator close object on socket.error."""
+
+    def read(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except socket.error:
+            logger.debug('ignoring socket exception', exc_info=True)
+            self.close()
+    return read
+
+
+class Message(object):
+    """A complete request frame, read in place into `buffer`.
+
+    `seq` is the position of the request on its connection and `ready` the
+    callback which answers it, see Connection.ready().
+    """
+
+    def __init__(self, buffer, len_, seq=0, ready=None):
+        self.buffer = buffer
+        self.len = len_
+        self.seq = seq
+        self.ready = ready
+
+    def transport(self, memory_buffer_cls):
+        """Returns a TMemoryBuffer reading the frame without copying it."""
+        trans = memory_buffer_cls()
+        trans._buffer = self.buffer
+        return trans
+
+
+def _allocate(size):
+    """Returns a BytesIO of `size` zero bytes that owns its memory."""
+    buf = BytesIO()
+    if size:
+        buf.seek(size - 1)
+        buf.write(b'\0')
+        buf.seek(0)
+    return buf
+
+
+class Connection(object):
+    """Basic class is represented connection.
+
+    Its read side can be in state:
+        WAIT_LEN --- connection is reading request len.
+        WAIT_MESSAGE --- connection is reading request.
+        CLOSED --- socket was closed and connection should be deleted.
+
+    Every complete request gets the next sequence number and is answered
+    through ready(). Up to `pipeline_depth` requests may be in flight at
+    once; answers coming back out of order are held until the earlier ones
+    are queued, so the client always reads them in request order. With the
+    default depth of 1 the connection neither reads nor processes the next
+    request before the previous answer is fully sent.
+
+    Small reads land in a fixed scratch buffer. Once the length of a frame
+    is known, a buffer of that size is allocated and the rest of the frame
+    is received straight into it, so large frames are neither grown chunk
+    by chunk nor copied out again.
+    """
+
+    def __init__(self, new_socket, wake_up, pipeline_depth=1,
+                 read_latency=None, write_latency=None):
+        self.socket = new_socket
+        self.socket.setblocking(False)
+        self.status = WAIT_LEN
+        self.len = 0
+        self.pipeline_depth = max(1, int(pipeline_depth))
+        self.received = deque()
+        self._scratch = bytearray(READ_SIZE)
+        self._scratch_view = memoryview(self._scratch)
+        # unparsed bytes are self._scratch[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # frame being filled and the number of bytes received so far
+        self._frame = None
+        self._frame_view = None
+        self._filled = 0
+        self._frame_started = 0
+        # optional histograms of the time spent receiving and sending
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        # seq of the next request read and of the next answer to queue
+        self._next_seq = 0
+        self._send_seq = 0
+        self._answers = {}
+        self._wbuf = deque()
+        self.lock = threading.Lock()
+        self.wake_up = wake_up
+        self.remaining = False
+
+    @property
+    def in_flight(self):
+        """Number of requests read but not answered yet."""
+        return self._next_seq - self._send_seq
+
+    @socket_exception
+    def read(self):
+        """Reads as many requests as the pipeline allows."""
+        drained = False
+        while self.in_flight < self.pipeline_depth:
+            # a worker may close the connection at any time
+            if self.is_closed():
+                return
+            if self._parse():
+                continue
+            if drained:
+                break
+            if self._frame is not None:
+                view = self._frame_view[self._filled:]
+            else:
+                view = self._scratch_view[self._end:]
+            try:
+                rlen = self.socket.recv_into(view)
+            except BlockingIOError:
+                break
+            if rlen == 0:
+                if self.status != WAIT_LEN or self._start < self._end:
+                    logger.error('could not read frame from socket')
+                else:
+                    logger.debug(
+                        'read zero length. client might have disconnected')
+                self.close()
+                return
+            if self._frame is not None:
+                self._filled += rlen
+            else:
+                self._end += rlen
+            # a short read means the socket is most likely empty
+            drained = rlen < len(view)
+        self.remaining = self._start < self._end
+
+    def _parse(self):
+        """Moves buffered bytes into frames, returns True once one is complete.
+
+        Returns False once the connection is closed, status changes are done
+        under the lock as ready() may close it from a worker thread.
+        """
+        if self._frame is None:
+            if self._end - self._start < 4:
+                # keep the partial header at the front of the scratch buffer
+                pending = self._end - self._start
+                self._scratch[:pending] = self._scratch[self._start:self._end]
+                self._start, self._end = 0, pending
+                return False
+            mlen, = struct.unpack_from('!i', self._scratch, self._start)
+            if mlen < 0:
+                raise socket.error('invalid frame length %d' % mlen)
+            self._start += 4
+            self._frame = _allocate(mlen)
+            self._frame_view = self._frame.getbuffer()
+            self._filled = 0
+            self._frame_started = time.time()
+            self.len = mlen
+            with self.lock:
+                if self.status == CLOSED:
+                    return False
+                self.status = WAIT_MESSAGE
+        take = min(self.len - self._filled, self._end - self._start)
+        if take:
+            self._frame_view[self._filled:self._filled + take] = \
+                self._scratch_view[self._start:self._start + take]
+            self._filled += take
+            self._start += take
+        if self._start == self._end:
+            self._start = self._end = 0
+        if self._filled < self.len:
+            return False
+        # the transport may close the buffer, which needs no exported view
+        self._frame_view.release()
+        if self.read_latency is not None:
+            self.read_latency.observe(time.time() - self._frame_started)
+        with self.lock:
+            if self.status == CLOSED:
+                return False
+            seq = self._next_seq
+            self.received.append(Message(self._frame, self.len, seq,
+                                         partial(self.ready, seq=seq)))
+            self._next_seq += 1
+            self._frame = self._frame_view = None
+            self.status = WAIT_LEN
+        return True
+
+    @socket_exception
+    def write(self):
+        """Writes queued answers until done or the socket is full."""
+        while self._wbuf:
+            chunk, queued_at = self._wbuf[0]
+            try:
+                sent = self.socket.send(chunk)
+            except BlockingIOError:
+                return
+            if sent < len(chunk):
+                self._wbuf[0] = (memoryview(chunk)[sent:], queued_at)
+                return
+            self._wbuf.popleft()
+            if self.write_latency is not None:
+                self.write_latency.observe(time.time() - queued_at)
+
+    @locked
+    def ready(self, all_ok, message, seq=None):
+        """Callback function for queueing an answer and waking up main thread.
+
+        This function is the only function witch can be called asynchronous.
+
+        `seq` is the request answered, the oldest pending one by default.
+        An empty message answers a oneway request, nothing is written. If the
+        request throws unexpected exception the connection is closed.
+
+        The one wakes up main thread.
+        """
+        if self.status == CLOSED:
+            return
+        if seq is None:
+            seq = self._send_seq
+        assert self._send_seq <= seq < self._next_seq
+        if not all_ok:
+            self._close()
+            self.wake_up()
+            return
+        self._answers[seq] = message
+        while self._send_seq in self._answers:
+            message = self._answers.pop(self._send_seq)
+            if message:
+                self._wbuf.append((struct.pack('!i', len(message)) + message, time.time()))
+            self._send_seq += 1
+        self.wake_up()
+
+    @locked
+    def is_writeable(self):
+        """Return True if connection should be registered for write events"""
+        return self.status != CLOSED and bool(self._wbuf)
+
+    @locked
+    def is_readable(self):
+        """Return True if connection should be registered for read events"""
+        if self.status == CLOSED or self.in_flight >= self.pipeline_depth:
+            return False
+        # without pipelining, the answer is sent before reading further
+        return self.pipeline_depth > 1 or not self._wbuf
+
+    @locked
+    def is_closed(self):
+        """Returns True if connection is closed."""
+        return self.status == CLOSED
+
+    def fileno(self):
+        """Returns the file descriptor of the associated socket."""
+        return self.socket.fileno()
+
+    @locked
+    def close(self):
+        """Closes connection"""
+        self._close()
+
+    def _close(self):
+        self.status = CLOSED
+        self.socket.close()
+
+
+class EventLoop(object):
+    """Accepts connections and moves them through their states.
+
+    `dispatch(fileno, connection, message)` is called from the main thread
+    for every complete request; whoever processes it must eventually call
+    message.ready(), from any thread. Up to `pipeline_depth` requests of a
+    connection are dispatched at once.
+
+    With a ServerMetrics, the loop reports its open connections and the
+    time spent receiving requests and sending answers.
+    """
+
+    def __init__(self, server_socket, dispatch, pipeline_depth=1, metrics=None):
+        self.server_socket = server_socket
+        self.dispatch = dispatch
+        self.pipeline_depth = pipeline_depth
+        self.metrics = metrics
+        self.clients = {}
+        if metrics is not None:
+            metrics.connections_open.set_function(lambda: len(self.clients))
+        self.selector = selectors.DefaultSelector()
+        self._events = {}
+        self._changed = deque()
+        self._read, self._write = socket.socketpair()
+        self._read.setblocking(False)
+        self._write.setblocking(False)
+        self.selector.register(self._read.fileno(),
+                               selectors.EVENT_READ, self._drain)
+        self._server_fileno = None
+
+    def listen(self):
+        """Listens on the server socket and starts watching it."""
+        self.server_socket.listen()
+        self._server_fileno = self.server_socket.handle.fileno()
+        self.selector.register(self._server_fileno,
+                               selectors.EVENT_READ, self._accept)
+
+    def wake_up(self):
+        """Wake up main thread.
+
+        The main thread usually waits in select call, writing anything to the
+        socketpair makes it return. Workers call it holding a connection
+        lock, so it must not block: a full socketpair already has wake ups
+        pending.
+        """
+        try:
+            self._write.send(b'1')
+        except BlockingIOError:
+            pass
+
+    def _notify(self, fileno):
+        """Called by a connection whose state was changed by another thread."""
+        self._changed.append(fileno)
+        self.wake_up()
+
+    def handle(self, timeout=None):
+        """Waits for events and handles them."""
+        for key, events in self.selector.select(timeout):
+            if key.data is not None:
+                # the server socket or the wake up socketpair
+                key.data()
+                continue
+            connection = self.clients.get(key.fd)
+            if connection is None:
+                continue
+            if events & selectors.EVENT_WRITE:
+                self._on_writeable(key.fd, connection)
+            if events & selectors.EVENT_READ and connection.is_readable():
+                self._on_readable(key.fd, connection)
+
+    def _accept(self):
+        try:
+            client = self.server_socket.accept()
+        except socket.error:
+            logger.debug('error while accepting', exc_info=True)
+            return
+        if not client:
+            return
+        fileno = client.handle.fileno()
+        # the descriptor of a connection closed by a worker may be reused
+        self._forget(fileno)
+        if self.metrics is not None:
+            connection = Connection(client.handle, partial(self._notify, fileno),
+                                    self.pipeline_depth, self.metrics.read_latency,
+                                    self.metrics.write_latency)
+        else:
+            connection = Connection(client.handle, partial(self._notify, fileno),
+                                    self.pipeline_depth)
+        self.clients[fileno] = connection
+        self._update(fileno, connection)
+
+    def _drain(self):
+        try:
+            self._read.recv(4096)
+        except BlockingIOError:
+            pass
+        while self._changed:
+            fileno = self._changed.popleft()
+            connection = self.clients.get(fileno)
+            if connection is None:
+                continue
+            if connection.is_writeable():
+                # most answers fit in the socket buffer, send right away
+                self._on_writeable(fileno, connection)
+            else:
+                self._on_idle(fileno, connection)
+
+    def _on_readable(self, fileno, connection):
+        if not connection.received:
+            connection.read()
+        while connection.received:
+            self.dispatch(fileno, connection, connection.received.popleft())
+        self._update(fileno, connection)
+
+    def _on_writeable(self, fileno, connection):
+        connection.write()
+        self._on_idle(fileno, connection)
+
+    def _on_idle(self, fileno, connection):
+        """Serves requests already buffered by a connection that may read again."""
+        if connection.is_readable() and (connection.received or connection.remaining):
+            self._on_readable(fileno, connection)
+        else:
+            self._update(fileno, connection)
+
+    def _update(self, fileno, connection):
+        """Makes the registered interest match the connection state."""
+        if connection.is_closed():
+            self._forget(fileno)
+            return
+        events = 0
+        if connection.is_readable():
+            events |= selectors.EVENT_READ
+        if connection.is_writeable():
+            events |= selectors.EVENT_WRITE
+        registered = self._events.get(fileno, 0)
+        if events == registered:
+            return
+        if not events:
+            self.selector.unregister(fileno)
+            del self._events[fileno]
+        elif not registered:
+            self.selector.register(fileno, events)
+            self._events[fileno] = events
+        else:
+            self.selector.modify(fileno, events)
+            self._events[fileno] = events
+
+    def _forget(self, fileno):
+        if self._events.pop(fileno, None):
+            try:
+                self.selector.unregister(fileno)
+            except (KeyError, ValueError):
+                pass
+        self.clients.pop(fileno, None)
+
+    def stop_accepting(self):
+        """Closes the server socket, open connections are still served."""
+        if self._server_fileno is not None:
+            self.selector.unregister(self._server_fileno)
+            self._server_fileno = None
+        self.server_socket.close()
+
+    def has_pending_writes(self):
+        """Returns True while some answer is not fully sent."""
+        return bool(self._changed) or any(
+            connection.is_writeable() for connection in self.clients.values())
+
+    def close(self):
+        """Closes the server socket and all connections."""
+        for fileno, connection in list(self.clients.items()):
+            self._forget(fileno)
+            if not connection.is_closed():
+                connection.close()
+        self.stop_accepting()
@@ -2,12 +2,10 @@
 import asyncio
 from threading import Thread
 import logging
-import select
-import socket
-import struct
+import os
+import stat
 import threading
 
-from collections import deque
 from six.moves import queue
 
 from zaailabcorelib.thrift.transport import TTransport
@@ -16,20 +14,18 @@ from multiprocessing import Process, Queue
 import traceback
 from zaailabcorelib.thrift.protocol import TBinaryProtocol
 from zaailabcorelib.thrift.transport.TTransport import TTransportException
-import random
+import itertools
+import time
+from ..metrics import ServerMetrics, processor_methods
+from ..nonblocking import EventLoop
+from ...zdispatch.dispatch_policy import WorkerLoad, get_dispatch_policy
+from .supervisor import WorkerSupervisor
 
 __all__ = ['TModelPoolServer']
 
 logger = logging.getLogger(__name__)
 
 
-WAIT_LEN = 0
-WAIT_MESSAGE = 1
-WAIT_PROCESS = 2
-SEND_ANSWER = 3
-CLOSED = 4
-
-
 class ThreadWkr(Thread):
     def __init__(self, *args, **kwargs):
         super(ThreadWkr, self).__init__()
@@ -39,6 +35,9 @@ class ThreadWkr(Thread):
         self._callback_queue = kwargs.get('callback_queue')
         self._model_config = kwargs.get('model_config')
         self._worker_id = kwargs.get('worker_id')
+        self._ready_event = kwargs.get('ready_event')
+        self._queue_wait = kwargs.get('queue_wait')
+        self._predict_latency = kwargs.get('predict_latency')
         print("Start Thread Worker:", self._worker_id)
 
     def run(self):
@@ -49,19 +48,51 @@ class ThreadWkr(Thread):
         else:
             self._handler = self._handler_cls(**self._model_config)
         self._processor = self._processor_cls(self._handler)
+        if self._ready_event is not None:
+            self._ready_event.set()
 
         while True:
             try:
-                iprot, oprot, otrans, rsocket_fileno = self._tasks_queue.get()
+                task = self._tasks_queue.get()
+                if task is None:
+                    break
+                iprot, oprot, otrans, request_id, dispatch_time = task
+                started = time.time()
                 self._processor.process(iprot, oprot)
+                if self._predict_latency is not None:
+                    self._queue_wait.observe(started - dispatch_time)
+                    self._predict_latency.observe(time.time() - started)
                 self._callback_queue.put({"ok_all": True,
                                           "message": otrans.getvalue(),
-                                          "rsocket_fileno": rsocket_fileno})
+                                          "request_id": request_id})
             except Exception as e:
                 print(traceback.format_exc())
                 self._callback_queue.put({"ok_all": False,
                                           "message": b"",
-                                          "rsocket_fileno": rsocket_fileno})
+                                          "request_id": request_id})
+
+
+def _drop_inherited_sockets():
+    """Drops the sockets a forked worker inherited from the server.
+
+    A worker forked while clients are connected holds their sockets, so the
+    server closing one of them would not send a FIN. Each socket descriptor
+    is pointed at /dev/null rather than closed, the copies of the server
+    objects owning them are never closed in the worker.
+    """
+    fd_dir = '/proc/self/fd' if os.path.isdir('/proc/self/fd') else '/dev/fd'
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        for name in os.listdir(fd_dir):
+            fd = int(name)
+            try:
+                if fd != devnull and stat.S_ISSOCK(os.fstat(fd).st_mode):
+                    os.dup2(devnull, fd)
+            except OSError:
+                # the descriptor of the listing itself, closed by now
+                pass
+    finally:
+        os.close(devnull)
 
 
 class ProcessWrk(Process):
@@ -73,251 +104,156 @@ class ProcessWrk(Process):
         self._callback_queue = kwargs.get('callback_queue')
         self._model_config = kwargs.get('model_config')
         self._worker_id = kwargs.get('worker_id')
+        self._ready_event = kwargs.get('ready_event')
+        self._queue_wait = kwargs.get('queue_wait')
+        self._predict_latency = kwargs.get('predict_latency')
         print("Start Process Worker:", self._worker_id)
 
     def run(self):
         """Loop getting clients from the shared queue and process them"""
+        _drop_inherited_sockets()
         # Init Handler and Processor
         if len(self._model_config) == 0:
             self._handler = self._handler_cls()
         else:
             self._handler = self._handler_cls(**self._model_config)
         self._processor = self._processor_cls(self._handler)
+        if self._ready_event is not None:
+            self._ready_event.set()
 
         while True:
             try:
-                iprot, oprot, otrans, rsocket_fileno = self._tasks_queue.get()
+                task = self._tasks_queue.get()
+                if task is None:
+                    break
+                iprot, oprot, otrans, request_id, dispatch_time = task
+                started = time.time()
                 self._processor.process(iprot, oprot)
+                if self._predict_latency is not None:
+                    self._queue_wait.observe(started - dispatch_time)
+                    self._predict_latency.observe(time.time() - started)
                 self._callback_queue.put({"ok_all": True,
                                           "message": otrans.getvalue(),
-                                          "rsocket_fileno": rsocket_fileno})
+                                          "request_id": request_id})
             except Exception as e:
                 print(traceback.format_exc())
                 self._callback_queue.put({"ok_all": False,
                                           "message": b"",
-                                          "rsocket_fileno": rsocket_fileno})
-
-
-def locked(func):
-    """Decorator which locks self.lock."""
-
-    def nested(self, *args, **kwargs):
-        self.lock.acquire()
-        try:
-            return func(self, *args, **kwargs)
-        finally:
-            self.lock.release()
-    return nested
-
-
-def socket_exception(func):
-    """Decorator close object on socket.error."""
-
-    def read(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except socket.error:
-            logger.debug('ignoring socket exception', exc_info=True)
-            self.close()
-    return read
-
-
-class Message(object):
-    def __init__(self, offset, len_, header):
-        self.offset = offset
-        self.len = len_
-        self.buffer = None
-        self.is_header = header
-
-    @property
-    def end(self):
-        return self.offset + self.len
+                                          "request_id": request_id})
 
 
 class ConnectionStateChanger(threading.Thread):
-    def __init__(self, queue, clients):
+    """Completes the results of a worker, until it is gone if given."""
+
+    def __init__(self, queue, complete, worker=None, interval=0.5):
         threading.Thread.__init__(self)
         self.callback_queue = queue
-        self.clients = clients
+        self.complete = complete
+        self.worker = worker
+        self.interval = interval
 
     def run(self):
         while True:
-            callback_state = self.callback_queue.get()
-            connection = self.clients[callback_state['rsocket_fileno']]
-            connection.ready(
-                callback_state['ok_all'], callback_state['message'])
+            if self.worker is None:
+                callback_state = self.callback_queue.get()
+            else:
+                try:
+                    callback_state = self.callback_queue.get(timeout=self.interval)
+                except queue.Empty:
+                    if not self.worker.is_alive():
+                        return
+                    continue
+            if callback_state is None:
+                return
+            self.complete(callback_state)
+
+    def stop(self, timeout=None):
+        # a killed worker may hold the queue lock, exiting must not wait for it
+        self.callback_queue.cancel_join_thread()
+        self.callback_queue.put(None)
+        self.join(timeout)
 
 
 class ConnectionStateChangerAsyncIo():
-    def __init__(self, queue, clients):
+    def __init__(self, queue, complete):
         self.callback_queue = queue
-        self.clients = clients
+        self.complete = complete
 
     def _asyncio_start(self):
         while True:
             callback_state = self.callback_queue.get()
-            connection = self.clients[callback_state['rsocket_fileno']]
-            connection.ready(
-                callback_state['ok_all'], callback_state['message'])
+            self.complete(callback_state)
 
     def start(self):
         self.loop = asyncio.get_event_loop()
         self.loop.run_in_executor(executor=None, func=self._asyncio_start)
 
 
-class Connection(object):
-    """Basic class is represented connection.
-
-    It can be in state:
-        WAIT_LEN --- connection is reading request len.
-        WAIT_MESSAGE --- connection is reading request.
-        WAIT_PROCESS --- connection has just read whole request and
-                         waits for call ready routine.
-        SEND_ANSWER --- connection is sending answer string (including length
-                        of answer).
-        CLOSED --- socket was closed and connection should be deleted.
-    """
-
-    def __init__(self, new_socket, wake_up):
-        self.socket = new_socket
-        self.socket.setblocking(False)
-        self.status = WAIT_LEN
-        self.len = 0
-        self.received = deque()
-        self._reading = Message(0, 4, True)
-        self._rbuf = b''
-        self._wbuf = b''
-        self.lock = threading.Lock()
-        self.wake_up = wake_up
-        self.remaining = False
-
-    @socket_exception
-    def read(self):
-        """Reads data from stream and switch state."""
-        assert self.status in (WAIT_LEN, WAIT_MESSAGE)
-        assert not self.received
-        buf_size = 8192
-        first = True
-        done = False
-        while not done:
-            read = self.socket.recv(buf_size)
-            rlen = len(read)
-            done = rlen < buf_size
-            self._rbuf += read
-            if first and rlen == 0:
-                if self.status != WAIT_LEN or self._rbuf:
-                    logger.error('could not read frame from socket')
-                else:
-                    logger.debug(
-                        'read zero length. client might have disconnected')
-                self.close()
-            while len(self._rbuf) >= self._reading.end:
-                if self._reading.is_header:
-                    mlen, = struct.unpack('!i', self._rbuf[:4])
-                    self._reading = Message(self._reading.end, mlen, False)
-                    self.status = WAIT_MESSAGE
-                else:
-                    self._reading.buffer = self._rbuf
-                    self.received.append(self._reading)
-                    self._rbuf = self._rbuf[self._reading.end:]
-                    self._reading = Message(0, 4, True)
-                    done = True
-            first = False
-            if self.received:
-                self.status = WAIT_PROCESS
-                break
-        self.remaining = not done
-
-    @socket_exception
-    def write(self):
-        """Writes data from socket and switch state."""
-        assert self.status == SEND_ANSWER
-        sent = self.socket.send(self._wbuf)
-        if sent == len(self._wbuf):
-            self.status = WAIT_LEN
-            self._wbuf = b''
-            self.len = 0
-        else:
-            self._wbuf = self._wbuf[sent:]
-
-    @locked
-    def ready(self, all_ok, message):
-        """Callback function for switching state and waking up main thread.
-        This function is the only function witch can be called asynchronous.
-        The ready can switch Connection to three states:
-            WAIT_LEN if request was oneway.
-            SEND_ANSWER if request was processed in normal way.
-            CLOSED if request throws unexpected exception.
-
-        The one wakes up main thread.
-        """
-        assert self.status == WAIT_PROCESS
-        if not all_ok:
-            self.close()
-            self.wake_up()
-            return
-        self.len = 0
-        if len(message) == 0:
-            # it was a oneway request, do not write answer
-            self._wbuf = b''
-            self.status = WAIT_LEN
-        else:
-            self._wbuf = struct.pack('!i', len(message)) + message
-            self.status = SEND_ANSWER
-        self.wake_up()
-
-    @locked
-    def is_writeable(self):
-        """Return True if connection should be added to write list of select"""
-        return self.status == SEND_ANSWER
-
-    @locked
-    def is_readable(self):
-        """Return True if connection should be added to read list of select"""
-        return self.status in (WAIT_LEN, WAIT_MESSAGE)
-
-    @locked
-    def is_closed(self):
-        """Returns True if connection is closed."""
-        return self.status == CLOSED
-
-    def fileno(self):
-        """Returns the file descriptor of the associated socket."""
-        return self.socket.fileno()
-
-    def close(self):
-        """Closes connection"""
-        self.status = CLOSED
-        self.socket.close()
+class TModelPoolServer(object):
+    """TModelPoolServer is based on Non-blocking server.
 
+    Requests are spread over the workers by `dispatch_policy`, one of
+    'least_outstanding' (default), 'round_robin', 'random', 'p2c' (power of
+    two choices on queue depth), 'p2c_ewma' (power of two choices on EWMA
+    latency) or a DispatchPolicy instance.
 
-class TModelPoolServer(object):
-    """TModelPoolServer is based on Non-blocking server."""
+    Unless `supervise` is False, a WorkerSupervisor respawns dead workers
+    every `supervise_interval` seconds, reload() swaps in new model configs
+    without downtime and shutdown() drains pending requests before serve()
+    returns.
+    """
 
     def __init__(self, handler_cls, processor_cls, tsocket, protocol_factory, worker_type='process', *args, **kwargs):
         assert worker_type in ['process', 'thread']
         self.worker_type = worker_type
         self.handler_cls = handler_cls
         self.processor_cls = processor_cls
+        self.methods = processor_methods(processor_cls)
         self.tsocket = tsocket
         self.transport_factory = kwargs.get(
             'transport_factory')  # The default is FrameTransport
         self.protocol_factory = protocol_factory
-        self.list_model_config = kwargs.get("list_model_config", [])
-        self.clients = {}  # Store client connection
-        self.callback_queue = Queue()
-        self._read, self._write = socket.socketpair()
+        # the server's own copy, reload() writes into it
+        self.list_model_config = list(kwargs.get("list_model_config", []))
+        self.metrics = ServerMetrics()
+        self.metrics_port = kwargs.get('metrics_port')
+        self.event_loop = EventLoop(self.tsocket, self._dispatch,
+                                    kwargs.get('pipeline_depth', 1), self.metrics)
+        self.clients = self.event_loop.clients  # Store client connection
         self.list_task_queue = []  # Distribute task to Worker
+        self._result_dists = []
         self.workers = []
+        self.dispatch_policy = get_dispatch_policy(
+            kwargs.get('dispatch_policy', 'least_outstanding'))
+        self.load = WorkerLoad(len(self.list_model_config))
+        # (queue wait, predict latency) histograms written by the worker of
+        # each id, created before the workers fork, reused by their respawns
+        self.worker_histograms = []
+        for wrk_id in range(len(self.list_model_config)):
+            self.worker_histograms.append((self.metrics.queue_wait.labels(wrk_id),
+                                           self.metrics.predict_latency.labels(wrk_id)))
+            self.metrics.queue_depth.labels('worker%d' % wrk_id).set_function(
+                lambda wrk_id=wrk_id: self.load.in_flight[wrk_id])
+        # request id -> (worker id, worker, ready callback, dispatch time)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+        self.supervisor = None
+        if kwargs.get('supervise', True):
+            self.supervisor = WorkerSupervisor(
+                self, kwargs.get('supervise_interval', 1.0))
 
         self.prepared = False
         self._stop = False
+        self._drain_deadline = None
 
     def prepare(self):
         """Prepares server for serve requests."""
         if self.prepared:
             return
-        self.tsocket.listen()
+        self.event_loop.listen()
+        if self.metrics_port is not None:
+            self.metrics.serve_http(self.metrics_port)
 
         if self.worker_type == 'process':
             self.worker_cls = ProcessWrk
@@ -325,27 +261,99 @@ class TModelPoolServer(object):
             self.worker_cls = ThreadWkr
 
         for wrk_id, model_config in enumerate(self.list_model_config):
-            tasks_queue = Queue()
-            self.list_task_queue.append(tasks_queue)
             try:
-                wrk = self.worker_cls(handler_cls=self.handler_cls,
-                                      processor_cls=self.processor_cls,
-                                      connection_queue=tasks_queue,
-                                      model_config=model_config,
-                                      callback_queue=self.callback_queue,
-                                      tasks_queue=tasks_queue,
-                                      worker_id=wrk_id)
-                wrk.daemon = True
-                wrk.start()
+                wrk, tasks_queue = self._spawn_worker(wrk_id, model_config)
+                self.list_task_queue.append(tasks_queue)
                 self.workers.append(wrk)
             except Exception as x:
                 print(traceback.format_exc())
 
-        result_dist = ConnectionStateChanger(self.callback_queue, self.clients)
-        result_dist.setDaemon(True)
-        result_dist.start()
+        if self.supervisor is not None:
+            self.supervisor.start()
         self.prepared = True
 
+    def _spawn_worker(self, wrk_id, model_config, ready_event=None, histograms=None):
+        """Starts a worker with its own task and result queues.
+
+        A worker killed while writing a result leaves the lock of its result
+        queue held, so no other worker shares it. The worker writes
+        `histograms`, by default the ones of `wrk_id`.
+        """
+        queue_wait, predict_latency = histograms or self.worker_histograms[wrk_id]
+        tasks_queue = Queue()
+        callback_queue = Queue()
+        wrk = self.worker_cls(handler_cls=self.handler_cls,
+                              processor_cls=self.processor_cls,
+                              connection_queue=tasks_queue,
+                              model_config=model_config,
+                              callback_queue=callback_queue,
+                              tasks_queue=tasks_queue,
+                              worker_id=wrk_id,
+                              ready_event=ready_event,
+                              queue_wait=queue_wait,
+                              predict_latency=predict_latency)
+        wrk.daemon = True
+        wrk.start()
+        result_dist = ConnectionStateChanger(callback_queue, self._complete, wrk)
+        result_dist.daemon = True
+        result_dist.start()
+        self._result_dists.append(result_dist)
+        return wrk, tasks_queue
+
+    def _replace_worker(self, wrk_id, wrk, tasks_queue, histograms=None):
+        """Sends the next requests of `wrk_id` to `wrk`, returns the old worker and queue."""
+        with self._pending_lock:
+            old = self.workers[wrk_id], self.list_task_queue[wrk_id]
+            self.workers[wrk_id] = wrk
+            self.list_task_queue[wrk_id] = tasks_queue
+            if histograms is not None:
+                self.worker_histograms[wrk_id] = histograms
+        return old
+
+    def _export_worker_histograms(self, wrk_id):
+        """Exports the histograms of `wrk_id`, once their worker is the only writer."""
+        queue_wait, predict_latency = self.worker_histograms[wrk_id]
+        self.metrics.queue_wait.add(queue_wait, wrk_id)
+        self.metrics.predict_latency.add(predict_latency, wrk_id)
+
+    def _stop_worker(self, wrk, tasks_queue, timeout):
+        tasks_queue.put(None)
+        wrk.join(timeout)
+        if wrk.is_alive() and hasattr(wrk, 'terminate'):
+            wrk.terminate()
+
+    def _num_pending(self, wrk):
+        with self._pending_lock:
+            return sum(1 for entry in self._pending.values() if entry[1] is wrk)
+
+    def _fail_pending(self, wrk):
+        """Fails the requests `wrk` will never answer, closing their connections."""
+        with self._pending_lock:
+            lost = [request_id for request_id, entry in self._pending.items()
+                    if entry[1] is wrk]
+            for request_id in lost:
+                wrk_id, _, ready, _ = self._pending.pop(request_id)
+                self.load.on_drop(wrk_id)
+                ready(False, b'')
+        if lost:
+            logger.warning('Failed %d requests of a stopped model worker', len(lost))
+
+    def _complete(self, callback_state):
+        """Answers a request with the result of its worker."""
+        with self._pending_lock:
+            entry = self._pending.pop(callback_state['request_id'], None)
+            if entry is None:
+                # already failed, its worker was given up on
+                return
+            wrk_id, _, ready, dispatch_time = entry
+            self.load.on_complete(wrk_id, time.time() - dispatch_time)
+            ready(callback_state['ok_all'], callback_state['message'])
+
+    def reload(self, list_model_config, warmup_timeout=None, drain_timeout=None):
+        """Rolls new model configs over the workers, see WorkerSupervisor.reload()."""
+        assert self.supervisor is not None, "reload needs a supervised server"
+        self.supervisor.reload(list_model_config, warmup_timeout, drain_timeout)
+
     def wake_up(self):
         """Wake up main thread.
 
@@ -357,7 +365,7 @@ class TModelPoolServer(object):
         In this case, we can just write anything to the second socket from
         socketpair.
         """
-        self._write.send(b'1')
+        self.event_loop.wake_up()
 
     def stop(self):
         """Stop the server.
@@ -374,72 +382,77 @@ class TModelPoolServer(object):
         self._stop = True
         self.wake_up()
 
-    def _select(self):
-        """Does select on open connections."""
-        readable = [self.tsocket.handle.fileno(), self._read.fileno()]
-        writable = []
-        remaining = []
-        for i, connection in list(self.clients.items()):
-            if connection.is_readable():
-                readable.append(connection.fileno())
-                if connection.remaining or connection.received:
-                    remaining.append(connection.fileno())
-            if connection.is_writeable():
-                writable.append(connection.fileno())
-            if connection.is_closed():
-                del self.clients[i]
-        if remaining:
-            return remaining, [], [], False
-        else:
-            return select.select(readable, writable, readable) + (True,)
-
-    def handle(self):
+    def _dispatch(self, fileno, connection, msg):
+        """Hands a complete request to the worker chosen by the dispatch policy."""
+        itransport = msg.transport(TTransport.TMemoryBuffer)
+        otransport = TTransport.TMemoryBuffer()
+        iprot = self.protocol_factory.getProtocol(itransport)
+        oprot = self.protocol_factory.getProtocol(otransport)
+
+        self.metrics.count_request(self.protocol_factory, TTransport.TMemoryBuffer, msg, self.methods)
+        wrk_id = self.dispatch_policy.choose(self.load)
+        request_id = next(self._request_ids)
+        with self._pending_lock:
+            wrk = self.workers[wrk_id]
+            tasks_queue = self.list_task_queue[wrk_id]
+            self._pending[request_id] = (wrk_id, wrk, msg.ready, time.time())
+        self.load.on_dispatch(wrk_id)
+        tasks_queue.put([iprot, oprot, otransport, request_id, time.time()])
+
+    def stats(self):
+        """Returns the load of every worker."""
+        stats = {'workers': self.load.stats()}
+        if self.supervisor is not None:
+            stats['num_respawned'] = self.supervisor.num_respawned
+        return stats
+
+    def handle(self, timeout=None):
         """Handle requests.
 
         WARNING! You must call prepare() BEFORE calling handle()
         """
         assert self.prepared, "You have to call prepare before handle"
-        rset, wset, xset, selected = self._select()
-        for readable in rset:
-            if readable == self._read.fileno():
-                # don't care i just need to clean readable flag
-                self._read.recv(1024)
-            elif readable == self.tsocket.handle.fileno():
-                try:
-                    client = self.tsocket.accept()
-                    if client:
-                        self.clients[client.handle.fileno()] = Connection(client.handle,
-                                                                          self.wake_up)
-                except socket.error:
-                    logger.debug('error while accepting', exc_info=True)
-            else:
-                connection = self.clients[readable]
-                if selected:
-                    connection.read()
-                if connection.received:
-                    connection.status = WAIT_PROCESS
-                    msg = connection.received.popleft()
-                    itransport = TTransport.TMemoryBuffer(
-                        msg.buffer, msg.offset)
-                    otransport = TTransport.TMemoryBuffer()
-                    iprot = self.protocol_factory.getProtocol(itransport)
-                    oprot = self.protocol_factory.getProtocol(otransport)
-
-                    rand_idx = random.randint(0, len(self.list_task_queue) - 1)
-                    self.list_task_queue[rand_idx].put(
-                        [iprot, oprot, otransport, readable])
-
-        for writeable in wset:
-            self.clients[writeable].write()
-        for oob in xset:
-            self.clients[oob].close()
-            del self.clients[oob]
+        self.event_loop.handle(timeout)
 
     def serve(self):
         """Serve requests.
-        Serve requests forever, or until stop() is called.
+        Serve requests forever, or until stop() or shutdown() is called.
         """
         self._stop = False
         self.prepare()
         while not self._stop:
-            self.handle()
+            if self._drain_deadline is None:
+                self.handle()
+                continue
+            self.handle(0.05)
+            if self._drained():
+                self.close()
+                break
+
+    def shutdown(self, timeout=None):
+        """Stops accepting connections and makes serve() return once drained.
+
+        Pending requests get up to `timeout` seconds to be answered, then
+        the workers are stopped and the server closed. May be invoked from
+        another thread, e.g. a signal handler.
+        """
+        self._drain_deadline = time.time() + timeout if timeout is not None else float('inf')
+        self.wake_up()
+
+    def _drained(self):
+        self.event_loop.stop_accepting()
+        if time.time() >= self._drain_deadline:
+            logger.warning('Shutting down with %d pending requests', len(self._pending))
+            return True
+        return not self._pending and not self.event_loop.has_pending_writes()
+
+    def close(self):
+        """Stops the workers and closes the server socket and all connections."""
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        for wrk, tasks_queue in zip(self.workers, self.list_task_queue):
+            self._stop_worker(wrk, tasks_queue, 1.0)
+        for result_dist in self._result_dists:
+            result_dist.stop(1.0)
+        self.event_loop.close()
+        self.metrics.close()
@@ -0,0 +1,104 @@
+import logging
+import multiprocessing
+import threading
+import time
+
+from ..metrics import Histogram
+
+__all__ = ['WorkerSupervisor']
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSupervisor(threading.Thread):
+    """Keeps the model workers of a TModelPoolServer alive.
+
+    Every `interval` seconds dead workers are replaced by a new one with the
+    same model config, requests they held are failed so their clients do
+    not wait forever.
+
+    reload() rolls new model configs over the workers one at a time: the
+    new worker is started and warmed up while the old one keeps serving,
+    then requests go to the new one and the old one is stopped once its
+    pending requests are answered. The new worker writes its own histograms,
+    exported in place of the old ones after the drain.
+    """
+
+    def __init__(self, server, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.interval = interval
+        self.num_respawned = 0
+        # serializes respawns and reload swaps
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                for wrk_id, wrk in enumerate(list(self.server.workers)):
+                    if not wrk.is_alive() and not self._stopped.is_set():
+                        self._respawn(wrk_id, wrk)
+
+    def _respawn(self, wrk_id, wrk):
+        logger.error('Model worker %s died (exitcode %s), respawning',
+                     wrk_id, getattr(wrk, 'exitcode', None))
+        # clients of the dead worker get their error before the new one starts
+        self.server._fail_pending(wrk)
+        new_wrk, tasks_queue = self.server._spawn_worker(
+            wrk_id, self.server.list_model_config[wrk_id])
+        # requests queue up for the new worker while it loads its model
+        self.server._replace_worker(wrk_id, new_wrk, tasks_queue)
+        # and the ones dispatched to the dead worker in the meantime
+        self.server._fail_pending(wrk)
+        self.num_respawned += 1
+
+    def reload(self, list_model_config, warmup_timeout=None, drain_timeout=None):
+        """Replaces the workers one by one with the given model configs.
+
+        Raises RuntimeError if a new worker dies or is not warmed up within
+        `warmup_timeout` seconds, workers already replaced keep their new
+        config. Old workers get `drain_timeout` seconds to answer their
+        pending requests, the ones left are failed.
+        """
+        assert len(list_model_config) == len(self.server.workers)
+        for wrk_id, model_config in enumerate(list_model_config):
+            ready_event = multiprocessing.Event()
+            # the old worker writes its histograms until it is drained
+            histograms = (Histogram(), Histogram())
+            new_wrk, tasks_queue = self.server._spawn_worker(
+                wrk_id, model_config, ready_event, histograms)
+            if not self._wait_ready(new_wrk, ready_event, warmup_timeout):
+                self.server._stop_worker(new_wrk, tasks_queue, 0)
+                raise RuntimeError('Model worker %s failed to warm up with %r'
+                                   % (wrk_id, model_config))
+            with self._lock:
+                self.server.list_model_config[wrk_id] = model_config
+                old_wrk, old_queue = self.server._replace_worker(
+                    wrk_id, new_wrk, tasks_queue, histograms)
+            logger.info('Model worker %s reloaded, draining the old one', wrk_id)
+            self.drain(old_wrk, old_queue, drain_timeout)
+            self.server._export_worker_histograms(wrk_id)
+
+    def _wait_ready(self, wrk, ready_event, timeout):
+        deadline = time.time() + timeout if timeout is not None else None
+        while not ready_event.wait(self.interval):
+            if not wrk.is_alive():
+                return False
+            if deadline is not None and time.time() >= deadline:
+                return False
+        return True
+
+    def drain(self, wrk, tasks_queue, timeout=None):
+        """Waits for the requests pending on `wrk`, then stops it."""
+        deadline = time.time() + timeout if timeout is not None else None
+        while self.server._num_pending(wrk) and wrk.is_alive():
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.01)
+        self.server._stop_worker(wrk, tasks_queue, self.interval)
+        self.server._fail_pending(wrk)
+
+    def stop(self):
+        self._stopped.set()
@@ -1,25 +1,28 @@
 from time import time
 import logging
-import select
-import socket
-import struct
 import threading
-from collections import deque
 from six.moves import queue
 from zaailabcorelib.thrift.transport import TTransport
 from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
+from ..metrics import ServerMetrics, processor_methods
+from ..nonblocking import EventLoop
 logger = logging.getLogger(__name__)
 
 __all__ = ['THandlerPoolServer']
 
 class Worker(threading.Thread):
     """Worker is a small helper to process incoming connection."""
-    def __init__(self, thread_id, queue, processor_cls, handler_cls):
+    def __init__(self, thread_id, queue, processor_cls, handler_cls, metrics=None):
         threading.Thread.__init__(self)
         self.thread_id = thread_id
         self.queue = queue
         self.processor_cls = processor_cls
         self.handler_cls = handler_cls
+        self.queue_wait = None
+        self.predict_latency = None
+        if metrics is not None:
+            self.queue_wait = metrics.queue_wait.labels(thread_id)
+            self.predict_latency = metrics.predict_latency.labels(thread_id)
 
     def run(self):
         """Process queries from task queue, stop if processor is None."""
@@ -27,189 +30,20 @@ class Worker(threading.Thread):
         self.processor = self.processor_cls(self.handler)
         while True:
             try:
-                iprot, oprot, otrans, callback = self.queue.get()
+                iprot, oprot, otrans, callback, enqueued_at = self.queue.get()
+                if iprot is None:
+                    break
+                started = time()
                 self.processor.process(iprot, oprot)
+                if self.predict_latency is not None:
+                    self.queue_wait.observe(started - enqueued_at)
+                    self.predict_latency.observe(time() - started)
                 callback(True, otrans.getvalue())
             except Exception:
                 logger.exception(
                     "Exception while processing request")
                 callback(False, b'')
 
-WAIT_LEN = 0
-WAIT_MESSAGE = 1
-WAIT_PROCESS = 2
-SEND_ANSWER = 3
-CLOSED = 4
-
-def locked(func):
-    """Decorator which locks self.lock."""
-
-    def nested(self, *args, **kwargs):
-        self.lock.acquire()
-        try:
-            return func(self, *args, **kwargs)
-        finally:
-            self.lock.release()
-    return nested
-
-
-def socket_exception(func):
-    """Decorator close object on socket.error."""
-
-    def read(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except socket.error:
-            logger.exception('ignoring socket exception')
-            self.close()
-    return read
-
-
-class Message(object):
-    def __init__(self, offset, len_, header):
-        self.offset = offset
-        self.len = len_
-        self.buffer = None
-        self.is_header = header
-
-    @property
-    def end(self):
-        return self.offset + self.len
-
-
-class Connection(object):
-    """Basic class is represented connection.
-
-    It can be in state:
-        WAIT_LEN --- connection is reading request len.
-        WAIT_MESSAGE --- connection is reading request.
-        WAIT_PROCESS --- connection has just read whole request and
-                         waits for call ready routine.
-        SEND_ANSWER --- connection is sending answer string (including length
-                        of answer).
-        CLOSED --- socket was closed and connection should be deleted.
-    """
-
-    def __init__(self, new_socket, wake_up):
-        self.socket = new_socket
-        self.socket.setblocking(False)
-        self.status = WAIT_LEN
-        self.len = 0
-        self.received = deque()
-        self._reading = Message(0, 4, True)
-        self._rbuf = b''
-        self._wbuf = b''
-        self.lock = threading.Lock()
-        self.wake_up = wake_up
-        self.remaining = False
-
-    @socket_exception
-    def read(self):
-        """Reads data from stream and switch state."""
-        assert self.status in (WAIT_LEN, WAIT_MESSAGE)
-        assert not self.received
-        buf_size = 8192
-        first = True
-        done = False
-
-        while not done:
-            read = self.socket.recv(buf_size)
-            rlen = len(read)
-            done = rlen < buf_size
-            self._rbuf += read
-            if first and rlen == 0:
-                if self.status != WAIT_LEN or self._rbuf:
-                    logger.exception('could not read frame from socket')
-                else:
-                    logger.exception(
-                        'read zero length. client might have disconnected')
-
-                self.close()
-
-            while len(self._rbuf) >= self._reading.end:
-                if self._reading.is_header:
-                    mlen, = struct.unpack('!i', self._rbuf[:4])
-                    self._reading = Message(self._reading.end, mlen, False)
-                    self.status = WAIT_MESSAGE
-                else:
-                    self._reading.buffer = self._rbuf
-                    self.received.append(self._reading)
-                    self._rbuf = self._rbuf[self._reading.end:]
-                    self._reading = Message(0, 4, True)
-                    done = True
-
-            first = False
-            if self.received:
-                self.status = WAIT_PROCESS
-                break
-
-        self.remaining = not done
-
-    @socket_exception
-    def write(self):
-        """Writes data from socket and switch state."""
-        assert self.status == SEND_ANSWER
-        sent = self.socket.send(self._wbuf)
-        if sent == len(self._wbuf):
-            self.status = WAIT_LEN
-            self._wbuf = b''
-            self.len = 0
-        else:
-            self._wbuf = self._wbuf[sent:]
-
-    @locked
-    def ready(self, all_ok, message):
-        """Callback function for switching state and waking up main thread.
-
-        This function is the only function witch can be called asynchronous.
-
-        The ready can switch Connection to three states:
-            WAIT_LEN if request was oneway.
-            SEND_ANSWER if request was processed in normal way.
-            CLOSED if request throws unexpected exception.
-
-        The one wakes up main thread.
-        """
-        assert self.status == WAIT_PROCESS
-        if not all_ok:
-            self.close()
-            self.wake_up()
-            return
-        self.len = 0
-        if len(message) == 0:
-            # it was a oneway request, do not write answer
-            self._wbuf = b''
-            self.status = WAIT_LEN
-        else:
-            self._wbuf = struct.pack('!i', len(message)) + message
-            self.status = SEND_ANSWER
-        self.wake_up()
-
-    @locked
-    def is_writeable(self):
-        """Return True if connection should be added to write list of select"""
-        return self.status == SEND_ANSWER
-
-    @locked
-    def is_readable(self):
-        """Return True if connection should be added to read list of select"""
-        return self.status in (WAIT_LEN, WAIT_MESSAGE)
-
-    @locked
-    def is_closed(self):
-        """Returns True if connection is closed."""
-        return self.status == CLOSED
-
-    def fileno(self):
-        """Returns the file descriptor of the associated socket."""
-        return self.socket.fileno()
-
-    def close(self):
-        """Closes connection"""
-        self.status = CLOSED
-        self.socket.close()
-
-
 class THandlerPoolServer(object):
     """Handler Pool Server."""
 
@@ -219,16 +53,22 @@ class THandlerPoolServer(object):
                  socket,
                  inputProtocolFactory=None,
                  outputProtocolFactory=None,
-                 threads=10):
+                 threads=10,
+                 pipeline_depth=1,
+                 metrics_port=None):
         self.handler_cls = handler_cls
         self.processor_cls = processor_cls
+        self.methods = processor_methods(processor_cls)
         self.socket = socket
         self.in_protocol = inputProtocolFactory or TBinaryProtocolFactory()
         self.out_protocol = outputProtocolFactory or self.in_protocol
         self.threads = int(threads)
-        self.clients = {}
         self.tasks = queue.Queue()
-        self._read, self._write = socket.socketpair()
+        self.metrics = ServerMetrics()
+        self.metrics.watch_queue('tasks', self.tasks)
+        self.metrics_port = metrics_port
+        self.event_loop = EventLoop(self.socket, self._dispatch, pipeline_depth, self.metrics)
+        self.clients = self.event_loop.clients
         self.prepared = False
         self._stop = False
         self.list_workers = []
@@ -242,10 +82,12 @@ class THandlerPoolServer(object):
         """Prepares server for serve requests."""
         if self.prepared:
             return
-        self.socket.listen()
+        self.event_loop.listen()
+        if self.metrics_port is not None:
+            self.metrics.serve_http(self.metrics_port)
         for idx in range(self.threads):
             thread = Worker(idx, self.tasks,
-                            self.processor_cls, self.handler_cls)
+                            self.processor_cls, self.handler_cls, self.metrics)
             thread.setDaemon(True)
             thread.start()
             self.list_workers.append(thread)
@@ -262,7 +104,7 @@ class THandlerPoolServer(object):
         In this case, we can just write anything to the second socket from
         socketpair.
         """
-        self._write.send(b'1')
+        self.event_loop.wake_up()
 
     def stop(self):
         """Stop the server.
@@ -279,24 +121,14 @@ class THandlerPoolServer(object):
         self._stop = True
         self.wake_up()
 
-    def _select(self):
-        """Does select on open connections."""
-        readable = [self.socket.handle.fileno(), self._read.fileno()]
-        writable = []
-        remaining = []
-        for i, connection in list(self.clients.items()):
-            if connection.is_readable():
-                readable.append(connection.fileno())
-                if connection.remaining or connection.received:
-                    remaining.append(connection.fileno())
-            if connection.is_writeable():
-                writable.append(connection.fileno())
-            if connection.is_closed():
-                del self.clients[i]
-        if remaining:
-            return remaining, [], [], False
-        else:
-            return select.select(readable, writable, readable) + (True,)
+    def _dispatch(self, fileno, connection, msg):
+        """Hands a complete request to the worker threads."""
+        itransport = msg.transport(TTransport.TMemoryBuffer)
+        otransport = TTransport.TMemoryBuffer()
+        iprot = self.in_protocol.getProtocol(itransport)
+        oprot = self.out_protocol.getProtocol(otransport)
+        self.metrics.count_request(self.in_protocol, TTransport.TMemoryBuffer, msg, self.methods)
+        self.tasks.put([iprot, oprot, otransport, msg.ready, time()])
 
     def handle(self):
         """Handle requests.
@@ -304,47 +136,14 @@ class THandlerPoolServer(object):
         WARNING! You must call prepare() BEFORE calling handle()
         """
         assert self.prepared, "You have to call prepare before handle"
-        rset, wset, xset, selected = self._select()
-        for readable in rset:
-            if readable == self._read.fileno():
-                # don't care i just need to clean readable flag
-                self._read.recv(1024)
-            elif readable == self.socket.handle.fileno():
-                try:
-                    client = self.socket.accept()
-                    if client:
-                        self.clients[client.handle.fileno()] = Connection(client.handle,
-                                                                          self.wake_up)
-                except socket.error:
-                    logger.exception('error while accepting')
-            else:
-                connection = self.clients[readable]
-                if selected:
-                    connection.read()
-                if connection.received:
-                    connection.status = WAIT_PROCESS
-                    msg = connection.received.popleft()
-                    itransport = TTransport.TMemoryBuffer(
-                        msg.buffer, msg.offset)
-                    otransport = TTransport.TMemoryBuffer()
-                    iprot = self.in_protocol.getProtocol(itransport)
-                    oprot = self.out_protocol.getProtocol(otransport)
-
-                    self.tasks.put([iprot, oprot,
-                                    otransport, connection.ready])
-
-        for writeable in wset:
-            self.clients[writeable].write()
-
-        for oob in xset:
-            self.clients[oob].close()
-            del self.clients[oob]
+        self.event_loop.handle()
 
     def close(self):
         """Closes the server."""
         for _ in range(self.threads):
-            self.tasks.put([None, None, None, None])
-        self.socket.close()
+            self.tasks.put([None, None, None, None, None])
+        self.event_loop.close()
+        self.metrics.close()
         self.prepared = False
 
     def serve(self):
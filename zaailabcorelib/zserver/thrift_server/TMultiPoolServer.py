@@ -1,35 +1,43 @@
 
+import concurrent.futures
 import time
-from queue import Empty
 from multiprocessing import Queue
 import multiprocessing
 import logging
-import select
-import socket
-import struct
 import threading
-from collections import deque
+from contextlib import contextmanager
 from six.moves import queue
 from zaailabcorelib.thrift.transport import TTransport
 from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
-from .utils import current_milli_time, current_nano_time
+from ..metrics import Histogram, ServerMetrics, processor_methods
+from .batcher import DynamicBatcher
+from .dispatcher import ResultDispatcher
+from .shm import SharedMemoryRing, ShmArrayRef
+from ..nonblocking import EventLoop
 logger = logging.getLogger(__name__)
 
 __all__ = ['TMultiPoolServer', 'TModelBase', 'THandlerBase']
 
 
 class TModelBase(multiprocessing.Process):
-    def __init__(self, inference_queue, result_dict, model_config, batch_infer_size=1, batch_timeout=10):
+    def __init__(self, inference_queue, result_queues, model_config, batch_infer_size=1, batch_timeout=10, shm_ring=None):
         super(TModelBase, self).__init__()
         self.inference_queue = inference_queue
-        self.result_dict = result_dict
+        self.result_queues = result_queues
+        self.shm_ring = shm_ring
         self.batch_infer_size = batch_infer_size
         self.batch_timeout_in_sec = self._microsec_to_sec(batch_timeout)
         self.batch_timeout = batch_timeout
+        # created before the fork, so the server can read its histograms
+        self.batcher = DynamicBatcher(inference_queue,
+                                      max_batch_size=batch_infer_size,
+                                      max_wait=self.batch_timeout_in_sec,
+                                      shm_ring=shm_ring)
+        self.predict_latency = Histogram()
         self.model = self.model_init(model_config)
 
     def _microsec_to_sec(self, microsec):
-        return microsec/1000
+        return microsec / 1000000
 
     def model_init(self, model_config: dict):
         raise NotImplementedError
@@ -37,63 +45,115 @@ class TModelBase(multiprocessing.Process):
     def predict(self, list_input):
         raise NotImplementedError
 
-    # def run(self):
-    #     list_inference = []
-    #     list_request_id = []
-    #     while True:
-    #         t = current_milli_time()
-    #         while (len(list_inference) < self.batch_infer_size) and current_milli_time() - t < self.batch_timeout:
-    #             try:
-    #                 [request_id, inp] = self.inference_queue.get(block=True, timeout=self.batch_timeout_in_sec)
-    #                 list_inference.append(inp)
-    #                 list_request_id.append(request_id)
-    #             except Empty:
-    #                 pass
-    #             t = current_milli_time()
-    #         list_result = self.predict(list_inference)
-    #         for [_id, res] in zip(list_request_id, list_result):
-    #             self.result_dict.update({_id:res})
-    #         list_request_id.clear()
-    #         list_inference.clear()
+    def send_results(self, list_route, list_request_id, list_inference):
+        """Predicts a batch and pushes results back, one message per route."""
+        list_ref = list_inference
+        if self.shm_ring is not None:
+            list_inference = [self.shm_ring.view(inp) if isinstance(inp, ShmArrayRef) else inp
+                              for inp in list_ref]
+        started = time.time()
+        try:
+            list_result = self.predict(list_inference)
+            list_error = [None] * len(list_inference)
+            self.predict_latency.observe(time.time() - started)
+        except Exception as e:
+            logger.exception("Exception while predicting batch")
+            list_result = [None] * len(list_inference)
+            list_error = [RuntimeError(repr(e))] * len(list_inference)
+        batches = {}
+        for route, _id, ref, res, err in zip(list_route, list_request_id, list_ref, list_result, list_error):
+            if isinstance(ref, ShmArrayRef):
+                # the output reuses the slot of its input when it fits
+                if err is None and self.shm_ring.fits(res):
+                    res = self.shm_ring.store(ref.slot, res)
+                else:
+                    self.shm_ring.release(ref)
+            batches.setdefault(route, []).append((_id, res, err))
+        for route, batch in batches.items():
+            self.result_queues[route].put(batch)
 
     def run(self):
-        list_inference = []
-        list_request_id = []
         while True:
-            while True:
-                try:
-                    # , timeout=self.batch_timeout_in_sec)
-                    [request_id, inp] = self.inference_queue.get(block=False)
-                    list_inference.append(inp)
-                    list_request_id.append(request_id)
-                    if (len(list_inference) < self.batch_infer_size):
-                        continue
-                except Empty:
-                    break
+            list_route, list_request_id, list_inference = self.batcher.next_batch()
             if len(list_inference) != 0:
-                list_result = self.predict(list_inference)
-                for [_id, res] in zip(list_request_id, list_result):
-                    self.result_dict.update({_id: res})
-                list_request_id.clear()
-                list_inference.clear()
+                self.send_results(list_route, list_request_id, list_inference)
+
+    def stats(self):
+        """Returns batching histograms, readable from the server process."""
+        stats = self.batcher.stats()
+        stats['predict'] = self.predict_latency.snapshot()
+        return stats
+
+    def export_metrics(self, metrics, worker):
+        """Adds the histograms of this model to a ServerMetrics."""
+        metrics.batch_size.add(self.batcher.batch_size_hist, worker)
+        metrics.queue_wait.add(self.batcher.queue_wait_hist, worker)
+        metrics.predict_latency.add(self.predict_latency, worker)
 
 
 class THandlerBase():
-    def __init__(self, inference_queue, result_dict):
+    def __init__(self, inference_queue, result_dispatcher, shm_ring=None):
         self.inference_queue = inference_queue
-        self.result_dict = result_dict
+        self.result_dispatcher = result_dispatcher
+        self.shm_ring = shm_ring
 
-    def send_to_model(self, input_val):
-        request_id = current_nano_time()
-        input_ = self.process_input(input_val)
-        self.inference_queue.put([request_id, input_], block=False)
-        done = False
-        while not done:
-            result = self.result_dict.get(request_id, None)
-            if result is not None:
-                done = True
+    def send_to_model(self, input_val, timeout=None):
+        """Sends an input to the model pool and waits for its result.
+
+        Raises concurrent.futures.TimeoutError if no result arrives within
+        `timeout` seconds, model processes skip the request once its deadline
+        has passed.
+        """
+        result = self._submit(input_val, timeout)
+        if isinstance(result, ShmArrayRef):
+            try:
+                return self.shm_ring.view(result).copy()
+            finally:
+                self.shm_ring.release(result)
         return result
 
+    @contextmanager
+    def borrow_from_model(self, input_val, timeout=None):
+        """Like send_to_model, but does not copy array results.
+
+        With a shared memory ring, an array result is a view of its slot
+        which is only valid inside the with block.
+        """
+        result = self._submit(input_val, timeout)
+        try:
+            if isinstance(result, ShmArrayRef):
+                yield self.shm_ring.view(result)
+            else:
+                yield result
+        finally:
+            if self.shm_ring is not None:
+                self.shm_ring.discard(result)
+
+    def _submit(self, input_val, timeout):
+        input_ = self.process_input(input_val)
+        if self.shm_ring is not None and self.shm_ring.fits(input_):
+            input_ = self.shm_ring.put(input_, timeout)
+        request_id, future = self.result_dispatcher.register()
+        now = time.time()
+        deadline = now + timeout if timeout is not None else None
+        try:
+            self.inference_queue.put(
+                [self.result_dispatcher.route, request_id, input_, now, deadline], block=False)
+        except Exception:
+            self.result_dispatcher.discard(request_id)
+            if self.shm_ring is not None:
+                self.shm_ring.discard(input_)
+            raise
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.result_dispatcher.discard(request_id)
+            if not future.cancel() and future.exception() is None:
+                # the result raced the timeout, free it like the dispatcher would
+                if self.shm_ring is not None:
+                    self.shm_ring.discard(future.result())
+            raise
+
     def process_input(self, input):
         raise NotImplementedError
 
@@ -101,19 +161,22 @@ class THandlerBase():
 class ConnectionSink(threading.Thread):
     """Worker is a small helper to process incoming connection."""
 
-    def __init__(self, thread_id, queue, processor_cls, handler_cls, inference_queue, result_dict):
+    def __init__(self, thread_id, queue, processor_cls, handler_cls, inference_queue, result_dispatcher,
+                 shm_ring=None):
         threading.Thread.__init__(self)
         self.thread_id = thread_id
         self.queue = queue
         self.processor_cls = processor_cls
         self.handler_cls = handler_cls
         self.inference_queue = inference_queue
-        self.result_dict = result_dict
+        self.result_dispatcher = result_dispatcher
+        self.shm_ring = shm_ring
 
     def run(self):
         """Process queries from task queue, stop if processor is None."""
         self.handler = self.handler_cls(
-            inference_queue=self.inference_queue, result_dict=self.result_dict)
+            inference_queue=self.inference_queue, result_dispatcher=self.result_dispatcher,
+            shm_ring=self.shm_ring)
         self.processor = self.processor_cls(self.handler)
         while True:
             try:
@@ -128,178 +191,6 @@ class ConnectionSink(threading.Thread):
                 callback(False, b'')
 
 
-WAIT_LEN = 0
-WAIT_MESSAGE = 1
-WAIT_PROCESS = 2
-SEND_ANSWER = 3
-CLOSED = 4
-
-
-def locked(func):
-    """Decorator which locks self.lock."""
-
-    def nested(self, *args, **kwargs):
-        self.lock.acquire()
-        try:
-            return func(self, *args, **kwargs)
-        finally:
-            self.lock.release()
-    return nested
-
-
-def socket_exception(func):
-    """Decorator close object on socket.error."""
-
-    def read(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except socket.error:
-            logger.debug('ignoring socket exception', exc_info=True)
-            self.close()
-    return read
-
-
-class Message(object):
-    def __init__(self, offset, len_, header):
-        self.offset = offset
-        self.len = len_
-        self.buffer = None
-        self.is_header = header
-
-    @property
-    def end(self):
-        return self.offset + self.len
-
-
-class Connection(object):
-    """Basic class is represented connection.
-
-    It can be in state:
-        WAIT_LEN --- connection is reading request len.
-        WAIT_MESSAGE --- connection is reading request.
-        WAIT_PROCESS --- connection has just read whole request and
-                         waits for call ready routine.
-        SEND_ANSWER --- connection is sending answer string (including length
-                        of answer).
-        CLOSED --- socket was closed and connection should be deleted.
-    """
-
-    def __init__(self, new_socket, wake_up):
-        self.socket = new_socket
-        self.socket.setblocking(False)
-        self.status = WAIT_LEN
-        self.len = 0
-        self.received = deque()
-        self._reading = Message(0, 4, True)
-        self._rbuf = b''
-        self._wbuf = b''
-        self.lock = threading.Lock()
-        self.wake_up = wake_up
-        self.remaining = False
-
-    @socket_exception
-    def read(self):
-        """Reads data from stream and switch state."""
-        assert self.status in (WAIT_LEN, WAIT_MESSAGE)
-        assert not self.received
-        buf_size = 8192
-        first = True
-        done = False
-        while not done:
-            read = self.socket.recv(buf_size)
-            rlen = len(read)
-            done = rlen < buf_size
-            self._rbuf += read
-            if first and rlen == 0:
-                if self.status != WAIT_LEN or self._rbuf:
-                    logger.error('could not read frame from socket')
-                else:
-                    logger.debug(
-                        'read zero length. client might have disconnected')
-                self.close()
-            while len(self._rbuf) >= self._reading.end:
-                if self._reading.is_header:
-                    mlen, = struct.unpack('!i', self._rbuf[:4])
-                    self._reading = Message(self._reading.end, mlen, False)
-                    self.status = WAIT_MESSAGE
-                else:
-                    self._reading.buffer = self._rbuf
-                    self.received.append(self._reading)
-                    self._rbuf = self._rbuf[self._reading.end:]
-                    self._reading = Message(0, 4, True)
-                    done = True
-            first = False
-            if self.received:
-                self.status = WAIT_PROCESS
-                break
-        self.remaining = not done
-
-    @socket_exception
-    def write(self):
-        """Writes data from socket and switch state."""
-        assert self.status == SEND_ANSWER
-        sent = self.socket.send(self._wbuf)
-        if sent == len(self._wbuf):
-            self.status = WAIT_LEN
-            self._wbuf = b''
-            self.len = 0
-        else:
-            self._wbuf = self._wbuf[sent:]
-
-    @locked
-    def ready(self, all_ok, message):
-        """Callback function for switching state and waking up main thread.
-
-        This function is the only function witch can be called asynchronous.
-
-        The ready can switch Connection to three states:
-            WAIT_LEN if request was oneway.
-            SEND_ANSWER if request was processed in normal way.
-            CLOSED if request throws unexpected exception.
-
-        The one wakes up main thread.
-        """
-        assert self.status == WAIT_PROCESS
-        if not all_ok:
-            self.close()
-            self.wake_up()
-            return
-        self.len = 0
-        if len(message) == 0:
-            # it was a oneway request, do not write answer
-            self._wbuf = b''
-            self.status = WAIT_LEN
-        else:
-            self._wbuf = struct.pack('!i', len(message)) + message
-            self.status = SEND_ANSWER
-        self.wake_up()
-
-    @locked
-    def is_writeable(self):
-        """Return True if connection should be added to write list of select"""
-        return self.status == SEND_ANSWER
-
-    # it's not necessary, but...
-    @locked
-    def is_readable(self):
-        """Return True if connection should be added to read list of select"""
-        return self.status in (WAIT_LEN, WAIT_MESSAGE)
-
-    @locked
-    def is_closed(self):
-        """Returns True if connection is closed."""
-        return self.status == CLOSED
-
-    def fileno(self):
-        """Returns the file descriptor of the associated socket."""
-        return self.socket.fileno()
-
-    def close(self):
-        """Closes connection"""
-        self.status = CLOSED
-        self.socket.close()
-
-
 class TMultiPoolServer(object):
     """TMultiPoolServer."""
 
@@ -314,31 +205,48 @@ class TMultiPoolServer(object):
                  batch_infer_size=1,
                  batch_timeout=10,
                  n_models=1,
-                 n_handlers=10):
+                 n_handlers=10,
+                 shm_slots=0,
+                 shm_slot_size=0,
+                 pipeline_depth=1,
+                 metrics_port=None):
         self.model_cls = model_cls
         self.handler_cls = handler_cls
         self.processor_cls = processor_cls
+        self.methods = processor_methods(processor_cls)
         self.socket = lsocket
         self.in_protocol = inputProtocolFactory or TBinaryProtocolFactory()
         self.out_protocol = outputProtocolFactory or self.in_protocol
         self.n_handlers = int(n_handlers)
         self.n_models = int(n_models)
-        self.clients = {}
         self.connection_queue = queue.Queue()
         # self.inference_queue = queue.Queue()
         self.inference_queue = multiprocessing.Queue()
-        self.result_dict = multiprocessing.Manager().dict()
-        # self.result_dict = dict()
+        self.result_queue = multiprocessing.Queue()
+        self.result_dispatcher = None
         self.list_model_config = list_model_config
         self.batch_infer_size = batch_infer_size
         self.batch_timeout = batch_timeout
-
-        self._read, self._write = socket.socketpair()
+        # optional transport of numpy inputs/outputs through shared memory
+        self.shm_ring = None
+        if shm_slots > 0:
+            self.shm_ring = SharedMemoryRing(shm_slots, shm_slot_size)
+
+        self.metrics = ServerMetrics()
+        self.metrics.watch_queue('connections', self.connection_queue)
+        self.metrics.watch_queue('inference', self.inference_queue)
+        self.metrics_port = metrics_port
+        self.event_loop = EventLoop(self.socket, self._dispatch, pipeline_depth, self.metrics)
+        self.clients = self.event_loop.clients
         self.prepared = False
         self._stop = False
         self.list_handlers = []
         self.list_models = []
 
+    def stats(self):
+        """Returns the batching stats of every model process."""
+        return {'models': [model.stats() for model in self.list_models]}
+
     def set_num_handler(self, num):
         """Set the number of worker threads that should be created."""
         assert not self.prepared, "Can't change number of threads after start"
@@ -348,21 +256,30 @@ class TMultiPoolServer(object):
         """Prepares server for serve requests."""
         if self.prepared:
             return
-        self.socket.listen()
+        self.event_loop.listen()
+        if self.metrics_port is not None:
+            self.metrics.serve_http(self.metrics_port)
+        self.result_dispatcher = ResultDispatcher(
+            self.result_queue,
+            release=self.shm_ring.discard if self.shm_ring is not None else None)
+        self.result_dispatcher.start()
 
         for model_config in self.list_model_config:
             process = self.model_cls(inference_queue=self.inference_queue,
-                                     result_dict=self.result_dict,
+                                     result_queues=[self.result_queue],
                                      model_config=model_config,
                                      batch_infer_size=self.batch_infer_size,
-                                     batch_timeout=self.batch_timeout)
+                                     batch_timeout=self.batch_timeout,
+                                     shm_ring=self.shm_ring)
+            process.export_metrics(self.metrics, len(self.list_models))
             process.start()
             self.list_models.append(process)
 
         for idx in range(self.n_handlers):
             thread = ConnectionSink(idx, self.connection_queue,
                                     self.processor_cls, self.handler_cls,
-                                    self.inference_queue, self.result_dict)
+                                    self.inference_queue, self.result_dispatcher,
+                                    self.shm_ring)
             thread.setDaemon(True)
             thread.start()
             self.list_handlers.append(thread)
@@ -379,7 +296,7 @@ class TMultiPoolServer(object):
         In this case, we can just write anything to the second socket from
         socketpair.
         """
-        self._write.send(b'1')
+        self.event_loop.wake_up()
 
     def stop(self):
         """Stop the server.
@@ -396,24 +313,14 @@ class TMultiPoolServer(object):
         self._stop = True
         self.wake_up()
 
-    def _select(self):
-        """Does select on open connections."""
-        readable = [self.socket.handle.fileno(), self._read.fileno()]
-        writable = []
-        remaining = []
-        for i, connection in list(self.clients.items()):
-            if connection.is_readable():
-                readable.append(connection.fileno())
-                if connection.remaining or connection.received:
-                    remaining.append(connection.fileno())
-            if connection.is_writeable():
-                writable.append(connection.fileno())
-            if connection.is_closed():
-                del self.clients[i]
-        if remaining:
-            return remaining, [], [], False
-        else:
-            return select.select(readable, writable, readable) + (True,)
+    def _dispatch(self, fileno, connection, msg):
+        """Hands a complete request to the handler threads."""
+        itransport = msg.transport(TTransport.TMemoryBuffer)
+        otransport = TTransport.TMemoryBuffer()
+        iprot = self.in_protocol.getProtocol(itransport)
+        oprot = self.out_protocol.getProtocol(otransport)
+        self.metrics.count_request(self.in_protocol, TTransport.TMemoryBuffer, msg, self.methods)
+        self.connection_queue.put([iprot, oprot, otransport, msg.ready])
 
     def handle(self):
         """Handle requests.
@@ -421,44 +328,18 @@ class TMultiPoolServer(object):
         WARNING! You must call prepare() BEFORE calling handle()
         """
         assert self.prepared, "You have to call prepare before handle"
-        rset, wset, xset, selected = self._select()
-        for readable in rset:
-            if readable == self._read.fileno():
-                # don't care i just need to clean readable flag
-                self._read.recv(1024)
-            elif readable == self.socket.handle.fileno():
-                try:
-                    client = self.socket.accept()
-                    if client:
-                        self.clients[client.handle.fileno()] = Connection(client.handle,
-                                                                          self.wake_up)
-                except socket.error:
-                    logger.debug('error while accepting', exc_info=True)
-            else:
-                connection = self.clients[readable]
-                if selected:
-                    connection.read()
-                if connection.received:
-                    connection.status = WAIT_PROCESS
-                    msg = connection.received.popleft()
-                    itransport = TTransport.TMemoryBuffer(
-                        msg.buffer, msg.offset)
-                    otransport = TTransport.TMemoryBuffer()
-                    iprot = self.in_protocol.getProtocol(itransport)
-                    oprot = self.out_protocol.getProtocol(otransport)
-                    self.connection_queue.put([iprot, oprot,
-                                               otransport, connection.ready])
-        for writeable in wset:
-            self.clients[writeable].write()
-        for oob in xset:
-            self.clients[oob].close()
-            del self.clients[oob]
+        self.event_loop.handle()
 
     def close(self):
         """Closes the server."""
         for _ in range(self.n_handlers):
             self.connection_queue.put([None, None, None, None, None])
-        self.socket.close()
+        self.result_dispatcher.close()
+        if self.shm_ring is not None:
+            self.shm_ring.close(unlink=True)
+            self.shm_ring = None
+        self.event_loop.close()
+        self.metrics.close()
         self.prepared = False
 
     def serve(self):
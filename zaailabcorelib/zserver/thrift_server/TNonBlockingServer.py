@@ -27,16 +27,13 @@ maximum connections
 
 import traceback
 import logging
-import select
-import socket
-import struct
 import threading
 
-from collections import deque
 from six.moves import queue
 
 from thrift.transport import TTransport
 from thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
+from ..nonblocking import EventLoop
 
 __all__ = ['TNonblockingServer']
 
@@ -67,178 +64,6 @@ class Worker(threading.Thread):
                 callback(False, b'')
 
 
-WAIT_LEN = 0
-WAIT_MESSAGE = 1
-WAIT_PROCESS = 2
-SEND_ANSWER = 3
-CLOSED = 4
-
-
-def locked(func):
-    """Decorator which locks self.lock."""
-
-    def nested(self, *args, **kwargs):
-        self.lock.acquire()
-        try:
-            return func(self, *args, **kwargs)
-        finally:
-            self.lock.release()
-    return nested
-
-
-def socket_exception(func):
-    """Decorator close object on socket.error."""
-
-    def read(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except socket.error:
-            logger.debug('ignoring socket exception', exc_info=True)
-            self.close()
-    return read
-
-
-class Message(object):
-    def __init__(self, offset, len_, header):
-        self.offset = offset
-        self.len = len_
-        self.buffer = None
-        self.is_header = header
-
-    @property
-    def end(self):
-        return self.offset + self.len
-
-
-class Connection(object):
-    """Basic class is represented connection.
-
-    It can be in state:
-        WAIT_LEN --- connection is reading request len.
-        WAIT_MESSAGE --- connection is reading request.
-        WAIT_PROCESS --- connection has just read whole request and
-                         waits for call ready routine.
-        SEND_ANSWER --- connection is sending answer string (including length
-                        of answer).
-        CLOSED --- socket was closed and connection should be deleted.
-    """
-
-    def __init__(self, new_socket, wake_up):
-        self.socket = new_socket
-        self.socket.setblocking(False)
-        self.status = WAIT_LEN
-        self.len = 0
-        self.received = deque()
-        self._reading = Message(0, 4, True)
-        self._rbuf = b''
-        self._wbuf = b''
-        self.lock = threading.Lock()
-        self.wake_up = wake_up
-        self.remaining = False
-
-    @socket_exception
-    def read(self):
-        """Reads data from stream and switch state."""
-        assert self.status in (WAIT_LEN, WAIT_MESSAGE)
-        assert not self.received
-        buf_size = 8192
-        first = True
-        done = False
-        while not done:
-            read = self.socket.recv(buf_size)
-            rlen = len(read)
-            done = rlen < buf_size
-            self._rbuf += read
-            if first and rlen == 0:
-                if self.status != WAIT_LEN or self._rbuf:
-                    logger.error('could not read frame from socket')
-                else:
-                    logger.debug(
-                        'read zero length. client might have disconnected')
-                self.close()
-            while len(self._rbuf) >= self._reading.end:
-                if self._reading.is_header:
-                    mlen, = struct.unpack('!i', self._rbuf[:4])
-                    self._reading = Message(self._reading.end, mlen, False)
-                    self.status = WAIT_MESSAGE
-                else:
-                    self._reading.buffer = self._rbuf
-                    self.received.append(self._reading)
-                    self._rbuf = self._rbuf[self._reading.end:]
-                    self._reading = Message(0, 4, True)
-                    done = True
-            first = False
-            if self.received:
-                self.status = WAIT_PROCESS
-                break
-        self.remaining = not done
-
-    @socket_exception
-    def write(self):
-        """Writes data from socket and switch state."""
-        assert self.status == SEND_ANSWER
-        sent = self.socket.send(self._wbuf)
-        if sent == len(self._wbuf):
-            self.status = WAIT_LEN
-            self._wbuf = b''
-            self.len = 0
-        else:
-            self._wbuf = self._wbuf[sent:]
-
-    @locked
-    def ready(self, all_ok, message):
-        """Callback function for switching state and waking up main thread.
-
-        This function is the only function witch can be called asynchronous.
-
-        The ready can switch Connection to three states:
-            WAIT_LEN if request was oneway.
-            SEND_ANSWER if request was processed in normal way.
-            CLOSED if request throws unexpected exception.
-
-        The one wakes up main thread.
-        """
-        assert self.status == WAIT_PROCESS
-        if not all_ok:
-            self.close()
-            self.wake_up()
-            return
-        self.len = 0
-        if len(message) == 0:
-            # it was a oneway request, do not write answer
-            self._wbuf = b''
-            self.status = WAIT_LEN
-        else:
-            self._wbuf = struct.pack('!i', len(message)) + message
-            self.status = SEND_ANSWER
-        self.wake_up()
-
-    @locked
-    def is_writeable(self):
-        """Return True if connection should be added to write list of select"""
-        return self.status == SEND_ANSWER
-
-    # it's not necessary, but...
-    @locked
-    def is_readable(self):
-        """Return True if connection should be added to read list of select"""
-        return self.status in (WAIT_LEN, WAIT_MESSAGE)
-
-    @locked
-    def is_closed(self):
-        """Returns True if connection is closed."""
-        return self.status == CLOSED
-
-    def fileno(self):
-        """Returns the file descriptor of the associated socket."""
-        return self.socket.fileno()
-
-    def close(self):
-        """Closes connection"""
-        self.status = CLOSED
-        self.socket.close()
-
-
 class TNonblockingServer(object):
     """Non-blocking server."""
 
@@ -247,15 +72,16 @@ class TNonblockingServer(object):
                  lsocket,
                  inputProtocolFactory=None,
                  outputProtocolFactory=None,
-                 threads=10):
+                 threads=10,
+                 pipeline_depth=1):
         self.processor = processor
         self.socket = lsocket
         self.in_protocol = inputProtocolFactory or TBinaryProtocolFactory()
         self.out_protocol = outputProtocolFactory or self.in_protocol
         self.threads = int(threads)
-        self.clients = {}
         self.tasks = queue.Queue()
-        self._read, self._write = socket.socketpair()
+        self.event_loop = EventLoop(self.socket, self._dispatch, pipeline_depth)
+        self.clients = self.event_loop.clients
         self.prepared = False
         self._stop = False
 
@@ -269,7 +95,7 @@ class TNonblockingServer(object):
         """Prepares server for serve requests."""
         if self.prepared:
             return
-        self.socket.listen()
+        self.event_loop.listen()
         for _ in range(self.threads):
             thread = Worker(self.tasks)
             thread.setDaemon(True)
@@ -287,7 +113,7 @@ class TNonblockingServer(object):
         In this case, we can just write anything to the second socket from
         socketpair.
         """
-        self._write.send(b'1')
+        self.event_loop.wake_up()
 
     def stop(self):
         """Stop the server.
@@ -304,24 +130,14 @@ class TNonblockingServer(object):
         self._stop = True
         self.wake_up()
 
-    def _select(self):
-        """Does select on open connections."""
-        readable = [self.socket.handle.fileno(), self._read.fileno()]
-        writable = []
-        remaining = []
-        for i, connection in list(self.clients.items()):
-            if connection.is_readable():
-                readable.append(connection.fileno())
-                if connection.remaining or connection.received:
-                    remaining.append(connection.fileno())
-            if connection.is_writeable():
-                writable.append(connection.fileno())
-            if connection.is_closed():
-                del self.clients[i]
-        if remaining:
-            return remaining, [], [], False
-        else:
-            return select.select(readable, writable, readable) + (True,)
+    def _dispatch(self, fileno, connection, msg):
+        """Hands a complete request to the worker threads."""
+        itransport = msg.transport(TTransport.TMemoryBuffer)
+        otransport = TTransport.TMemoryBuffer()
+        iprot = self.in_protocol.getProtocol(itransport)
+        oprot = self.out_protocol.getProtocol(otransport)
+        self.tasks.put([self.processor, iprot, oprot,
+                        otransport, msg.ready])
 
     def handle(self):
         """Handle requests.
@@ -329,46 +145,13 @@ class TNonblockingServer(object):
         WARNING! You must call prepare() BEFORE calling handle()
         """
         assert self.prepared, "You have to call prepare before handle"
-        rset, wset, xset, selected = self._select()
-        for readable in rset:
-            if readable == self._read.fileno():
-                # don't care i just need to clean readable flag
-                self._read.recv(1024)
-            elif readable == self.socket.handle.fileno():
-                try:
-                    client = self.socket.accept()
-                    if client:
-                        self.clients[client.handle.fileno()] = Connection(client.handle,
-                                                                          self.wake_up)
-                except socket.error:
-                    logger.debug('error while accepting', exc_info=True)
-                    tb = traceback.format_exc()
-                    logger.exception(tb)
-            else:
-                connection = self.clients[readable]
-                if selected:
-                    connection.read()
-                if connection.received:
-                    connection.status = WAIT_PROCESS
-                    msg = connection.received.popleft()
-                    itransport = TTransport.TMemoryBuffer(
-                        msg.buffer, msg.offset)
-                    otransport = TTransport.TMemoryBuffer()
-                    iprot = self.in_protocol.getProtocol(itransport)
-                    oprot = self.out_protocol.getProtocol(otransport)
-                    self.tasks.put([self.processor, iprot, oprot,
-                                    otransport, connection.ready])
-        for writeable in wset:
-            self.clients[writeable].write()
-        for oob in xset:
-            self.clients[oob].close()
-            del self.clients[oob]
+        self.event_loop.handle()
 
     def close(self):
         """Closes the server."""
         for _ in range(self.threads):
             self.tasks.put([None, None, None, None, None])
-        self.socket.close()
+        self.event_loop.close()
         self.prepared = False
 
     def serve(self):
@@ -1,6 +1,5 @@
 
 import time
-from queue import Empty
 from multiprocessing import Queue
 import multiprocessing
 import logging
@@ -10,7 +9,10 @@ from collections import deque
 from six.moves import queue
 from zaailabcorelib.thrift.transport import TTransport
 from zaailabcorelib.thrift.protocol.TBinaryProtocol import TBinaryProtocolFactory
-from .utils import current_milli_time, current_nano_time
+from ..metrics import Counter, ServerMetrics, processor_methods
+from .dispatcher import ResultDispatcher
+from .shm import SharedMemoryRing
+from .TMultiPoolServer import THandlerBase, TModelBase as _TModelBase
 
 import traceback
 from zaailabcorelib.thrift.transport.TTransport import TTransportException
@@ -23,87 +25,35 @@ logger = logging.getLogger(__name__)
 # __all__ = ['TModelServer', 'TModelPoolServer']
 
 
-class TModelBase(multiprocessing.Process):
-    def __init__(self, inference_queue, result_dict, model_config, batch_infer_size=1, batch_group_timeout=10):
-        super(TModelBase, self).__init__()
-        self.inference_queue = inference_queue
-        self.result_dict = result_dict
-        self.batch_infer_size = batch_infer_size
-        self.batch_group_timeout_in_sec = self._microsec_to_sec(
-            batch_group_timeout)
-        self.batch_group_timeout = batch_group_timeout
-        self.model = self.model_init(model_config)
+class _CounterSum(object):
+    """Exports the sum of counters written by different processes."""
 
-    def _microsec_to_sec(self, microsec):
-        return microsec/1000
+    def __init__(self, counters):
+        self.counters = counters
 
-    def model_init(self, model_config: dict):
-        raise NotImplementedError
+    @property
+    def value(self):
+        return sum(counter.value for counter in self.counters)
 
-    def predict(self, list_input):
-        raise NotImplementedError
 
-    def run(self):
-        list_inference = []
-        list_request_id = []
-        while True:
-            t = current_milli_time()
-            while (len(list_inference) < self.batch_infer_size) and current_milli_time() - t < self.batch_group_timeout_in_sec:
-                try:
-                    [request_id, inp] = self.inference_queue.get(block=False)
-                    list_inference.append(inp)
-                    list_request_id.append(request_id)
-                except Empty:
-                    pass
-                t = current_milli_time()
-
-            if len(list_inference) > 0:
-                list_result = self.predict(list_inference)
-                for [_id, res] in zip(list_request_id, list_result):
-                    self.result_dict.update({_id:res})
-                list_request_id.clear()
-                list_inference.clear()
-
-    # def run(self):
-    #     list_inference = []
-    #     list_request_id = []
-    #     while True:
-    #         while True:
-    #             try:
-    #                 # , timeout=self.batch_timeout_in_sec)
-    #                 [request_id, inp] = self.inference_queue.get(block=False)
-    #                 list_inference.append(inp)
-    #                 list_request_id.append(request_id)
-    #                 if (len(list_inference) < self.batch_infer_size):
-    #                     continue
-    #             except Empty:
-    #                 break
-    #         if len(list_inference) != 0:
-    #             list_result = self.predict(list_inference)
-    #             for [_id, res] in zip(list_request_id, list_result):
-    #                 self.result_dict.update({_id: res})
-    #             list_request_id.clear()
-    #             list_inference.clear()
-
-
-class THandlerBase():
-    def __init__(self, inference_queue, result_dict):
-        self.inference_queue = inference_queue
-        self.result_dict = result_dict
-
-    def send_to_model(self, input_val):
-        request_id = current_nano_time()
-        input_ = self.process_input(input_val)
-        self.inference_queue.put([request_id, input_], block=False)
-        done = False
-        while not done:
-            result = self.result_dict.get(request_id, None)
-            if result is not None:
-                done = True
-        return result
-
-    def process_input(self, input):
-        raise NotImplementedError
+def _count_calls(function, counter):
+    def counted(*args, **kwargs):
+        counter.inc()
+        return function(*args, **kwargs)
+    return counted
+
+
+class TModelBase(_TModelBase):
+    """TMultiPoolServer's TModelBase, configured with `batch_group_timeout`."""
+
+    def __init__(self, inference_queue, result_queues, model_config, batch_infer_size=1, batch_group_timeout=10, shm_ring=None):
+        self.batch_group_timeout = batch_group_timeout
+        self.batch_group_timeout_in_sec = self._microsec_to_sec(
+            batch_group_timeout)
+        super(TModelBase, self).__init__(inference_queue, result_queues, model_config,
+                                         batch_infer_size=batch_infer_size,
+                                         batch_timeout=batch_group_timeout,
+                                         shm_ring=shm_ring)
 
 
 class ConnectionSink(multiprocessing.Process):
@@ -117,7 +67,11 @@ class ConnectionSink(multiprocessing.Process):
         self.processor_cls = kwargs.get('processor_cls')
         self.handler_cls = kwargs.get('handler_cls')
         self.inference_queue = kwargs.get('inference_queue')
-        self.result_dict = kwargs.get('result_dict')
+        self.result_queue = kwargs.get('result_queue')
+        self.shm_ring = kwargs.get('shm_ring')
+        # {method: Counter} and Counter of closed connections, written by this process only
+        self.method_counters = kwargs.get('method_counters') or {}
+        self.num_closed = kwargs.get('num_closed')
 
         self.input_transport_factory = kwargs.get('input_transport_factory')
         self.output_transport_factory = kwargs.get('output_transport_factory')
@@ -131,10 +85,20 @@ class ConnectionSink(multiprocessing.Process):
 
     def run(self):
         """Process queries from task queue, stop if processor is None."""
+        # results of this handler are routed back on its own queue
+        self.result_dispatcher = ResultDispatcher(
+            self.result_queue, route=self.wrk_id,
+            release=self.shm_ring.discard if self.shm_ring is not None else None)
+        self.result_dispatcher.start()
         self.handler = self.handler_cls(
             inference_queue=self.inference_queue,
-            result_dict=self.result_dict)
+            result_dispatcher=self.result_dispatcher,
+            shm_ring=self.shm_ring)
         self.processor = self.processor_cls(self.handler)
+        for name, counter in self.method_counters.items():
+            if name in self.processor._processMap:
+                self.processor._processMap[name] = _count_calls(
+                    self.processor._processMap[name], counter)
         while True:
             try:
                 client = self.connection_queue.get()
@@ -162,6 +126,8 @@ class ConnectionSink(multiprocessing.Process):
         itrans.close()
         if otrans:
             otrans.close()
+        if self.num_closed is not None:
+            self.num_closed.inc()
 
 
 class TModelServer():
@@ -215,7 +181,10 @@ class TWrkServer(TModelServer):
                  batch_group_timeout=10,
                  n_models=2,
                  n_handlers=2,
-                 logger=None):
+                 logger=None,
+                 shm_slots=0,
+                 shm_slot_size=0,
+                 metrics_port=None):
 
         if logger:
             self.logger = logger
@@ -236,7 +205,8 @@ class TWrkServer(TModelServer):
         self.clients = {}
         self.connection_queue = multiprocessing.Queue()
         self.inference_queue = multiprocessing.Queue()
-        self.result_dict = multiprocessing.Manager().dict()
+        self.list_result_queue = [multiprocessing.Queue()
+                                  for _ in range(self.n_handlers)]
         self.list_model_config = list_model_config
         if len(self.list_model_config) == 0:
             warnings.warn(
@@ -244,14 +214,31 @@ class TWrkServer(TModelServer):
 
         self.batch_infer_size = batch_infer_size
         self.batch_group_timeout = batch_group_timeout
+        # optional transport of numpy inputs/outputs through shared memory
+        self.shm_ring = None
+        if shm_slots > 0:
+            self.shm_ring = SharedMemoryRing(shm_slots, shm_slot_size)
         self.list_handlers = []
         self.list_models = []
+        # read/write latencies are not measured, sinks serve blocking sockets
+        self.metrics = ServerMetrics()
+        self.metrics.watch_queue('connections', self.connection_queue)
+        self.metrics.watch_queue('inference', self.inference_queue)
+        self.metrics_port = metrics_port
+        self.num_accepted = Counter()
+        self.list_num_closed = []
+        self.metrics.connections_open.set_function(
+            lambda: self.num_accepted.value - sum(c.value for c in self.list_num_closed))
 
         super(TWrkServer, self).__init__(
             serverTransport=self.server_transport,
             transportFactory=self.transport_factory,
             protocolFactory=self.protocol_factory)
 
+    def stats(self):
+        """Returns the batching stats of every model process."""
+        return {'models': [model.stats() for model in self.list_models]}
+
     def set_model_config(self, list_model_config):
         """Set the number of worker threads that should be created"""
         self.list_model_config = list_model_config
@@ -300,19 +287,33 @@ class TWrkServer(TModelServer):
 
         for model_config in self.list_model_config:
             wrk_model = self.model_cls(inference_queue=self.inference_queue,
-                                       result_dict=self.result_dict,
+                                       result_queues=self.list_result_queue,
                                        model_config=model_config,
                                        batch_infer_size=self.batch_infer_size,
-                                       batch_group_timeout=self.batch_group_timeout)
+                                       batch_group_timeout=self.batch_group_timeout,
+                                       shm_ring=self.shm_ring)
+            wrk_model.export_metrics(self.metrics, len(self.list_models))
             wrk_model.start()
             self.list_models.append(wrk_model)
 
+        methods = sorted(processor_methods(self.processor_cls))
+        list_method_counters = [{name: Counter() for name in methods}
+                                for _ in range(self.n_handlers)]
+        for name in methods:
+            self.metrics.requests.add(
+                _CounterSum([counters[name] for counters in list_method_counters]), name)
+
         for idx in range(self.n_handlers):
+            num_closed = Counter()
+            self.list_num_closed.append(num_closed)
             wrk_conn = ConnectionSink(wrk_id=idx,
+                                      method_counters=list_method_counters[idx],
+                                      num_closed=num_closed,
                                       processor_cls=self.processor_cls,
                                       handler_cls=self.handler_cls,
                                       inference_queue=self.inference_queue,
-                                      result_dict=self.result_dict,
+                                      result_queue=self.list_result_queue[idx],
+                                      shm_ring=self.shm_ring,
                                       connection_queue=self.connection_queue,
                                       input_transport_factory=self.transport_factory,
                                       output_transport_factory=self.transport_factory,
@@ -323,6 +324,8 @@ class TWrkServer(TModelServer):
 
     def serve(self):
         self.prepare()
+        if self.metrics_port is not None:
+            self.metrics.serve_http(self.metrics_port)
 
         # first bind and listen to the port
         self.serverTransport.listen()
@@ -331,9 +334,13 @@ class TWrkServer(TModelServer):
                 client = self.serverTransport.accept()
                 if not client:
                     continue
+                self.num_accepted.inc()
                 self.connection_queue.put(client)
             except (SystemExit, KeyboardInterrupt):
                 break
             except Exception as err:
                 tb = traceback.format_exc()
                 self.logger.exception(tb)
+        if self.shm_ring is not None:
+            self.shm_ring.close(unlink=True)
+        self.metrics.close()
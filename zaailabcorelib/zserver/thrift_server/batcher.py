@@ -0,0 +1,70 @@
+import time
+from queue import Empty
+
+from ..metrics import Counter, Histogram
+
+__all__ = ['DynamicBatcher']
+
+
+class DynamicBatcher(object):
+    """Groups requests of an inference queue into batches.
+
+    next_batch() blocks until the first request arrives, then keeps
+    collecting until `max_batch_size` requests are grouped or `max_wait`
+    seconds have passed since the first one. The wait is also cut short by
+    the earliest deadline of the grouped requests, and requests whose
+    deadline already passed are dropped since nobody waits for them anymore.
+
+    Queue items are ``[route, request_id, input, enqueue_time, deadline]``
+    with times from time.time(), `deadline` may be None. Inputs held in
+    `shm_ring` slots are released when their request is dropped.
+    """
+
+    def __init__(self, inference_queue, max_batch_size=1, max_wait=0, shm_ring=None):
+        self.inference_queue = inference_queue
+        self.shm_ring = shm_ring
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait
+        self.batch_size_hist = Histogram(range(1, self.max_batch_size + 1))
+        self.queue_wait_hist = Histogram()
+        self.num_expired = Counter()
+
+    def next_batch(self):
+        """Returns the routes, request ids and inputs of the next batch."""
+        list_route = []
+        list_request_id = []
+        list_inference = []
+        wait_until = None
+        while len(list_inference) < self.max_batch_size:
+            if wait_until is None:
+                item = self.inference_queue.get()
+            else:
+                timeout = wait_until - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.inference_queue.get(timeout=timeout)
+                except Empty:
+                    break
+            route, request_id, inp, enqueue_time, deadline = item
+            now = time.time()
+            if deadline is not None and deadline <= now:
+                self.num_expired.inc()
+                if self.shm_ring is not None:
+                    self.shm_ring.discard(inp)
+                continue
+            self.queue_wait_hist.observe(now - enqueue_time)
+            list_route.append(route)
+            list_request_id.append(request_id)
+            list_inference.append(inp)
+            if wait_until is None:
+                wait_until = now + self.max_wait
+            if deadline is not None:
+                wait_until = min(wait_until, deadline)
+        self.batch_size_hist.observe(len(list_inference))
+        return list_route, list_request_id, list_inference
+
+    def stats(self):
+        return {'batch_size': self.batch_size_hist.snapshot(),
+                'queue_wait': self.queue_wait_hist.snapshot(),
+                'num_expired': int(self.num_expired.value)}
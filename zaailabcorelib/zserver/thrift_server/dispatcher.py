@@ -0,0 +1,79 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from .utils import RequestIdAllocator
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ResultDispatcher']
+
+
+class ResultDispatcher(threading.Thread):
+    """Resolve pending requests with the results pushed back by model processes.
+
+    Handlers register a request before sending it to the model queue and block
+    on the returned future. Model processes put a list of
+    ``(request_id, result, error)`` tuples for a whole batch on
+    ``result_queue``; this thread pops the matching futures and completes them,
+    so a waiting handler costs no CPU at all.
+
+    ``route`` identifies the result queue of this dispatcher, model processes
+    use it to send results back to the right handler. It is also the owner of
+    the request ids allocated here, so ids never collide across dispatchers.
+
+    ``release`` is called with the results nobody waits for anymore, i.e. of
+    discarded or cancelled requests, to free the resources they hold.
+    """
+
+    def __init__(self, result_queue, route=0, release=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.result_queue = result_queue
+        self.route = route
+        self.release = release
+        self._request_ids = RequestIdAllocator(route)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def register(self):
+        """Allocates a request id.
+
+        Returns the id and a future which is resolved with the request result.
+        """
+        request_id = self._request_ids.next_id()
+        future = Future()
+        with self._lock:
+            self._pending[request_id] = future
+        return request_id, future
+
+    def discard(self, request_id):
+        """Forgets a request whose result is no longer awaited."""
+        with self._lock:
+            self._pending.pop(request_id, None)
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    def run(self):
+        while True:
+            batch = self.result_queue.get()
+            if batch is None:
+                break
+            for request_id, result, error in batch:
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is None or not future.set_running_or_notify_cancel():
+                    # the handler gave up on this request
+                    logger.debug('drop result of discarded request %s', request_id)
+                    if self.release is not None and error is None:
+                        self.release(result)
+                elif error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def close(self):
+        """Stops the dispatcher thread."""
+        self.result_queue.put(None)
@@ -0,0 +1,86 @@
+import multiprocessing
+from collections import namedtuple
+from multiprocessing import shared_memory
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+import numpy as np
+
+__all__ = ['SharedMemoryRing', 'ShmArrayRef']
+
+# Sent over the queues in place of an array stored in a ring slot.
+ShmArrayRef = namedtuple('ShmArrayRef', ['slot', 'shape', 'dtype'])
+
+_ALIGNMENT = 64
+
+
+class SharedMemoryRing(object):
+    """A ring of fixed size shared memory slots for numpy arrays.
+
+    Handlers copy an input array into a free slot and only send its
+    ShmArrayRef to the model process, which reads it as a zero-copy view and
+    writes the output back into the same slot. Whoever holds the ref of a
+    slot owns it and must release() it once done.
+
+    The ring must be created before worker processes are started.
+    """
+
+    def __init__(self, num_slots, slot_size):
+        self.num_slots = int(num_slots)
+        self.slot_size = -(-int(slot_size) // _ALIGNMENT) * _ALIGNMENT
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.num_slots * self.slot_size)
+        # stack of free slots, guarded by _lock; _free counts its size
+        self._stack = RawArray('i', range(self.num_slots))
+        self._top = RawValue('i', self.num_slots)
+        self._lock = multiprocessing.Lock()
+        self._free = multiprocessing.Semaphore(self.num_slots)
+
+    def fits(self, array):
+        return (isinstance(array, np.ndarray) and not array.dtype.hasobject
+                and array.nbytes <= self.slot_size)
+
+    def acquire(self, timeout=None):
+        """Returns a free slot, blocking while the ring is full."""
+        if not self._free.acquire(timeout=timeout):
+            raise TimeoutError('no free shared memory slot')
+        with self._lock:
+            self._top.value -= 1
+            return self._stack[self._top.value]
+
+    def release(self, ref):
+        """Gives the slot of `ref` back to the ring."""
+        with self._lock:
+            self._stack[self._top.value] = ref.slot
+            self._top.value += 1
+        self._free.release()
+
+    def discard(self, obj):
+        """Releases the slot of `obj` if it is a ref, ignores it otherwise."""
+        if isinstance(obj, ShmArrayRef):
+            self.release(obj)
+
+    def view(self, ref):
+        """Returns a zero-copy array over the slot of `ref`."""
+        return np.ndarray(ref.shape, dtype=np.dtype(ref.dtype),
+                          buffer=self.shm.buf, offset=ref.slot * self.slot_size)
+
+    def store(self, slot, array):
+        """Copies `array` into `slot` and returns its ref."""
+        array = np.asarray(array)
+        ref = ShmArrayRef(slot, array.shape, array.dtype.str)
+        np.copyto(self.view(ref), array, casting='no')
+        return ref
+
+    def put(self, array, timeout=None):
+        """Copies `array` into a free slot and returns its ref."""
+        slot = self.acquire(timeout)
+        try:
+            return self.store(slot, array)
+        except Exception:
+            self.release(ShmArrayRef(slot, (), None))
+            raise
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
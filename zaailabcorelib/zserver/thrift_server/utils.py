@@ -1,3 +1,4 @@
+import itertools
 import time
 
 
@@ -7,3 +8,20 @@ def current_milli_time():
 
 def current_nano_time():
     return int(round(time.time() * 1000000))
+
+
+class RequestIdAllocator(object):
+    """Allocates request ids which are unique for the lifetime of a server.
+
+    An id is the pair ``(owner_id, seq)`` where ``seq`` comes from a counter
+    shared by every thread of the owner. Unlike timestamps, two requests
+    submitted in the same microsecond never get the same id.
+    """
+
+    def __init__(self, owner_id=0):
+        self.owner_id = owner_id
+        # next() on itertools.count is atomic under the GIL
+        self._counter = itertools.count()
+
+    def next_id(self):
+        return (self.owner_id, next(self._counter))
@@ -17,10 +17,14 @@ from zmq.utils import jsonapi
 from .protocol import *
 from .decentralizedworker import *
 
-__all__ = ['__version__', 'WKRClient', 'ConcurrentWKRClient', 'WKRWorker', 'WKRDecentralizeCenter']
+__all__ = ['__version__', 'WKRClient', 'ConcurrentWKRClient', 'WKRWorker', 'WKRDecentralizeCenter', 'ServerBusyError']
 
 # in the future client version must match with server version
-__version__ = '1.0.0-b'
+# 2.0.0 changes the wire protocol: results go from a ROUTER sink to DEALER
+# clients, workers are DEALER sockets asking for jobs by credits and frames
+# carry extra parts. 1.x clients and workers hang against a 2.x server, and
+# the other way around, so always deploy them together.
+__version__ = '2.0.0'
 
 if sys.version_info >= (3, 0):
     from ._py3_var import *
@@ -32,7 +36,7 @@ Response = namedtuple('Response', ['id', 'embedding'])
 
 class WKRClient(object):
     def __init__(self, ip='localhost', port=5555, port_out=5556,
-                 protocol='obj',
+                 protocol='obj', zero_copy=False,
                  show_server_config=False, identity=None, 
                  check_version=True, check_length=False,
                  ignore_all_checks=False,
@@ -64,9 +68,13 @@ class WKRClient(object):
         :type port_out: int
         :type port: int
         :type ip: str
+        :type zero_copy: bool
         :param ip: the ip address of the server
         :param port: port for pushing data from client to server, must be consistent with the server side config
-        :param port_out: port for publishing results from server to client, must be consistent with the server side config
+        :param port_out: port for sending results from server to client, must be consistent with the server side config
+        :param zero_copy: send numpy buffers without copying them, and pickle objects with out-of-band frames,
+            arrays must not be modified until sent. Results are received without copy either way,
+            numpy results and out-of-band arrays are read-only
         :param output_fmt: the output format of the sentence encodes, either in numpy array or python List[List[float]] (ndarray/list)
         :param show_server_config: whether to show server configs when first connected
         :param identity: the UUID of this client
@@ -82,9 +90,10 @@ class WKRClient(object):
         self.identity = identity or str(uuid.uuid4()).encode('ascii')
         self.sender.connect('tcp://%s:%d' % (ip, port))
 
-        self.receiver = self.context.socket(zmq.SUB)
+        # the server sends the results of this client to its identity only
+        self.receiver = self.context.socket(zmq.DEALER)
         self.receiver.setsockopt(zmq.LINGER, 0)
-        self.receiver.setsockopt(zmq.SUBSCRIBE, self.identity)
+        self.receiver.setsockopt(zmq.IDENTITY, self.identity)
         self.receiver.connect('tcp://%s:%d' % (ip, port_out))
 
         self.request_id = 0
@@ -96,6 +105,7 @@ class WKRClient(object):
             raise AttributeError('"protocol" must be "obj" or "numpy"')
 
         self.protocol = protocol
+        self.zero_copy = zero_copy
 
         self.port = port
         self.port_out = port_out
@@ -139,10 +149,10 @@ class WKRClient(object):
         req_id = target_request_id if target_request_id else self.request_id
         req_id = str(req_id)
 
-        if msg in [ServerCmd.terminate, ServerCmd.show_config]:
+        if isinstance(msg, bytes) and msg in [ServerCmd.terminate, ServerCmd.show_config]:
             send_to_next_raw(self.identity, req_id, msg, jsonapi.dumps('{}'), self.sender)
         else:
-            send_to_next(self.protocol, self.identity, req_id, msg, self.sender)
+            send_to_next(self.protocol, self.identity, req_id, msg, self.sender, zero_copy=self.zero_copy)
 
         self.pending_request.add(req_id)
         return req_id
@@ -157,6 +167,8 @@ class WKRClient(object):
                 # a request has been returned and found in pending_response
                 if wait_for_req_id in self.pending_response:
                     response = self.pending_response.pop(wait_for_req_id)
+                    if isinstance(response, ServerBusyError):
+                        raise response
                     return _Response(wait_for_req_id, response)
 
                 # receive a response
@@ -167,6 +179,8 @@ class WKRClient(object):
                 # if not wait for particular response then simply return
                 if not wait_for_req_id or (wait_for_req_id == request_id):
                     self.pending_request.remove(request_id)
+                    if isinstance(msg, ServerBusyError):
+                        raise msg
                     return _Response(request_id, msg)
                 elif wait_for_req_id != request_id:
                     self.pending_response[request_id] = msg
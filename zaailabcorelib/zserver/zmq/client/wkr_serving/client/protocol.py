@@ -7,7 +7,8 @@ from zmq.utils import jsonapi
 __all__ = ['ServerCmd', 
            'send_to_next', 'recv_from_prev',
            'to_bytes', 'to_str', 
-           'send_object', 'recv_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw']
+           'send_object', 'recv_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw',
+           'recv_from_prev_frames', 'as_cmd', 'ServerBusyError']
 
 class ServerCmd:
     terminate = b'TERMINATION'
@@ -15,31 +16,71 @@ class ServerCmd:
     restart_client = b'RESTART_CLIENT'
     show_config = b'SHOW_CONFIG'
     switch_server = b'SWITCH'
+    busy = b'SERVER_BUSY'
 
     @staticmethod
     def is_valid(cmd):
         return any(not k.startswith('__') and v == cmd for k, v in vars(ServerCmd).items())
 
-def send_to_next(protocol, client, job_id, msg, dst, flags=0):
+# longest ServerCmd, payloads longer than that are never read as commands
+_MAX_CMD_LEN = 32
+
+# out-of-band pickle buffers need pickle protocol 5, python >= 3.8
+_PICKLE_OOB = pickle.HIGHEST_PROTOCOL >= 5
+
+class ServerBusyError(RuntimeError):
+    """The server did not run a request, its client is too slow reading results."""
+
+def send_to_next(protocol, client, job_id, msg, dst, flags=0, zero_copy=False):
+    """Sends `msg` with the transfer `protocol`.
+
+    With zero_copy, zmq sends numpy buffers in place rather than copying
+    them, and objects are pickled with protocol 5 with their numpy arrays
+    as out-of-band frames. Arrays must not be modified until sent.
+    """
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
     
     if protocol == 'obj':
-        send_object(dst, client, job_id, msg, flags=flags)
+        send_object(dst, client, job_id, msg, flags=flags, copy=not zero_copy, out_of_band=zero_copy)
     else:
-        send_ndarray(dst, client, job_id, msg, flags=flags)
+        send_ndarray(dst, client, job_id, msg, flags=flags, copy=not zero_copy)
 
 def recv_from_prev(protocol, src):
+    """Receives and decodes a result, a ServerBusyError if the server refused the request."""
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
 
+    client, req_id, msg, msg_info, buffers = recv_from_prev_frames(src)
+    if as_cmd(msg) == ServerCmd.busy:
+        error = ServerBusyError('server busy, request %s was not processed, read the pending results first' % to_str(req_id))
+        return to_str(client), to_str(req_id), error, {}
+    msg_info = jsonapi.loads(msg_info)
     if protocol == 'obj':
-        client, req_id, msg, msg_info = recv_object(src)
+        msg = decode_object(msg, msg_info, buffers)
     else:
-        client, req_id, msg, msg_info = recv_ndarray(src)
+        msg = decode_ndarray(msg, msg_info)
+
+    return to_str(client), to_str(req_id), msg, msg_info
+
+def send_to_next_raw(client, req_id, msg, msg_info, dst, flags=0, copy=True, track=False, buffers=()):
+    dst.send_multipart([to_bytes(client), to_bytes(req_id), msg, msg_info] + list(buffers), flags, copy=copy, track=track)
+
+def recv_from_prev_frames(src):
+    """Receives a message without copying its payload.
 
-    return client, req_id, msg, msg_info
+    Returns client, req_id and msg_info as bytes, msg and the out-of-band
+    buffers as zmq.Frame, to forward or decode in place.
+    """
+    frames = src.recv_multipart(copy=False)
+    if len(frames) < 4:
+        raise ValueError('expected at least 4 frames, got %d' % len(frames))
+    client, req_id, msg, msg_info = frames[:4]
+    return client.bytes, req_id.bytes, msg, msg_info.bytes, frames[4:]
 
-def send_to_next_raw(client, req_id, msg, msg_info, dst, flags=0, copy=True, track=False):
-    dst.send_multipart([to_bytes(client), to_bytes(req_id), msg, msg_info], flags, copy=copy, track=track)
+def as_cmd(msg):
+    """Returns the bytes of `msg` if it can be a ServerCmd, else b''."""
+    if len(msg) > _MAX_CMD_LEN:
+        return b''
+    return msg.bytes if isinstance(msg, zmq.Frame) else msg
 
 def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False):
     md = dict(dtype=str(array.dtype), shape=array.shape)
@@ -47,8 +88,7 @@ def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False):
     send_to_next_raw(client, job_id, array, msg_info, dst, flags=flags, copy=copy, track=track )
 
 def recv_ndarray(src):
-    msg = src.recv_multipart()
-    client, req_id, msg, msg_info = msg
+    client, req_id, msg, msg_info, _ = recv_from_prev_frames(src)
     arr_info, arr_val = jsonapi.loads(msg_info), msg
     array = decode_ndarray(arr_val, arr_info)
     return to_str(client), to_str(req_id), array, arr_info
@@ -56,30 +96,38 @@ def recv_ndarray(src):
 def decode_ndarray(buffer, info):
     return np.frombuffer(memoryview(buffer), dtype=info['dtype']).reshape(info['shape'])
 
-def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0):
+def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0, out_of_band=False):
+    buffers = []
     if need_compress == 1:
         p = pickle.dumps(obj, protocol)
         z = zlib.compress(p)
+    elif out_of_band and _PICKLE_OOB:
+        # contiguous numpy arrays are not copied into the pickle but sent as frames
+        protocol = 5
+        z = pickle.dumps(obj, protocol, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
     else:
         z = pickle.dumps(obj, protocol)
-    obj_info = jsonapi.dumps(dict(protocol=protocol, compress=need_compress))
-    send_to_next_raw(client, job_id, z, obj_info, dst, flags=flags, copy=copy, track=track )
+    obj_info = jsonapi.dumps(dict(protocol=protocol, compress=need_compress, buffers=len(buffers)))
+    send_to_next_raw(client, job_id, z, obj_info, dst, flags=flags, copy=copy, track=track, buffers=buffers)
 
 def recv_object(src):
-    msg = src.recv_multipart()
-    client, req_id, msg, msg_info = msg
+    client, req_id, msg, msg_info, buffers = recv_from_prev_frames(src)
     obj_info, obj_buffer = jsonapi.loads(msg_info), msg
-    obj = decode_object(obj_buffer, obj_info)
+    obj = decode_object(obj_buffer, obj_info, buffers)
     return to_str(client), to_str(req_id), obj, obj_info
 
-def decode_object(buffer, info):
+def decode_object(buffer, info, buffers=()):
     pickle_protocol = info['protocol']
     need_decompress = info['compress']
     if need_decompress == 1:
         obj_decompressed = zlib.decompress(buffer)
         obj = pickle.loads(obj_decompressed)
+    elif info.get('buffers'):
+        # arrays are views of the received frames, read-only
+        obj = pickle.loads(memoryview(buffer), buffers=[memoryview(b) for b in buffers])
     else:
-        obj = pickle.loads(buffer)
+        obj = pickle.loads(memoryview(buffer))
     return obj
 
 def to_bytes(bytes_or_str):
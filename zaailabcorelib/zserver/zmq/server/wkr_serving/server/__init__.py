@@ -7,7 +7,7 @@ import random
 import sys
 import threading
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from itertools import chain
 from multiprocessing import Process
@@ -29,7 +29,11 @@ from .hard_worker import WKRHardWorker
 from .statistic import ServerStatistic
 
 __all__ = ['__version__', 'WKRServer', 'WKRHardWorker']
-__version__ = '1.0.0-a'
+# 2.0.0 changes the wire protocol: results go from a ROUTER sink to DEALER
+# clients, workers are DEALER sockets asking for jobs by credits and frames
+# carry extra parts. 1.x clients and workers hang against a 2.x server, and
+# the other way around, so always deploy them together.
+__version__ = '2.0.0'
 
 class WKRServer(threading.Thread):
     def __init__(self, args, hardprocesser=WKRHardWorker):
@@ -46,14 +50,12 @@ class WKRServer(threading.Thread):
         self.gpu_memory_fraction = args.gpu_memory_fraction
         self.all_cpu = args.cpu
 
-        self.num_concurrent_postsocket = max(8, args.num_worker * 2)
         self.batch_size = args.batch_size
 
-        self.total_concurrent_socket = self.num_concurrent_postsocket
-
         self.port = args.port
         self.args = args
         self.transfer_protocol = args.protocol
+        self.zero_copy = args.zero_copy
 
         self.status_args = {k: v for k, v in sorted(vars(args).items())}
         self.status_static = {
@@ -88,7 +90,7 @@ class WKRServer(threading.Thread):
     @zmqd.socket(zmq.PUSH)
     def _send_close_signal(self, _, frontend):
         frontend.connect('tcp://localhost:%d' % self.port)
-        frontend.send_multipart([b'', ServerCmd.terminate, b'', b''])
+        frontend.send_multipart([b'', b'', ServerCmd.terminate, b''])
 
     @staticmethod
     def shutdown(args):
@@ -97,7 +99,7 @@ class WKRServer(threading.Thread):
             with ctx.socket(zmq.PUSH) as frontend:
                 try:
                     frontend.connect('tcp://%s:%d' % (args.ip, args.port))
-                    frontend.send_multipart([b'', ServerCmd.terminate, b'', b''])
+                    frontend.send_multipart([b'', b'', ServerCmd.terminate, b''])
                     print('shutdown signal sent to %d' % args.port)
                 except zmq.error.Again:
                     raise TimeoutError(
@@ -110,20 +112,38 @@ class WKRServer(threading.Thread):
     @zmqd.context()
     @zmqd.socket(zmq.PULL)
     @zmqd.socket(zmq.PAIR)
-    @multi_socket(zmq.PUSH, num_socket='total_concurrent_socket')
-    def _run(self, _, frontend, sink, *backend_socks):
+    @zmqd.socket(zmq.ROUTER)
+    def _run(self, _, frontend, sink, backend):
+
+        # free job slots of every worker socket, by socket identity
+        credits = OrderedDict()
 
-        def push_new_job(client, req_id, msg_raw, msg_info_raw):
-            _sock = rand_backend_socket
-            send_to_next_raw(client, req_id, msg_raw, msg_info_raw, _sock)
+        def push_new_job(client, req_id, msg_raw, msg_info_raw, buffers):
+            """Sends the job to a worker, False if no worker is left."""
+            while credits:
+                # the least loaded worker has the most free slots
+                worker = max(credits, key=credits.get)
+                try:
+                    backend.send(worker, zmq.SNDMORE)
+                except zmq.ZMQError:
+                    self.logger.warning('worker socket %r is gone' % worker)
+                    del credits[worker]
+                    continue
+                credits[worker] -= 1
+                # forward the received frames, no copy
+                send_to_next_raw(client, req_id, msg_raw, msg_info_raw, backend, copy=False, buffers=buffers)
+                return True
+            self.logger.error('no worker left for job %s#%s' % (client, req_id))
+            return False
 
         # bind all sockets
         self.logger.info('bind all sockets')
         frontend.bind('tcp://*:%d' % self.port)
         addr_front2sink = auto_bind(sink)
 
-        addr_backend_post_list = [auto_bind(b) for b in backend_socks]
-        self.logger.info('open %d worker sockets' % len(addr_backend_post_list))
+        # fail rather than drop jobs sent to a worker socket that is gone
+        backend.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        addr_backend_post_list = [auto_bind(backend)]
 
         # start the sink process
         self.logger.info('start the sink')
@@ -149,7 +169,6 @@ class WKRServer(threading.Thread):
             self.processes.append(proc_proxy)
             proc_proxy.start()
 
-        rand_backend_socket = None
         server_status = ServerStatistic()
 
         for p in self.processes:
@@ -158,20 +177,41 @@ class WKRServer(threading.Thread):
         self.is_ready.set()
         self.logger.info('all set, ready to serve request!')
 
+        # clients the sink holds too many results for, their jobs are answered busy
+        busy_clients = set()
+
+        poller = zmq.Poller()
+        poller.register(frontend, zmq.POLLIN)
+        poller.register(backend, zmq.POLLIN)
+        poller.register(sink, zmq.POLLIN)
+
         while True:
+            # requests wait in the client sockets while no worker has a free slot
+            poller.modify(frontend, zmq.POLLIN if any(credits.values()) else 0)
+            events = dict(poller.poll())
+            if backend in events:
+                worker, num_job = recv_credit(backend)
+                credits[worker] = credits.get(worker, 0) + num_job
+            if sink in events:
+                client, cmd, _, _ = sink.recv_multipart()
+                if cmd == ServerCmd.client_busy:
+                    busy_clients.add(client)
+                else:
+                    busy_clients.discard(client)
+            if frontend not in events:
+                continue
             try:
-                request = frontend.recv_multipart()
-                client, req_id, msg, msg_info = request
+                client, req_id, msg, msg_info, buffers = recv_from_prev_frames(frontend)
                 # client, req_id, msg, msg_info = recv_from_prev(self.transfer_protocol, frontend)
                 # request = [client, msg, req_id, msg_info]
-            except (ValueError, AssertionError):
-                self.logger.error('received a wrongly-formatted request (expected 4 frames, got %d)' % len(request))
-                self.logger.error('\n'.join('field %d: %s' % (idx, k) for idx, k in enumerate(request)), exc_info=True)
+            except (ValueError, AssertionError) as e:
+                self.logger.error('received a wrongly-formatted request (%s)' % e, exc_info=True)
             else:
-                server_status.update(request)
-                if msg == ServerCmd.terminate:
+                cmd = as_cmd(msg)
+                server_status.update([client, cmd, req_id, msg_info])
+                if cmd == ServerCmd.terminate:
                     break
-                elif msg == ServerCmd.show_config:
+                elif cmd == ServerCmd.show_config:
                     self.logger.info('new config request\treq id: %d\tclient: %s' % (int(req_id), client))
                     status_runtime = {'client': client.decode('ascii'),
                                       'num_process': len(self.processes),
@@ -182,28 +222,27 @@ class WKRServer(threading.Thread):
                                       'main_device_map': device_map_main_worker,
                                       'main_batch_size': self.batch_size,
                                       'protocol': self.transfer_protocol,
-                                      'num_concurrent_socket': self.total_concurrent_socket}
-                    sink.send_multipart([client, msg, jsonapi.dumps({**status_runtime,
+                                      'zero_copy': self.zero_copy,
+                                      'free_credits': list(credits.values())}
+                    sink.send_multipart([client, cmd, jsonapi.dumps({**status_runtime,
                                                                      **self.status_args,
                                                                      **self.status_static}), req_id])
                 else:
                     self.logger.info('new encode request\treq id: %s\tclient: %s' %
                                      (str(req_id), client))
 
-                    # regist job
-                    sink.send_multipart([client, ServerCmd.new_job, jsonapi.dumps({'job_parts': '1', 'split_info': {}}), to_bytes(req_id)])
-
-                    # pick random socket
-                    rand_backend_socket = random.choice([b for b in backend_socks if b != rand_backend_socket])
-
                     # info = jsonapi.loads(msg_info)
                     # if self.transfer_protocol == 'obj':
                     #     msg = decode_object(msg, info)
                     # else:
                     #     msg = decode_ndarray(msg, info)
 
-                    # push job
-                    push_new_job(client, req_id, msg, msg_info)
+                    if client in busy_clients:
+                        # the sink holds too many results of the client already
+                        sink.send_multipart([client, ServerCmd.busy, b'', to_bytes(req_id)])
+                    elif push_new_job(client, req_id, msg, msg_info, buffers):
+                        # regist the job once pushed: a job no worker took is never counted by the sink
+                        sink.send_multipart([client, ServerCmd.new_job, jsonapi.dumps({'job_parts': '1', 'split_info': {}}), to_bytes(req_id)])
 
         for p in self.processes:
             p.close()
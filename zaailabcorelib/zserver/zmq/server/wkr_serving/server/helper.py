@@ -128,7 +128,17 @@ def get_args_parser():
     groupwa.add_argument('-batch_size', type=int, default=10,
                         help='maximum number of sequences handled by each worker')
     groupwa.add_argument('-batch_group_timeout', type=int, default=1,
-                        help='maximum time(ms) for wait for a new request, we all need waveglow to fix input shape, so need to wait a much longer')
+                        help='maximum time(ms) a batch waits for more requests, counted from its first request')
+    groupwa.add_argument('-batch_shape_mode', type=str, default='none', choices=['none', 'pad', 'bucket'],
+                        help='how a worker batches numpy inputs of different shapes: "pad" zero pads them to the \
+                        largest shape of the batch, "bucket" batches together the inputs of the same shape only')
+    groupwa.add_argument('-worker_credits', type=int, default=0,
+                        help='number of jobs the navigator may queue on a worker before it reads them, \
+                        new jobs go to the worker with the most free slots; 0 for twice the batch size')
+    groupwa.add_argument('-pipeline_depth', type=int, default=0,
+                        help='preprocess the next batches and postprocess the previous ones in threads \
+                        while a worker predicts, with at most this many batches queued between stages; \
+                        0 runs the stages in sequence')
     groupwa.add_argument('-cpu', action='store_true', default=False,
                         help='running on CPU (default on GPU)')
     groupwa.add_argument('-device_map', type=int, nargs='+', default=[],
@@ -140,10 +150,16 @@ def get_args_parser():
                                        'config how server utilizes GPU/CPU resources')
     group3.add_argument('-protocol', type=check_protocol, default='obj',
                         help='server-client tranfer protocol')
+    group3.add_argument('-zero_copy', action='store_true', default=False,
+                        help='send results without copying numpy buffers, objects are pickled with '
+                             'out-of-band frames, clients must support it')
     group3.add_argument('-port', '-port_in', '-port_data', type=int, default=5555,
                         help='server port for receiving data from client')
     group3.add_argument('-port_out', '-port_result', type=int, default=5556,
                         help='server port for sending result to client')
+    group3.add_argument('-max_undelivered', type=int, default=100,
+                        help='maximum number of results kept for a client which does not read them, \
+                        its next requests are answered busy until it catches up')
     group3.add_argument('-http_port', type=int, default=None,
                         help='server port for receiving HTTP requests')
     group3.add_argument('-http_max_connect', type=int, default=20,
@@ -7,7 +7,7 @@ import random
 import sys
 import threading
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime
 from itertools import chain
 from multiprocessing import Process
@@ -27,6 +27,9 @@ from .zmq_decor import multi_socket
 from .statistic import ServerStatistic
 
 class WKRSink(Process):
+    # seconds a result waits for its client to connect or catch up before it is dropped
+    undelivered_timeout = 60
+
     def __init__(self, args, nav_to_sink_addr, worker_socket_addrs):
         super().__init__()
         self.port = args.port_out
@@ -37,10 +40,14 @@ class WKRSink(Process):
         self.worker_socket_addrs = worker_socket_addrs
 
         self.transfer_protocol = args.protocol
+        # results kept at most for a client which does not read them
+        self.max_undelivered = args.max_undelivered
 
         self.current_jobnum = 0
         self.maximum_jobnum = 0
         self.total_processed = 0
+        self.total_dropped = 0
+        self.total_busy = 0
 
         self.logdir = args.log_dir
         self.logger = set_logger(colored('SINK', 'green'), logger_dir=self.logdir, verbose=args.verbose)
@@ -58,11 +65,15 @@ class WKRSink(Process):
 
     @zmqd.socket(zmq.PULL)
     @zmqd.socket(zmq.PAIR)
-    @zmqd.socket(zmq.PUB)
+    @zmqd.socket(zmq.ROUTER)
     def _run(self, receiver, frontend, sender):
 
         receiver_addr = auto_bind(receiver)
         frontend.connect(self.nav_to_sink_addr)
+        # a result for a client not connected yet or with a full queue raises
+        # rather than being dropped, a client reconnecting takes over its identity
+        sender.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        sender.setsockopt(zmq.ROUTER_HANDOVER, 1)
         sender.bind('tcp://*:%d' % self.port)
 
         poller = zmq.Poller()
@@ -80,15 +91,77 @@ class WKRSink(Process):
 
         sink_status = ServerStatistic()
 
+        # results the clients could not take yet, by client, oldest first, as (time, frames)
+        undelivered = OrderedDict()
+        # clients whose jobs the navigator answers busy
+        busy_clients = set()
+
+        def try_send(client, frames):
+            try:
+                sender.send_multipart([client] + frames, zmq.NOBLOCK, copy=False)
+                return True
+            except zmq.ZMQError as e:
+                # EHOSTUNREACH: the client is not connected, EAGAIN: its queue is full.
+                # Either way the result is kept and sent again later, no ack needed
+                if e.errno not in (zmq.EHOSTUNREACH, zmq.EAGAIN):
+                    raise
+                return False
+
+        def deliver(client, frames, busy=False):
+            backlog = undelivered.get(client)
+            # results of a client go out in order
+            if backlog is None and try_send(client, frames):
+                return
+            if backlog is None:
+                backlog = undelivered[client] = deque()
+            # at most max_undelivered results are kept, and as many busy replies on top
+            if len(backlog) >= self.max_undelivered * (2 if busy else 1):
+                if busy:
+                    self.total_dropped += 1
+                    logger.warning('drop a busy reply of client %s, %d results not received yet' % (client, len(backlog)))
+                else:
+                    # a job routed before the navigator knew the client was busy
+                    reply_busy(client, frames[1])
+                return
+            backlog.append((time.time(), frames))
+            if len(backlog) >= self.max_undelivered and client not in busy_clients:
+                # stop routing the jobs of the client until it catches up
+                busy_clients.add(client)
+                frontend.send_multipart([client, ServerCmd.client_busy, b'', b''])
+
+        def reply_busy(client, req_id):
+            self.total_busy += 1
+            deliver(client, [client, req_id, ServerCmd.busy, b''], busy=True)
+
+        def deliver_undelivered():
+            expired = time.time() - self.undelivered_timeout
+            for client in list(undelivered):
+                backlog = undelivered[client]
+                while backlog and try_send(client, backlog[0][1]):
+                    backlog.popleft()
+                while backlog and backlog[0][0] < expired:
+                    backlog.popleft()
+                    self.total_dropped += 1
+                    logger.warning('drop a result of client %s, not received in %ds' % (client, self.undelivered_timeout))
+                if not backlog:
+                    del undelivered[client]
+                    if client in busy_clients:
+                        busy_clients.discard(client)
+                        frontend.send_multipart([client, ServerCmd.client_ready, b'', b''])
+
         while not self.exit_flag.is_set():
             try:
-                socks = dict(poller.poll())
+                # retry undelivered results every 10ms
+                socks = dict(poller.poll(10 if undelivered else None))
+
+                if undelivered:
+                    deliver_undelivered()
 
                 if socks.get(receiver) == zmq.POLLIN:
-                    client, req_id, msg, msg_info = recv_from_prev_raw(receiver)
+                    client, req_id, msg, msg_info, buffers = recv_from_prev_frames(receiver)
                     logger.info("collected {}#{}".format(client, req_id))
                     
-                    send_to_next_raw(client, req_id, msg, msg_info, sender)
+                    deliver(client, [client, req_id, msg, msg_info] + buffers)
                     self.current_jobnum -= 1
                     self.total_processed += 1
                     logger.info('send back\tjob id: {}#{} \tleft: {}'.format(client, req_id, self.current_jobnum))
@@ -101,8 +174,10 @@ class WKRSink(Process):
                         self.maximum_jobnum = self.current_jobnum if self.current_jobnum > self.maximum_jobnum else self.maximum_jobnum
                         logger.info('registed job\tjob id: {}\tleft: {}'.format(job_id, self.current_jobnum))
 
+                    elif msg_type == ServerCmd.busy:
+                        reply_busy(client_addr, req_id)
+
                     elif msg_type == ServerCmd.show_config:
-                        time.sleep(0.1)  # dirty fix of slow-joiner: sleep so that client receiver can connect.
                         logger.info('send config\tclient %s' % client_addr)
                         prev_status = jsonapi.loads(msg_info)
                         status={
@@ -110,10 +185,15 @@ class WKRSink(Process):
                                 'total_job_in_queue': self.current_jobnum,
                                 'maximum_job_in_queue': self.maximum_jobnum,
                                 'total_processed_job': self.total_processed,
+                                'total_undelivered_job': sum(len(backlog) for backlog in undelivered.values()),
+                                'total_dropped_job': self.total_dropped,
+                                'total_busy_job': self.total_busy,
+                                'busy_clients': len(busy_clients),
                                 'util': self.current_jobnum/(self.maximum_jobnum) if self.maximum_jobnum > 0 else 0
                             }, **sink_status.value}
                         }
-                        send_to_next('obj', client_addr, req_id, {**prev_status, **status}, sender)
+                        msg, msg_info, buffers = encode_object({**prev_status, **status})
+                        deliver(client_addr, [client_addr, req_id, msg, msg_info] + buffers)
                                           
             except Exception as e:
                 import traceback
@@ -7,12 +7,18 @@ from zmq.utils import jsonapi
 __all__ = ['ServerCmd', 
            'send_to_next', 'recv_from_prev',
            'to_bytes', 'to_str', 
-           'send_object', 'recv_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw', 'recv_from_prev_raw']
+           'send_object', 'recv_object', 'encode_object', 'send_ndarray', 'decode_ndarray', 'decode_object', 'send_to_next_raw', 'recv_from_prev_raw',
+           'recv_from_prev_frames', 'as_cmd', 'send_credit', 'recv_credit']
 
 class ServerCmd:
     terminate = b'TERMINATION'
     show_config = b'SHOW_CONFIG'
     new_job = b'REGISTER'
+    # the sink tells the navigator a client stopped or resumed reading its results
+    client_busy = b'CLIENT_BUSY'
+    client_ready = b'CLIENT_READY'
+    # answers a job the server did not run
+    busy = b'SERVER_BUSY'
     enter_socket = b'ENTER_SOCKET'
     getout_socket = b'GETOUT_SOCKET'
     data_embed = b'EMBEDDINGS'
@@ -21,13 +27,25 @@ class ServerCmd:
     def is_valid(cmd):
         return any(not k.startswith('__') and v == cmd for k, v in vars(ServerCmd).items())
 
-def send_to_next(protocol, client, job_id, msg, dst, flags=0):
+# longest ServerCmd, payloads longer than that are never read as commands
+_MAX_CMD_LEN = 32
+
+# out-of-band pickle buffers need pickle protocol 5, python >= 3.8
+_PICKLE_OOB = pickle.HIGHEST_PROTOCOL >= 5
+
+def send_to_next(protocol, client, job_id, msg, dst, flags=0, zero_copy=False):
+    """Sends `msg` with the transfer `protocol`.
+
+    With zero_copy, zmq sends numpy buffers in place rather than copying
+    them, and objects are pickled with protocol 5 with their numpy arrays
+    as out-of-band frames. Arrays must not be modified until sent.
+    """
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
     
     if protocol == 'obj':
-        send_object(dst, client, job_id, msg, flags=flags)
+        send_object(dst, client, job_id, msg, flags=flags, copy=not zero_copy, out_of_band=zero_copy)
     else:
-        send_ndarray(dst, client, job_id, msg, flags=flags)
+        send_ndarray(dst, client, job_id, msg, flags=flags, copy=not zero_copy)
 
 def recv_from_prev(protocol, src):
     assert protocol in ['obj', 'numpy'], "{} is an invalid transfer protocol, must be 'obj' or 'numpy'".format(protocol)
@@ -39,20 +57,47 @@ def recv_from_prev(protocol, src):
 
     return client, req_id, msg, msg_info
 
-def send_to_next_raw(client, req_id, msg, msg_info, dst, flags=0, copy=True, track=False):
-    dst.send_multipart([to_bytes(client), to_bytes(req_id), msg, msg_info], flags, copy=copy, track=track)
+def send_to_next_raw(client, req_id, msg, msg_info, dst, flags=0, copy=True, track=False, buffers=()):
+    dst.send_multipart([to_bytes(client), to_bytes(req_id), msg, msg_info] + list(buffers), flags, copy=copy, track=track)
 
 def recv_from_prev_raw(src):
     client, req_id, msg, msg_info = src.recv_multipart()
     return client, req_id, msg, msg_info
 
+def recv_from_prev_frames(src):
+    """Receives a message without copying its payload.
+
+    Returns client, req_id and msg_info as bytes, msg and the out-of-band
+    buffers as zmq.Frame, to forward or decode in place.
+    """
+    frames = src.recv_multipart(copy=False)
+    if len(frames) < 4:
+        raise ValueError('expected at least 4 frames, got %d' % len(frames))
+    client, req_id, msg, msg_info = frames[:4]
+    return client.bytes, req_id.bytes, msg, msg_info.bytes, frames[4:]
+
+def as_cmd(msg):
+    """Returns the bytes of `msg` if it can be a ServerCmd, else b''."""
+    if len(msg) > _MAX_CMD_LEN:
+        return b''
+    return msg.bytes if isinstance(msg, zmq.Frame) else msg
+
+def send_credit(dst, num_job):
+    """Tells the navigator that the worker socket `dst` takes `num_job` more jobs."""
+    dst.send(str(num_job).encode('ascii'))
+
+def recv_credit(src):
+    """Returns the identity of the worker socket and the number of jobs it takes."""
+    worker, num_job = src.recv_multipart()
+    return worker, int(num_job)
+
 def send_ndarray(dst, client, job_id, array, flags=0, copy=True, track=False):
     md = dict(dtype=str(array.dtype), shape=array.shape)
     msg_info = jsonapi.dumps(md)
     send_to_next_raw(client, job_id, array, msg_info, dst, flags=flags, copy=copy, track=track )
 
 def recv_ndarray(src):
-    client, req_id, msg, msg_info = recv_from_prev_raw(src)
+    client, req_id, msg, msg_info, _ = recv_from_prev_frames(src)
     arr_info, arr_val = jsonapi.loads(msg_info), msg
     array = decode_ndarray(arr_val, arr_info)
     return to_str(client), to_str(req_id), array, arr_info
@@ -60,29 +105,43 @@ def recv_ndarray(src):
 def decode_ndarray(buffer, info):
     return np.frombuffer(memoryview(buffer), dtype=info['dtype']).reshape(info['shape'])
 
-def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0):
+def send_object(dst, client, job_id, obj, flags=0, copy=True, track=False, protocol=-1, need_compress=0, out_of_band=False):
+    z, obj_info, buffers = encode_object(obj, protocol=protocol, need_compress=need_compress, out_of_band=out_of_band)
+    send_to_next_raw(client, job_id, z, obj_info, dst, flags=flags, copy=copy, track=track, buffers=buffers)
+
+def encode_object(obj, protocol=-1, need_compress=0, out_of_band=False):
+    """Returns the pickle of `obj`, its info and its out-of-band buffers."""
+    buffers = []
     if need_compress == 1:
         p = pickle.dumps(obj, protocol)
         z = zlib.compress(p)
+    elif out_of_band and _PICKLE_OOB:
+        # contiguous numpy arrays are not copied into the pickle but sent as frames
+        protocol = 5
+        z = pickle.dumps(obj, protocol, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
     else:
         z = pickle.dumps(obj, protocol)
-    obj_info = jsonapi.dumps(dict(protocol=protocol, compress=need_compress))
-    send_to_next_raw(client, job_id, z, obj_info, dst, flags=flags, copy=copy, track=track )
+    obj_info = jsonapi.dumps(dict(protocol=protocol, compress=need_compress, buffers=len(buffers)))
+    return z, obj_info, buffers
 
 def recv_object(src):
-    client, req_id, msg, msg_info = recv_from_prev_raw(src)
+    client, req_id, msg, msg_info, buffers = recv_from_prev_frames(src)
     obj_info, obj_buffer = jsonapi.loads(msg_info), msg
-    obj = decode_object(obj_buffer, obj_info)
+    obj = decode_object(obj_buffer, obj_info, buffers)
     return to_str(client), to_str(req_id), obj, obj_info
 
-def decode_object(buffer, info):
+def decode_object(buffer, info, buffers=()):
     pickle_protocol = info['protocol']
     need_decompress = info['compress']
     if need_decompress == 1:
         obj_decompressed = zlib.decompress(buffer)
         obj = pickle.loads(obj_decompressed)
+    elif info.get('buffers'):
+        # arrays are views of the received frames, read-only
+        obj = pickle.loads(memoryview(buffer), buffers=[memoryview(b) for b in buffers])
     else:
-        obj = pickle.loads(buffer)
+        obj = pickle.loads(memoryview(buffer))
     return obj
 
 def to_bytes(bytes_or_str):
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
 # Han Xiao <artex.xh@gmail.com> <https://hanxiao.github.io>
+import math
 import multiprocessing
 import os
+import queue
 import random
 import sys
 import threading
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
 from itertools import chain
 from multiprocessing import Process
@@ -25,6 +27,44 @@ from .http import BertHTTPProxy
 from .zmq_decor import multi_socket
 
 
+def pad_batch(arrays):
+    """Stacks arrays of the same rank, zero padding each one at the end of
+    every axis to the largest shape of the batch."""
+    if len(set(a.ndim for a in arrays)) > 1:
+        raise ValueError('can not pad arrays of different ranks: %s' % [a.shape for a in arrays])
+    shape = tuple(max(dims) for dims in zip(*(a.shape for a in arrays)))
+    batch = np.zeros((len(arrays),) + shape, dtype=np.result_type(*arrays))
+    for i, a in enumerate(arrays):
+        batch[(i,) + tuple(slice(0, d) for d in a.shape)] = a
+    return batch
+
+
+class StageTimer(object):
+    """Sums the time batches spend in each stage of a worker and logs the
+    averages every `interval` batches."""
+
+    def __init__(self, logger, stages, interval=100):
+        self.logger = logger
+        self.stages = stages
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.elapsed = dict.fromkeys(self.stages, 0.)
+        self.counts = dict.fromkeys(self.stages, 0)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.elapsed[stage] += seconds
+            self.counts[stage] += 1
+            if stage == self.stages[-1] and self.counts[stage] >= self.interval:
+                self.logger.info('avg time per batch: %s' % ', '.join(
+                    '%s %.2fms' % (s, self.elapsed[s] / self.counts[s] * 1000) if self.counts[s] else '%s -' % s
+                    for s in self.stages))
+                self.reset()
+
+
 class WKRWorkerSkeleton(Process):
     def __init__(self, id, args, worker_address_list, sink_address, device_id, gpu_fraction, model_name, batch_size, batch_timeout, tmp_dir, name='WORKER', color='yellow'):
         super().__init__()
@@ -33,6 +73,7 @@ class WKRWorkerSkeleton(Process):
         self.worker_id = id
         self.device_id = device_id
         self.transfer_proto = args.protocol
+        self.zero_copy = args.zero_copy
 
         self.daemon = True
         self.exit_flag = multiprocessing.Event()
@@ -51,6 +92,12 @@ class WKRWorkerSkeleton(Process):
 
         self.batch_size = batch_size
         self.batch_group_timeout = batch_timeout
+        self.batch_shape_mode = args.batch_shape_mode
+        self.worker_credits = args.worker_credits or 2 * batch_size
+        # poll timeout(ms) while no batch is pending
+        self.idle_poll_timeout = 100
+        self.pipeline_depth = args.pipeline_depth
+        self.stage_timer = None
 
         # self.use_fp16 = args.fp16
         self.is_ready = multiprocessing.Event()
@@ -89,9 +136,11 @@ class WKRWorkerSkeleton(Process):
         if self.transfer_proto == 'obj':
             return list_input
         else:
+            if self.batch_shape_mode == 'pad':
+                return pad_batch(list_input)
             processed = [np.expand_dims(a, axis=0) for a in list_input]
             return np.vstack(processed)
-            
+
     def load_raw_msg(self, sock):
         client, req_id, msg, msg_info = recv_from_prev(self.transfer_proto, sock)
         return client, req_id, msg
@@ -100,7 +149,7 @@ class WKRWorkerSkeleton(Process):
         self._run()
 
     @zmqd.socket(zmq.PUSH)
-    @multi_socket(zmq.PULL, num_socket='num_concurrent_socket')
+    @multi_socket(zmq.DEALER, num_socket='num_concurrent_socket')
     def _run(self, sink_embed, *receivers):
         # Windows does not support logger in MP environment, thus get a new logger
         # inside the process for better compatibility
@@ -118,26 +167,85 @@ class WKRWorkerSkeleton(Process):
             sock.connect(addr)
         sink_embed.connect(self.sink_address)
 
+        self.stage_timer = StageTimer(logger, ('preprocess', 'predict', 'postprocess'))
         generator = self.input_fn_builder(receivers, input_preprocessor)
+        if self.pipeline_depth > 0:
+            self._run_pipeline(generator, model, output_postprocessor, sink_embed, logger)
+            return
+
         for msg in generator():
+            result = self._predict_batch(model, msg, logger)
+            if result is not None:
+                self._send_batch(result, output_postprocessor, sink_embed, logger)
+
+    def _run_pipeline(self, generator, model, output_postprocessor, sink_embed, logger):
+        # batch N+1 is received and preprocessed, and the outputs of batch N-1
+        # postprocessed and sent, in threads while batch N is predicted.
+        # None ends the pipeline.
+        batches = queue.Queue(maxsize=self.pipeline_depth)
+        results = queue.Queue(maxsize=self.pipeline_depth)
+
+        def prefetch():
             try:
-                
-                client_ids, input_data = msg['client_ids'], msg['input_data']
-                logger.warning("Number of client ID: {}".format(len(client_ids)))
-                outputs = self.predict(model, input_data)
-
-                if len(outputs) != len(input_data):
-                    logger.warning("output after process by predict func not match. input: {}, output: {}".format(input_data, outputs))
-
-                outputs = output_postprocessor(outputs)
-                for client_id, output in zip(client_ids, outputs):
-                    cliend, req_id = client_id.split('#')
-                    send_to_next(self.transfer_proto, cliend, req_id, output, sink_embed)
-
-            except Exception as e:
-                import traceback
-                tb=traceback.format_exc()
-                logger.error('{}\n{}'.format(e, tb))
+                for msg in generator():
+                    batches.put(msg)
+            finally:
+                batches.put(None)
+
+        def send():
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                self._send_batch(result, output_postprocessor, sink_embed, logger)
+
+        prefetcher = threading.Thread(target=prefetch, name='prefetch', daemon=True)
+        sender = threading.Thread(target=send, name='send', daemon=True)
+        prefetcher.start()
+        sender.start()
+        logger.info('pipelined with %d batches in flight per stage' % self.pipeline_depth)
+
+        while True:
+            msg = batches.get()
+            if msg is None:
+                break
+            result = self._predict_batch(model, msg, logger)
+            if result is not None:
+                results.put(result)
+        results.put(None)
+        sender.join()
+
+    def _predict_batch(self, model, msg, logger):
+        try:
+            start = time.time()
+            client_ids, input_data = msg['client_ids'], msg['input_data']
+            logger.warning("Number of client ID: {}".format(len(client_ids)))
+            outputs = self.predict(model, input_data)
+
+            if len(outputs) != len(input_data):
+                logger.warning("output after process by predict func not match. input: {}, output: {}".format(input_data, outputs))
+            self.stage_timer.add('predict', time.time() - start)
+            return client_ids, outputs
+
+        except Exception as e:
+            import traceback
+            tb=traceback.format_exc()
+            logger.error('{}\n{}'.format(e, tb))
+
+    def _send_batch(self, result, output_postprocessor, sink_embed, logger):
+        try:
+            start = time.time()
+            client_ids, outputs = result
+            outputs = output_postprocessor(outputs)
+            for client_id, output in zip(client_ids, outputs):
+                cliend, req_id = client_id.split('#')
+                send_to_next(self.transfer_proto, cliend, req_id, output, sink_embed, zero_copy=self.zero_copy)
+            self.stage_timer.add('postprocess', time.time() - start)
+
+        except Exception as e:
+            import traceback
+            tb=traceback.format_exc()
+            logger.error('{}\n{}'.format(e, tb))
 
     def input_fn_builder(self, socks, input_preprocessor):
         def gen():
@@ -148,36 +256,76 @@ class WKRWorkerSkeleton(Process):
             poller = zmq.Poller()
             for sock in socks:
                 poller.register(sock, zmq.POLLIN)
+                # the navigator queues that many jobs at most on each socket
+                send_credit(sock, self.worker_credits)
 
             logger.info('ready and listening!')
             self.is_ready.set()
 
-            def get_single_data(timeout=20):
-                events = dict(poller.poll(timeout=timeout))
-                if events:
+            bucketing = self.transfer_proto == 'numpy' and self.batch_shape_mode == 'bucket'
+            # pending batches by input shape (a single one without bucketing),
+            # oldest first, as [deadline, datas]
+            pending = OrderedDict()
+
+            def read_ready():
+                # read what is queued on the sockets without blocking, one
+                # message of each socket in turn, until a batch is full.
+                # Freed slots are given back to the navigator once read, a
+                # worker busy predicting does not read and gets no more jobs
+                received_per_sock = [0] * len(socks)
+                try:
+                    read_ready_socks(received_per_sock)
+                finally:
+                    for sock, num_job in zip(socks, received_per_sock):
+                        if num_job:
+                            send_credit(sock, num_job)
+
+            def read_ready_socks(received_per_sock):
+                while True:
+                    received = False
                     for sock_idx, sock in enumerate(socks):
-                        if sock in events:
-                            client, req_id, msg = self.load_raw_msg(sock)
-                            logger.info('new job\tsocket: {}\tclient: {}#{}'.format(sock_idx, client, req_id))
-                            return {
-                                'client_id': client+'#'+req_id,
-                                'client_msg': msg
-                            }
-                return None
+                        if not sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                            continue
+                        client, req_id, msg = self.load_raw_msg(sock)
+                        received_per_sock[sock_idx] += 1
+                        logger.info('new job\tsocket: {}\tclient: {}#{}'.format(sock_idx, client, req_id))
+                        key = msg.shape if bucketing else None
+                        if key not in pending:
+                            # the batch waits for batch_group_timeout at most
+                            pending[key] = [time.time() + self.batch_group_timeout / 1000., []]
+                        datas = pending[key][1]
+                        datas.append({
+                            'client_id': client+'#'+req_id,
+                            'client_msg': msg
+                        })
+                        if len(datas) >= self.batch_size:
+                            return
+                        received = True
+                    if not received:
+                        return
 
             while not self.exit_flag.is_set():
                 try:
-                    datas = []
-                    for _ in range(self.batch_size):
-                        d = get_single_data(timeout=self.batch_group_timeout)
-                        if d is not None:
-                            datas.append(d)
-                    if len(datas) > 0:
-                        
+                    if pending:
+                        deadline = min(deadline for deadline, _ in pending.values())
+                        timeout = max(0, math.ceil((deadline - time.time()) * 1000))
+                    else:
+                        timeout = self.idle_poll_timeout
+                    if poller.poll(timeout=timeout):
+                        read_ready()
+
+                    now = time.time()
+                    ready = [key for key, (deadline, datas) in pending.items()
+                             if len(datas) >= self.batch_size or deadline <= now]
+                    for key in ready:
+                        _, datas = pending.pop(key)
                         client_ids = [d['client_id'] for d in datas]
                         batch_raw = [d['client_msg'] for d in datas]
+                        start = time.time()
                         batch = self.batching(batch_raw)
                         batch_processed = input_preprocessor(batch)
+                        if self.stage_timer is not None:
+                            self.stage_timer.add('preprocess', time.time() - start)
                         yield {
                             'client_ids': client_ids,
                             'input_data': batch_processed
@@ -187,4 +335,4 @@ class WKRWorkerSkeleton(Process):
                     tb=traceback.format_exc()
                     logger.error('{}\n{}'.format(e, tb))
 
-        return gen
\ No newline at end of file
+        return gen